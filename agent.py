@@ -1,27 +1,45 @@
 from world import *
 from environment import *
+from sb3env import *
 from config import *
 
 from stable_baselines3 import PPO, A2C
 from stable_baselines3.common.monitor import Monitor
 from gym.wrappers import TimeLimit
 
-from stable_baselines3.common.callbacks import BaseCallback, CheckpointCallback, EvalCallback
+from stable_baselines3.common.callbacks import BaseCallback, EvalCallback
 
-import os
+from player import *
+from trainer import BackgroundTrainer
+from checkpoints import CheckpointManager, AsyncCheckpointCallback, SaveBestCallback, model_file
+from evaluation import EvaluationPool, AsyncEvalCallback
+from profiling import profiler
 
-MAX_STEPS_PER_EPISODE = config['n_max_steps_per_episode']
+import torch as th
+import threading
+import queue
+import os
 
-class BotAgent:
+class BotAgent(PolicyPlayer):
+    """
+    PPO agent of the main bot: trains on the world's arenas (or on worker
+    processes) and plays through PolicyPlayer
+    """
 
     def __init__(self, world, model_path, model_prefix, best_model=None, log_path="./logs"):
 
-        self.world = world
         env = BotWorldEnv(world)
         env = TimeLimit( env, max_episode_steps=config['n_max_steps_per_episode'] )
         # env = Monitor(env, filename=f"/logs/{config['model_prefix']}/stats_{config.get('best_model', 'new')}.log")
+        PolicyPlayer.__init__(self, world, env=env)
+
+        if config.get('n_workers', 0) > 0:
+            # train on a pool of offscreen worker processes, each with its own world
+            env = WorkerPoolVecEnv(config['n_workers'])
+        elif len(world.arenas) > 1:
+            # train on all the arenas, one frame per vectorized step
+            env = BotWorldVecEnv(world, max_episode_steps=config['n_max_steps_per_episode'])
         self.environment = env
-        self.agent = None
 
         self.model_path = model_path
         self.model_prefix = model_prefix
@@ -29,9 +47,13 @@ class BotAgent:
         self.log_path = log_path
         self.load()
 
-        self.playing_steps = 0
-        self.current_obs = None
-        self.cumulative_reward = 0
+        if config.get('quantized_inference', False):
+            self.quantizePlayPolicy()
+
+        if config.get('profiling', False):
+            profiler.instrument(self.policy, 'predict', 'inference')
+
+        self.trainer = None
 
     def load(self):
 
@@ -57,7 +79,7 @@ class BotAgent:
         else:
             try:
                 print(f"loading agent: {self.best_model}")
-                model_fname = f"{self.model_path}/{self.model_prefix}/{self.best_model}.zip"
+                model_fname = model_file(f"{self.model_path}/{self.model_prefix}", self.model_prefix, self.best_model)
                 self.agent = PPO.load( model_fname, self.environment 
                                     , learning_rate=linear_schedule(initial_learning_rate))
             except Exception as e:
@@ -66,94 +88,158 @@ class BotAgent:
                 raise e
 
 
-    def learn(self, n_episodes, n_max_steps_per_episode=MAX_STEPS_PER_EPISODE):
+    def quantizePlayPolicy(self):
+        """
+        Plays with an int8 copy of the policy, calibrated on recorded observations
+        """
+        from quantization import QuantizedPolicy, calibration_observations
+
+        dataset_path = config.get('quantization_dataset', None) or config.get('record_path', None)
+        if dataset_path is None or not os.path.exists(dataset_path):
+            print("quantized_inference needs recorded observations (quantization_dataset or record_path), playing the float policy")
+            return
+
+        self.play_policy = QuantizedPolicy(self.agent.policy, calibration_observations(dataset_path))
+
+        # requantized on its own thread when background learning updates the
+        # weights, calibration takes far longer than a frame
+        self.requantize_requests = queue.Queue(maxsize=1)
+        threading.Thread(target=self.requantize_loop, name='Requantizer', daemon=True).start()
+
+    def requantize_loop(self):
+
+        while True:
+            self.requantize_requests.get()
+            try:
+                self.play_policy.requantize(self.policy_lock)
+            except Exception as e:
+                print(f"ERROR: cannot requantize the play policy: {e}")
+
+    def learn(self, n_episodes, n_max_steps_per_episode=MAX_STEPS_PER_EPISODE, callbacks=None):
         
         if self.agent == None or self.environment == None:
             raise
 
-        base.win.setActive(False)
+        if base.win is not None:
+            base.win.setActive(False)
             
-        custom_callback = CustomSaveBestCallback(self.model_path, self.model_prefix)
-        eval_callback = EvalCallback(eval_env=self.environment,
-                                     best_model_save_path=f"{self.model_path}/{self.model_prefix}",
-                                    log_path="./logs/", 
-                                    eval_freq=config['eval_freq'],
-                                    deterministic=True, 
-                                    render=False, 
-                                    callback_on_new_best=custom_callback
-                                    )
-
-        checkpoint_callback = CheckpointCallback( \
-            save_freq=config['checkpoint_save_freq'], 
-            save_path=f"{self.model_path}/{self.model_prefix}", 
-            name_prefix=f"{self.model_prefix}_checkpoint"
-            )
+        # checkpoints are written in the background, the newest and the best are kept
+        checkpoints = CheckpointManager(f"{self.model_path}/{self.model_prefix}", self.model_prefix,
+                                        keep_last=config.get('checkpoint_keep_last', 5),
+                                        keep_best=config.get('checkpoint_keep_best', 3))
+
+        evaluation = None
+        if config.get('eval_workers', 1) > 0:
+            # evaluate policy snapshots on separate headless worlds while training goes on
+            evaluation = EvaluationPool(config.get('eval_workers', 1),
+                                        n_eval_episodes=config.get('n_eval_episodes', 5))
+            eval_callback = AsyncEvalCallback(evaluation, config['eval_freq'], checkpoints, log_path="./logs/")
+        else:
+            eval_callback = EvalCallback(eval_env=self.environment,
+                                        log_path="./logs/", 
+                                        eval_freq=config['eval_freq'],
+                                        deterministic=True, 
+                                        render=False, 
+                                        callback_on_new_best=SaveBestCallback(checkpoints)
+                                        )
+
+        checkpoint_callback = AsyncCheckpointCallback(checkpoints, config['checkpoint_save_freq'])
 
         debug_state = config['debug']
         config['debug'] = False
 
-        model_history = self.agent.learn( 
-            total_timesteps=n_episodes*n_max_steps_per_episode,
-            reset_num_timesteps=False,  
-            callback=[eval_callback, checkpoint_callback],
-            log_interval=1
-        )
-        config['debug'] = debug_state
-
-        base.win.setActive(True)
+        try:
+            model_history = self.agent.learn( 
+                total_timesteps=n_episodes*n_max_steps_per_episode,
+                reset_num_timesteps=False,  
+                callback=[eval_callback, checkpoint_callback] + (callbacks or []),
+                log_interval=1
+            )
+        finally:
+            config['debug'] = debug_state
+            if evaluation is not None:
+                evaluation.close()
+            checkpoints.close()
+
+        if base.win is not None:
+            base.win.setActive(True)
         
         print("learning terminated...")
-    
 
-    def play(self, n_max_steps_per_episode=MAX_STEPS_PER_EPISODE ):
-        
-        if self.agent == None or self.environment == None:
-            raise
+    def learn_in_background(self, n_episodes, n_max_steps_per_episode=MAX_STEPS_PER_EPISODE):
+        """
+        Trains in a separate process with its own headless world, while
+        the viewport keeps running; the policy used by play is refreshed
+        with the trained weights every policy_sync_interval seconds
+        """
+        if self.trainer is not None and self.trainer.is_alive():
+            print("already learning in background")
+            return
+
+        self.trainer = BackgroundTrainer(n_episodes, n_max_steps_per_episode)
+        self.trainer.start()
+
+        taskMgr.doMethodLater(config.get('policy_sync_interval', 5.0), self.sync_policy, 'AgentPolicySync')
+
+    def sync_policy(self, task):
+
+        # checked first, the last weights may be published right before the end
+        learning = self.trainer.is_alive()
+
+        weights = self.trainer.latest_weights()
+        if weights is not None:
+            with self.policy_lock:
+                self.agent.policy.load_state_dict({ k: th.as_tensor(v) for k, v in weights.items() })
+            if self.play_policy is not None:
+                try:
+                    self.requantize_requests.put_nowait(True)
+                except queue.Full:
+                    # the pending request will read these weights
+                    pass
+            debug("policy updated from background learning")
+
+        if not learning:
+            self.world.learning = False
+            print("learning terminated...")
+            return task.done
 
-        self.playing_steps = n_max_steps_per_episode
-        self.current_obs = self.environment.reset(reset_positions=False)
-        self.cumulative_reward = 0
+        return task.again
 
-        taskMgr.add(self.playStep, 'AgentPlayUpdate')
 
+class PublishWeightsCallback(BaseCallback):
+    """
+    Publishes the policy weights as numpy arrays every publish_freq steps,
+    replacing the ones not consumed yet. Stops training when stop_event is set.
+    """
 
-    def playStep(self, task):
+    def __init__(self, weights_queue, stop_event, publish_freq):
+        self.weights_queue = weights_queue
+        self.stop_event = stop_event
+        self.publish_freq = publish_freq
+        super(PublishWeightsCallback, self).__init__()
 
-        dt = globalClock.getDt()
+    def _on_step(self) -> bool:
 
-        action = self.agent.predict(self.current_obs)[0]
-        
-        self.current_obs, reward, done, info = self.environment.step(action)
- 
-        self.cumulative_reward += reward
+        if self.n_calls % self.publish_freq == 0:
+            self.publish()
 
-        if done: # episode ended
-            return task.done
+        return not self.stop_event.is_set()
 
-        self.playing_steps -= 1     
-        if self.playing_steps <= 0:
-            print("max play step reached")
-            return task.done
-        
-        return task.cont
+    def _on_training_end(self) -> None:
+        self.publish()
 
+    def publish(self):
 
-class CustomSaveBestCallback(BaseCallback):
-
-    def __init__(self, model_path, model_prefix):
-        self.model_path = model_path
-        self.model_prefix = model_prefix
-        super(CustomSaveBestCallback, self).__init__()
-
-    def _on_step(self) -> bool:
-        print(f"eval callback steps: {self.num_timesteps}")
-
-        file_path = f"{self.model_path}/{self.model_prefix}/best_model.zip"
-        new_file_path = f"{self.model_path}/{self.model_prefix}/{self.model_prefix}_{self.num_timesteps}_steps.zip"
-        if os.path.exists(f"agents"):
-            directory = os.path.dirname(file_path)
-            os.rename(file_path, new_file_path)
-            print(f"File '{file_path}' renamed to '{new_file_path}'")
-        else:
-            print(f"File '{file_path}' does not exist.")
-        return True
+        weights = { k: v.detach().cpu().numpy() for k, v in self.model.policy.state_dict().items() }
+        try:
+            self.weights_queue.put_nowait(weights)
+        except queue.Full:
+            # drop the stale weights nobody has read yet
+            try:
+                self.weights_queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                self.weights_queue.put_nowait(weights)
+            except queue.Full:
+                pass
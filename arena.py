@@ -0,0 +1,291 @@
+from panda3d.core import *
+
+from bot import Bot
+from collision import *
+from assets import loadCachedModel
+from environment import BOT_COLLISION_RADIUS, TARGET_COLLISION_RADIUS, STATE_DTYPE
+from observation import observation_spec, FrameProcessor
+from config import *
+
+import numpy as np
+import math
+
+# observations returned by getBotCameraBuffer stay valid for this many calls
+OBS_RING_SIZE = 4
+
+class Arena:
+    """
+    A bot/target pair together with its bot camera buffer and collision nodes.
+    Arena 0 lives under the world's render node and is the one shown in the
+    main viewport, additional arenas get their own scene root so their bot
+    cameras only see their own bot and target.
+    """
+
+    def __init__(self, world, index, root, interactive=False):
+
+        self.world = world
+        self.index = index
+        self.root = root
+        self.interactive = interactive
+
+        # bot and target live in their own subtree, apart from the scenery,
+        # so that collision traversal doesn't walk the skybox and the ground
+        self.actors = self.root.attachNewNode('actors')
+
+        self.loadBot(interactive)
+        self.loadTarget()
+
+        self.setupCollisions()
+        self.setupBotCamera()
+        self.setupObservationRing()
+
+    @property
+    def hud(self):
+        """
+        The world's HUD shows the main arena only
+        """
+        return self.world.hud if self.index == 0 else None
+
+    # 3D Model loading functions
+
+    def loadBot(self, interactive):
+        """
+        Loads 3d model for the bot (blue ball with camera)
+        """
+        self.bot = Bot(self.world, interactive=interactive)
+        self.bot.reparentTo(self.actors)
+        self.bot.setPos(5, -5, 0)
+
+    def loadTarget(self):
+        """
+        Loads 3d model for target (green box)
+        """
+        self.target = loadCachedModel(self.world.loader, "assets/models/target.egg")
+        self.target.setPos(-5, 5, 0)
+        self.target.reparentTo(self.actors)
+
+    # 3D World seutup functions
+
+    def setupCollisions(self):
+        """
+        Setup collision system to capture collisions between
+        the bot and the target.
+        With the 'analytic' collision_backend the spheres of the collision
+        nodes are tested directly through a CollisionIndex, with 'traverser'
+        a CollisionTraverser walks the actors subtree.
+        """
+        self.cTrav = CollisionTraverser()  # Collision traverser for handling collisions
+        self.cHandler = CollisionHandlerQueue()  # Collision handler to store collision results
+
+        # Create collision nodes for bot and target
+        botCollisionNode = CollisionNode("bot")
+        botCollisionNode.addSolid(CollisionSphere(0, 0, 0, BOT_COLLISION_RADIUS))  # Adjust the sphere radius according to your bot's size
+        botCollisionNP = self.bot.attachNewNode(botCollisionNode)
+
+        targetCollisionNode = CollisionNode("target")
+        targetCollisionNode.addSolid(CollisionSphere(0, 0, 0, TARGET_COLLISION_RADIUS))  # Adjust the sphere radius according to your target's size
+        targetCollisionNP = self.target.attachNewNode(targetCollisionNode)
+
+        self.cTrav.addCollider(botCollisionNP, self.cHandler)  # Add bot's collision node to the traverser
+
+        self.collisionBackend = config.get('collision_backend', 'analytic')
+        self.botCollider = MovingCollider(self.bot, self.root)
+        self.collisions = CollisionIndex(self.root)
+        self.collisions.addObject('target', self.target)
+
+    def setupBotCamera(self):
+        """
+        Setup the bot camera.
+        This is a secondary camera attached to the bot, provides its PoV.
+        Only the camera of an interactive arena is shown in the main window.
+        see: self.getBotCameraBuffer
+        """
+
+        self.obsSpec = observation_spec()
+        self.filmWidth, self.filmHeight = self.obsSpec.width, self.obsSpec.height
+        self.botCamBuffer = self.world.makeBotCameraBuffer(f'botCam-{self.index}', self.filmWidth, self.filmHeight )
+
+        # in pipelined readback mode the camera copies each frame into the
+        # next texture of a rotation, see rotateReadbackTexture
+        n_textures = config.get('readback_textures', 2) if self.world.pipelinedReadback else 1
+        self.botCamTextures = [ Texture(f'botCam-{self.index}-{i}') for i in range(n_textures) ]
+        self.readbackIndex = 0
+
+        self.botCamTexture = self.botCamTextures[0]
+        self.botCamBuffer.addRenderTexture(self.botCamTexture,
+                                           GraphicsOutput.RTM_copy_ram
+                                           )
+
+        # the camera renders the scene graph it belongs to, so once reparented
+        # to the bot it only sees this arena's root
+        self.botCam  = base.makeCamera( self.botCamBuffer )
+
+        self.world.applyRenderProfile(self.botCam, self.botCamBuffer)
+
+        self.botCam.reparentTo(self.bot)
+        self.botCam.setPos(0, 0.15, 0.5)
+
+        # Get the current lens of the botCam
+        self.botCam.node().getLens().setFilmSize(self.filmWidth, self.filmHeight)
+
+        if self.interactive:
+            botCamDispRegion = base.win.makeDisplayRegion(0.75, 0.95, 0.05, 0.3 )
+            botCamDispRegion.setCamera(self.botCam)
+            botCamDispRegion.setClearDepthActive(True)
+
+    def rotateReadbackTexture(self):
+        """
+        Called before each frame in pipelined readback mode: the texture
+        filled by the previous frame becomes the one observations are read
+        from, and the frame about to be rendered is copied into the next one
+        """
+        self.botCamTexture = self.botCamTextures[self.readbackIndex]
+        self.readbackIndex = (self.readbackIndex + 1) % len(self.botCamTextures)
+
+        self.botCamBuffer.clearRenderTextures()
+        self.botCamBuffer.addRenderTexture(self.botCamTextures[self.readbackIndex],
+                                           GraphicsOutput.RTM_copy_ram
+                                           )
+
+    def setupObservationRing(self):
+        """
+        Preallocates the ring of observations filled by getBotCameraBuffer,
+        and the buffers of their preprocessing, so that no memory is
+        allocated per step
+        """
+        ring_size = config.get('obs_ring_size', OBS_RING_SIZE)
+        self.obsRing = np.zeros((ring_size,) + self.obsSpec.frame_shape, dtype=np.uint8)
+        self.obsRingIndex = 0
+        self.frameProcessor = FrameProcessor(self.obsSpec)
+
+    # Utility functions
+
+    def collisionDetected(self):
+        """
+        Called to check wether a collision between the bot
+        and the target occurred. Signals successfull end of episode.
+        """
+        if self.collisionBackend == 'traverser':
+            # Check if any collisions occurred
+            self.cTrav.traverse(self.actors)
+            return self.cHandler.getNumEntries() > 0
+
+        for sphere in self.botCollider.getSpheres():
+            if self.collisions.query(*sphere):
+                return True
+        return False
+
+    def refreshCollisions(self):
+        """
+        To be called after the target (or any other still object) is moved
+        """
+        self.collisions.refresh()
+
+    def saveState(self, out=None):
+        """
+        Bot pose and target position as a STATE_DTYPE record, written into
+        out when given; episode_steps is left to the environment
+        """
+        if out is None:
+            out = np.zeros((), dtype=STATE_DTYPE)
+
+        botPos = self.bot.getPos()
+        targetPos = self.target.getPos()
+        out['bot_pos'] = (botPos.x, botPos.y)
+        out['bot_heading'] = self.bot.getH()
+        out['target_pos'] = (targetPos.x, targetPos.y)
+        return out
+
+    def restoreState(self, state):
+        """
+        Moves the bot and the target back to a STATE_DTYPE record
+        """
+        x, y = state['bot_pos']
+        self.bot.setPos(x, y, 0.0)
+        self.bot.setH(state['bot_heading'])
+
+        x, y = state['target_pos']
+        targetPos = self.target.getPos()
+        if targetPos.x != x or targetPos.y != y:
+            self.target.setPos(x, y, 0.0)
+            self.refreshCollisions()
+
+    def getBotTargetDistance(self):
+        """
+        Calculates current distance between the bot and the target.
+        Useful for reward evaluation.
+        """
+        return self.bot.getDistance(self.target)
+
+    def getBotTargetAngle(self):
+        """
+        calculate angle between the bot's y axis and the
+        line that connects its position to the target
+        see: https://math.stackexchange.com/questions/878785/how-to-find-an-angle-in-range0-360-between-2-vectors
+        Useful for reward evaluation.
+        """
+
+        bot_pos = self.bot.getPos()
+        target_pos = self.target.getPos()
+
+        u = self.bot.getRelativeVector(self.root, (0, 1, 0)) # bot_y_axis
+        u = Vec2(-u.x, u.y) # don't know why but I have to invert x coord
+
+        v = target_pos - bot_pos # dir_vec
+        v = Vec2(v.x, v.y)
+        v.normalize()
+
+        dot = u.x*v.x + u.y*v.y      # dot product
+        det = u.x*v.y - u.y*v.x      # determinant
+
+        return abs(math.atan2(det, dot))
+
+    def getRamImage(self):
+        """
+        The RAM image of the current bot camera view as a (rows, cols,
+        components) np.array, bottom row first and in BGR(A) order as kept
+        by Panda3D. None if nothing was rendered yet.
+        """
+        if not self.botCamTexture.hasRamImage():
+            return None
+
+        image = np.frombuffer(memoryview(self.botCamTexture.getRamImage()), dtype=np.uint8)
+        return image.reshape(self.filmHeight, self.filmWidth, self.botCamTexture.getNumComponents())
+
+    def getBotCameraBuffer(self, out=None):
+        """
+        Copies the current bot camera view, preprocessed according to the
+        observation spec, into out or into the next slot of the observation
+        ring, and returns it as an np.array of the spec's frame_shape.
+        Ring slots are overwritten after obs_ring_size calls.
+        """
+        if out is None:
+            out = self.obsRing[self.obsRingIndex]
+            self.obsRingIndex = (self.obsRingIndex + 1) % len(self.obsRing)
+
+        image = self.getRamImage()
+        if image is None:
+            # nothing rendered into this texture yet
+            out[:] = 0
+            return out
+
+        # flipping on the render side would also flip the faces winding,
+        # the processor reads the raw image through a flipped view instead
+        return self.frameProcessor.process(image, out)
+
+    def getBotCameraImage(self, out=None):
+        """
+        The current bot camera view as an np.array of (rows, cols, RGB)
+        with the top row first, at the camera resolution and without
+        preprocessing. Allocated when out is not given.
+        """
+        if out is None:
+            out = np.zeros((self.filmHeight, self.filmWidth, 3), dtype=np.uint8)
+
+        image = self.getRamImage()
+        if image is None:
+            out[:] = 0
+            return out
+
+        np.copyto(out, image[::-1, :, 2::-1])
+        return out
@@ -0,0 +1,82 @@
+from panda3d.core import PandaSystem, Filename
+
+import hashlib
+import os
+
+from config import *
+
+# converted models, named after their source path and the hash of its content
+ASSET_CACHE_DIR = 'assets/.cache'
+
+# source paths are keyed relative to the project root, wherever the app is started from
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# bump to invalidate all the cached models, e.g. when the conversion changes
+ASSET_CACHE_VERSION = 1
+
+def assetDigest(path, flatten):
+    """
+    Hash of the source model and of everything that affects its conversion
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        digest.update(f.read())
+    digest.update(f"{ASSET_CACHE_VERSION}:{PandaSystem.getVersionString()}:{flatten}".encode())
+    return digest.hexdigest()[:16]
+
+def assetKey(path):
+    """
+    Cache name of a source model: its stem and a hash of its path in the
+    project, so that models with the same file name don't collide
+    """
+    relative = os.path.relpath(os.path.abspath(path), PROJECT_ROOT).replace(os.sep, '/')
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return f"{stem}-{hashlib.sha1(relative.encode()).hexdigest()[:8]}"
+
+def loadCachedModel(loader, path, flatten=True):
+    """
+    Loads a model through a cache of .bam files, converted from the source
+    (.egg) model the first time and again whenever it changes.
+    flatten: the model is static, its scene graph is flattened before caching
+    """
+    if not config.get('asset_cache', True):
+        model = loader.loadModel(path)
+        if flatten:
+            model.flattenStrong()
+        return model
+
+    cache_dir = config.get('asset_cache_dir', ASSET_CACHE_DIR)
+    key = assetKey(path)
+    bam_path = os.path.join(cache_dir, f"{key}-{assetDigest(path, flatten)}.bam")
+
+    if os.path.exists(bam_path):
+        return loader.loadModel(Filename.fromOsSpecific(bam_path), noCache=True)
+
+    model = loader.loadModel(path, noCache=True)
+    if flatten:
+        model.flattenStrong()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # several worker processes may convert the same model at once
+    tmp_path = f"{bam_path}.{os.getpid()}.tmp"
+    if model.writeBamFile(Filename.fromOsSpecific(tmp_path)):
+        os.replace(tmp_path, bam_path)
+        removeStaleModels(cache_dir, key, bam_path)
+    elif os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    return model
+
+def removeStaleModels(cache_dir, key, current_path):
+    """
+    Deletes the cached conversions of older versions of a model, key being its assetKey
+    """
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith(f"{key}-") and name.endswith('.bam') and path != current_path:
+            # the key may be the prefix of another model's name
+            if len(name) == len(key) + len("-0123456789abcdef.bam"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
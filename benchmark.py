@@ -0,0 +1,379 @@
+# measures the throughput of the simulation and learning hot paths:
+# frame rendering, bot camera readback, collision checks, environment
+# steps, policy inference and PPO learning, for every combination of
+# render profile, camera resolution, number of arenas and window mode
+#
+#   python benchmark.py --output bench.json
+#   python benchmark.py --baseline bench.json --tolerance 0.15
+#   python benchmark.py --profiles interactive,training,minimal
+#
+# with several render profiles the bot camera frames of a fixed set of
+# poses are compared with the interactive ones to report the drift
+#
+# each configuration runs in its own process, since a process can only
+# hold one ShowBase; the exit code is 1 when a benchmark regressed by
+# more than --tolerance with respect to the baseline
+#
+# the imports check times, in fresh interpreters, the imports of the
+# viewer and of render-only workers, and fails when they exceed
+# --import-budget seconds or load the RL stack
+
+import multiprocessing as mp
+import numpy as np
+import argparse
+import platform
+import datetime
+import random
+import subprocess
+import json
+import time
+import sys
+import os
+
+from config import *
+
+BENCHMARKS = [ 'imports', 'startup', 'render', 'readback', 'collision', 'env_step', 'reset', 'restore', 'vecenv_step', 'predict', 'numpy_predict', 'learn' ]
+
+# PPO settings of the learn benchmark, short rollouts to keep it quick
+LEARN_N_STEPS = 256
+LEARN_BATCH_SIZE = 64
+LEARN_TIMESTEPS = 1024
+
+# seconds to wait for a configuration before giving up on it
+CONFIGURATION_TIMEOUT = 600
+
+# poses rendered by each configuration for the render profile drift
+DRIFT_POSES = 50
+
+# modules imported by the viewer and by render-only workers, they must not
+# load the RL stack, which is imported when training or playing starts
+LIGHT_MODULES = [ 'world', 'vecenv', 'workers' ]
+RL_MODULES = [ 'torch', 'stable_baselines3' ]
+IMPORT_BUDGET = 3.0
+
+def measure(fn, iterations, warmup):
+    """
+    Times iterations calls of fn after warmup untimed ones
+    """
+    for _ in range(warmup):
+        fn()
+
+    times = np.empty(iterations)
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn()
+        times[i] = time.perf_counter() - start
+
+    return {
+        'per_sec': float(iterations / times.sum()),
+        'mean_ms': float(times.mean() * 1000),
+        'p50_ms': float(np.percentile(times, 50) * 1000),
+        'p95_ms': float(np.percentile(times, 95) * 1000),
+    }
+
+def configuration_name(mode, profile, resolution, n_envs):
+    return f"{mode}-{profile}-{resolution[0]}x{resolution[1]}-n{n_envs}"
+
+def capture_frames(world, n_poses, seed):
+    """
+    Bot camera frames of the main arena for n_poses random poses
+    """
+    from environment import random_states
+
+    arena = world.arenas[0]
+    states = random_states(np.random.default_rng(seed), n_poses)
+
+    frames = np.empty((n_poses, arena.filmHeight, arena.filmWidth, 3), dtype=np.uint8)
+    for i in range(n_poses):
+        arena.restoreState(states[i])
+        world.stepFrame(sync=True)
+        arena.getBotCameraImage(out=frames[i])
+    return frames
+
+def frame_drift(frames, reference):
+    """
+    Mean absolute error and PSNR of frames with respect to reference frames
+    """
+    error = np.abs(frames.astype(np.float32) - reference)
+    mse = (error**2).mean(axis=(1, 2, 3))
+    psnr = 10 * np.log10(255.0**2 / np.maximum(mse, 1e-10))
+    return { 'mean_abs_error': float(error.mean()), 'psnr_mean': float(psnr.mean()),
+             'psnr_min': float(psnr.min()) }
+
+def run_configuration(config_path, mode, profile, resolution, n_envs, seed, iterations, warmup, benchmarks, asset_cache):
+    """
+    Runs the benchmarks of one configuration, in a fresh process
+    """
+    load_config(config_path)
+    config['asset_cache'] = asset_cache
+    config['render_profile'] = profile
+    config['observation'] = dict(config.get('observation') or {}, size=list(resolution))
+    config['n_arenas'] = n_envs
+    config['n_workers'] = 0
+    config['debug'] = False
+
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData("", "audio-library-name null")
+    loadPrcFileData("", "sync-video false")
+
+    import torch as th
+    random.seed(seed)
+    np.random.seed(seed)
+    th.manual_seed(seed)
+    rng = np.random.default_rng(seed)
+
+    from world import RobotTargetWorld
+    from environment import BotWorldEnv
+    from sb3env import BotWorldVecEnv
+
+    # includes converting the models when the asset cache is cold
+    start = time.perf_counter()
+    world = RobotTargetWorld(interactive=False, headless=(mode == 'headless'))
+    startup = time.perf_counter() - start
+
+    arena = world.arenas[0]
+    env = BotWorldEnv(arena)
+    obs = np.zeros(env.observation_space.shape, dtype=np.uint8)
+
+    results = {}
+
+    if 'startup' in benchmarks:
+        results['startup'] = { 'per_sec': float(1 / startup), 'seconds': float(startup) }
+
+    # not a benchmark, handed back to compute the drift between profiles
+    results['frames'] = capture_frames(world, DRIFT_POSES, seed)
+
+    if 'render' in benchmarks:
+        results['render'] = measure(world.graphicsEngine.renderFrame, iterations, warmup)
+
+    if 'readback' in benchmarks:
+        world.stepFrame(sync=True)
+        results['readback'] = measure(lambda: arena.getBotCameraBuffer(out=obs), iterations, warmup)
+
+    if 'collision' in benchmarks:
+        results['collision'] = measure(arena.collisionDetected, iterations, warmup)
+
+    env.seed(seed)
+
+    if 'env_step' in benchmarks:
+        env.reset()
+        def env_step():
+            _, _, done, _ = env.step(rng.integers(3))
+            if done:
+                env.reset()
+        results['env_step'] = measure(env_step, iterations, warmup)
+
+    if 'reset' in benchmarks:
+        results['reset'] = measure(env.reset, iterations, warmup)
+
+    if 'restore' in benchmarks:
+        state = env.save_state()
+        results['restore'] = measure(lambda: env.restore_state(state), iterations, warmup)
+
+    vec_env = BotWorldVecEnv(world)
+    vec_env.seed(seed)
+
+    if 'vecenv_step' in benchmarks:
+        vec_env.reset()
+        result = measure(lambda: vec_env.step(rng.integers(3, size=n_envs)), iterations, warmup)
+        # counted in environment steps, one per arena
+        result['per_sec'] *= n_envs
+        results['vecenv_step'] = result
+
+    if 'predict' in benchmarks or 'numpy_predict' in benchmarks or 'learn' in benchmarks:
+        from stable_baselines3 import PPO
+        model = PPO("CnnPolicy", vec_env, n_steps=LEARN_N_STEPS, batch_size=LEARN_BATCH_SIZE,
+                    seed=seed, verbose=0)
+
+    if 'predict' in benchmarks:
+        batch = vec_env.reset()
+        results['predict'] = measure(lambda: model.predict(batch, deterministic=True), iterations, warmup)
+
+    if 'numpy_predict' in benchmarks:
+        from numpy_policy import export_policy, NumpyPolicy
+        import tempfile
+        batch = vec_env.reset()
+        with tempfile.TemporaryDirectory() as directory:
+            export_policy(model.policy, os.path.join(directory, 'policy.npz'))
+            policy = NumpyPolicy.load(os.path.join(directory, 'policy.npz'))
+        result = measure(lambda: policy.predict(batch, deterministic=True), iterations, warmup)
+        # the export must choose the same actions as SB3
+        result['action_agreement'] = float(np.mean(policy.predict(batch, deterministic=True)[0] ==
+                                                   model.predict(batch, deterministic=True)[0]))
+        results['numpy_predict'] = result
+
+    if 'learn' in benchmarks:
+        total_timesteps = max(LEARN_TIMESTEPS, LEARN_N_STEPS * n_envs)
+        start = time.perf_counter()
+        model.learn(total_timesteps=total_timesteps)
+        elapsed = time.perf_counter() - start
+        results['learn'] = { 'per_sec': float(total_timesteps / elapsed), 'seconds': float(elapsed) }
+
+    return results
+
+def configuration_main(queue, *args):
+    try:
+        queue.put(run_configuration(*args))
+    except Exception as e:
+        queue.put({ 'error': repr(e) })
+
+def import_check(modules, budget):
+    """
+    Imports each module in a fresh interpreter, returns the import times,
+    the RL modules they loaded and whether they are within budget
+    """
+    results = {}
+    for module in modules:
+        code = ("import sys, time\n"
+                "start = time.perf_counter()\n"
+                f"import {module}\n"
+                # one line, the list of loaded modules is empty when the check passes
+                f"print(time.perf_counter() - start, ','.join(m for m in {RL_MODULES!r} if m in sys.modules), sep=';')\n")
+        process = subprocess.run([ sys.executable, '-c', code ], capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+        if process.returncode != 0:
+            results[module] = { 'error': process.stderr.strip().splitlines()[-1:], 'ok': False }
+            continue
+
+        seconds, loaded = process.stdout.splitlines()[-1].split(';')
+        seconds = float(seconds)
+        rl_modules = [ m for m in loaded.split(',') if m ]
+        results[module] = { 'seconds': seconds, 'rl_modules': rl_modules,
+                            'ok': seconds <= budget and not rl_modules }
+
+        status = "ok" if results[module]['ok'] else "OVER BUDGET"
+        print(f"import {module:12s} {seconds:6.2f} s  {' '.join(rl_modules)}  {status}")
+
+    return results
+
+def run_suite(config_path, modes, profiles, resolutions, n_envs_list, seed, iterations, warmup, benchmarks, asset_cache=True):
+
+    context = mp.get_context("spawn")
+    suite = {}
+
+    for mode in modes:
+        for resolution in resolutions:
+            for n_envs in n_envs_list:
+                reference = None
+                for profile in profiles:
+                    name = configuration_name(mode, profile, resolution, n_envs)
+                    print(f"running {name}...")
+
+                    queue = context.Queue()
+                    process = context.Process(target=configuration_main,
+                                              args=(queue, config_path, mode, profile, resolution, n_envs,
+                                                    seed, iterations, warmup, benchmarks, asset_cache))
+                    process.start()
+                    try:
+                        suite[name] = queue.get(timeout=CONFIGURATION_TIMEOUT)
+                    except Exception:
+                        suite[name] = { 'error': 'no result, the process crashed or timed out' }
+                    process.join(5)
+                    if process.is_alive():
+                        process.terminate()
+
+                    if 'error' in suite[name]:
+                        print(f"  {suite[name]['error']}")
+                        continue
+
+                    frames = suite[name].pop('frames')
+                    if profile == 'interactive':
+                        reference = frames
+                    elif reference is not None:
+                        suite[name]['drift'] = frame_drift(frames, reference)
+
+                    for benchmark, result in suite[name].items():
+                        if 'per_sec' in result:
+                            print(f"  {benchmark:12s} {result['per_sec']:12.1f} /s")
+                        else:
+                            print(f"  {benchmark:12s} psnr {result['psnr_mean']:.1f} dB, mean abs error {result['mean_abs_error']:.2f}")
+
+    return suite
+
+def compare(suite, baseline, tolerance):
+    """
+    Returns the (configuration, benchmark, ratio) of the benchmarks slower than
+    the baseline by more than tolerance, ratio is current/baseline throughput
+    """
+    regressions = []
+    for name, results in suite.items():
+        for benchmark, result in results.items():
+            reference = baseline.get(name, {}).get(benchmark)
+            if not isinstance(result, dict) or not isinstance(reference, dict) or 'per_sec' not in result:
+                continue
+            ratio = result['per_sec'] / reference['per_sec']
+            status = "REGRESSION" if ratio < 1 - tolerance else "ok"
+            print(f"{name:24s} {benchmark:12s} {ratio:6.2f}x  {status}")
+            if ratio < 1 - tolerance:
+                regressions.append((name, benchmark, ratio))
+    return regressions
+
+def parse_resolution(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="simulation and learning throughput benchmarks")
+    parser.add_argument('--output', type=str, default=None, help='json file for the results')
+    parser.add_argument('--baseline', type=str, default=None, help='json results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown')
+    parser.add_argument('--modes', type=str, default='headless', help='comma separated: headless, windowed')
+    parser.add_argument('--profiles', type=str, default='interactive', help='comma separated render profiles, interactive first for the drift')
+    parser.add_argument('--resolutions', type=str, default='80x60,160x120', help='comma separated WxH')
+    parser.add_argument('--n-envs', type=str, default='1,4', help='comma separated numbers of arenas')
+    parser.add_argument('--benchmarks', type=str, default=','.join(BENCHMARKS))
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-asset-cache', action='store_true', help='load the .egg models directly, to compare startup times')
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET, help='seconds allowed to import the viewer and worker modules')
+    args, _ = parser.parse_known_args()
+
+    benchmarks = args.benchmarks.split(',')
+    imports = None
+    if 'imports' in benchmarks:
+        imports = import_check(LIGHT_MODULES, args.import_budget)
+
+    suite = run_suite(os.environ[CONFIG_ENV_VAR],
+                      args.modes.split(','),
+                      args.profiles.split(','),
+                      [ parse_resolution(r) for r in args.resolutions.split(',') ],
+                      [ int(n) for n in args.n_envs.split(',') ],
+                      args.seed, args.iterations, args.warmup,
+                      benchmarks,
+                      asset_cache=not args.no_asset_cache)
+
+    report = {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'seed': args.seed,
+            'iterations': args.iterations,
+            'asset_cache': not args.no_asset_cache,
+        },
+        'results': suite,
+        'imports': imports,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    failed = False
+    if imports is not None and not all(result['ok'] for result in imports.values()):
+        print("imports check failed")
+        failed = True
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(suite, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}")
+            failed = True
+
+    if failed:
+        sys.exit(1)
@@ -1,7 +1,7 @@
 # from direct.actor.Actor import Actor
 from panda3d.core import NodePath
 
-from agent import *
+from assets import loadCachedModel
 from config import *
 
 # 
@@ -10,16 +10,45 @@ MOVE_STEP = 10
 
 class Bot(NodePath):
 
-    def __init__(self, world):
+    def __init__(self, world, interactive=True):
 
         self.world = world
         NodePath.__init__(self, 'Bot')
 
-        self.model = self.world.loader.loadModel("assets/models/bot-arrow.egg")
+        self.model = loadCachedModel(self.world.loader, "assets/models/bot-arrow.egg")
         self.model.reparentTo(self)
-        self.registerKeyboardEvents()
 
-        self.agent = BotAgent(world=self.world, 
+        # only the bot in the main viewport is driven by the keyboard
+        # and owns the agent
+        self._agent = None
+        if interactive:
+            self.registerKeyboardEvents()
+
+    @property
+    def agent(self):
+        """
+        The BotAgent, created on first use: importing the RL stack (SB3,
+        torch) and loading the model is only paid when training or playing
+        """
+        if self._agent is None:
+            self.createAgent()
+        return self._agent
+
+    def hasAgent(self):
+        return self._agent is not None
+
+    def createAgent(self):
+
+        if config.get('numpy_policy', None):
+            # play only, with an exported policy: neither SB3 nor torch are imported
+            from numpy_policy import NumpyPolicy
+            from player import PolicyPlayer
+            self._agent = PolicyPlayer(self.world, agent=NumpyPolicy.load(config['numpy_policy']))
+            return
+
+        from agent import BotAgent
+
+        self._agent = BotAgent(world=self.world, 
                               model_path=config['model_path'], 
                               model_prefix=config['model_prefix'], 
                               best_model=config.get('best_model', None),
@@ -68,15 +97,17 @@ class Bot(NodePath):
         return task.cont
 
 
+    # moves are relative to the parent, which is the scene root of the bot's arena
+
     def moveForward(self, step=MOVE_STEP):
-        quat = self.getQuat(render)
+        quat = self.getQuat()
         fwd = quat.getForward()
-        self.setPos(self.getPos(render) + fwd*step)
+        self.setPos(self.getPos() + fwd*step)
 
     def moveBackward(self, step=MOVE_STEP):
-        quat = self.getQuat(render)
+        quat = self.getQuat()
         fwd = quat.getForward()
-        self.setPos(self.getPos(render) - fwd*step)
+        self.setPos(self.getPos() - fwd*step)
 
     def rotateLeft(self, angle=ROTATE_STEP ):
         heading = self.getH()
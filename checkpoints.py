@@ -0,0 +1,238 @@
+import stable_baselines3
+import torch as th
+import threading
+import zipfile
+import queue
+import json
+import time
+import os
+
+from stable_baselines3.common.callbacks import BaseCallback
+from stable_baselines3.common.save_util import data_to_json
+from stable_baselines3.common.utils import get_system_info
+
+# checkpoints kept by default, besides the best ones
+CHECKPOINT_KEEP_LAST = 5
+CHECKPOINT_KEEP_BEST = 3
+
+# snapshots waiting to be written before save() blocks
+CHECKPOINT_QUEUE_SIZE = 2
+
+def index_path(directory, prefix):
+    return os.path.join(directory, f"{prefix}_checkpoints.json")
+
+def model_file(directory, prefix, name):
+    """
+    Zip file of the model called name in directory; 'best' is the best
+    evaluated checkpoint listed by the index of a CheckpointManager
+    """
+    if name != 'best':
+        return f"{directory}/{name}.zip"
+
+    with open(index_path(directory, prefix), 'r') as f:
+        best = json.load(f)['best']
+    if best is None:
+        raise FileNotFoundError(f"no evaluated checkpoint in {index_path(directory, prefix)}")
+    return best
+
+
+class CheckpointManager:
+    """
+    Saves models as SB3 zip files without stalling training: the model is
+    snapshotted in memory on the calling thread (weights copied to the
+    CPU, the rest serialized), the zip is written by a background thread
+    to a temporary file and renamed into place.
+    Keeps the keep_last newest checkpoints plus the keep_best ones with
+    the highest evaluation reward, listed with their metadata in an index.
+    The index and the saved steps are shared by the training and the
+    writer threads, behind lock.
+    """
+
+    def __init__(self, directory, prefix, keep_last=CHECKPOINT_KEEP_LAST, keep_best=CHECKPOINT_KEEP_BEST):
+
+        self.directory = directory
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        os.makedirs(directory, exist_ok=True)
+
+        self.index_path = index_path(directory, prefix)
+        self.lock = threading.RLock()
+        self.entries = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.entries = json.load(f)['checkpoints']
+        self.saved_steps = { entry['steps'] for entry in self.entries }
+
+        self.writes = queue.Queue(maxsize=CHECKPOINT_QUEUE_SIZE)
+        self.writer = threading.Thread(target=self.write_loop, name='CheckpointWriter', daemon=True)
+        self.writer.start()
+
+    def checkpoint_path(self, steps):
+        return os.path.join(self.directory, f"{self.prefix}_{steps}_steps.zip")
+
+    def snapshot(self, model):
+        """
+        Everything BaseAlgorithm.save writes, detached from the live model
+        """
+        data = model.__dict__.copy()
+        exclude = set(model._excluded_save_params())
+        state_dicts_names, torch_variable_names = model._get_torch_save_params()
+        for name in state_dicts_names + torch_variable_names:
+            exclude.add(name.split(".")[0])
+        for name in exclude:
+            data.pop(name, None)
+
+        pytorch_variables = None
+        if torch_variable_names:
+            pytorch_variables = {}
+            for name in torch_variable_names:
+                value = model
+                for attr in name.split("."):
+                    value = getattr(value, attr)
+                pytorch_variables[name] = value.detach().to('cpu', copy=True)
+
+        params = { name: { k: v.detach().to('cpu', copy=True) for k, v in state.items() }
+                   for name, state in model.get_parameters().items() }
+
+        return data_to_json(data), params, pytorch_variables
+
+    def save(self, model, steps, reward=None, snapshot=None):
+        """
+        Queues a checkpoint of model at steps, optionally with its evaluation reward.
+        snapshot: taken earlier by snapshot(), when model has moved on since steps
+        A checkpoint already saved at the same steps only gets the reward.
+        """
+        entry = { 'path': self.checkpoint_path(steps), 'steps': int(steps),
+                  'reward': None if reward is None else float(reward), 'time': time.time() }
+
+        # a given snapshot is always passed along: the checkpoint of these
+        # steps may be pruned before the writer gets to this entry
+        with self.lock:
+            saved = steps in self.saved_steps
+            self.saved_steps.add(steps)
+        if snapshot is None and not saved:
+            snapshot = self.snapshot(model)
+
+        self.writes.put((entry, snapshot))
+
+    def write_loop(self):
+
+        while True:
+            write = self.writes.get()
+            if write is None:
+                break
+
+            entry, snapshot = write
+            try:
+                if not os.path.exists(entry['path']):
+                    if snapshot is None:
+                        # pruned since, without a snapshot to write it again
+                        print(f"WARNING: checkpoint {entry['path']} was deleted, reward not recorded")
+                        continue
+                    self.write_zip(entry['path'], *snapshot)
+                with self.lock:
+                    self.add_entry(entry)
+                    self.prune()
+                    self.write_index()
+            except Exception as e:
+                print(f"ERROR: cannot write checkpoint {entry['path']}: {e}")
+
+    def write_zip(self, path, serialized_data, params, pytorch_variables):
+        """
+        Same layout as stable_baselines3.common.save_util.save_to_zip_file
+        """
+        tmp_path = f"{path}.tmp"
+        with zipfile.ZipFile(tmp_path, mode="w") as archive:
+            archive.writestr("data", serialized_data)
+            if pytorch_variables is not None:
+                with archive.open("pytorch_variables.pth", mode="w", force_zip64=True) as f:
+                    th.save(pytorch_variables, f)
+            for name, state in params.items():
+                with archive.open(name + ".pth", mode="w", force_zip64=True) as f:
+                    th.save(state, f)
+            archive.writestr("_stable_baselines3_version", stable_baselines3.__version__)
+            archive.writestr("system_info.txt", get_system_info(print_info=False)[1])
+        os.replace(tmp_path, path)
+
+    def add_entry(self, entry):
+
+        for existing in self.entries:
+            if existing['steps'] == entry['steps']:
+                if entry['reward'] is not None:
+                    existing['reward'] = entry['reward']
+                return
+        self.entries.append(entry)
+
+    def prune(self):
+        """
+        Deletes the checkpoints that are neither among the newest nor among the best
+        """
+        newest = sorted(self.entries, key=lambda e: e['steps'], reverse=True)[:self.keep_last]
+        rewarded = [ e for e in self.entries if e['reward'] is not None ]
+        best = sorted(rewarded, key=lambda e: e['reward'], reverse=True)[:self.keep_best]
+        kept = { e['steps'] for e in newest + best }
+
+        for entry in self.entries:
+            if entry['steps'] not in kept:
+                if os.path.exists(entry['path']):
+                    os.remove(entry['path'])
+                self.saved_steps.discard(entry['steps'])
+        self.entries = [ e for e in self.entries if e['steps'] in kept ]
+
+    def write_index(self):
+
+        index = { 'checkpoints': sorted(self.entries, key=lambda e: e['steps']) }
+        best = self.best()
+        index['best'] = best['path'] if best is not None else None
+
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def best(self):
+        """
+        Index entry of the checkpoint with the highest evaluation reward
+        """
+        with self.lock:
+            rewarded = [ e for e in self.entries if e['reward'] is not None ]
+            return max(rewarded, key=lambda e: e['reward']) if rewarded else None
+
+    def close(self):
+        """
+        Waits for the queued checkpoints to be written
+        """
+        self.writes.put(None)
+        self.writer.join()
+
+
+class AsyncCheckpointCallback(BaseCallback):
+    """
+    Saves a checkpoint through a CheckpointManager every save_freq calls
+    """
+
+    def __init__(self, manager, save_freq):
+        self.manager = manager
+        self.save_freq = save_freq
+        super(AsyncCheckpointCallback, self).__init__()
+
+    def _on_step(self) -> bool:
+        if self.n_calls % self.save_freq == 0:
+            self.manager.save(self.model, self.num_timesteps)
+        return True
+
+
+class SaveBestCallback(BaseCallback):
+    """
+    callback_on_new_best of an EvalCallback: checkpoints the model with its evaluation reward
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        super(SaveBestCallback, self).__init__()
+
+    def _on_step(self) -> bool:
+        reward = self.parent.best_mean_reward
+        print(f"new best mean reward {reward:.2f} at {self.num_timesteps} steps")
+        self.manager.save(self.model, self.num_timesteps, reward=reward)
+        return True
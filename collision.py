@@ -0,0 +1,110 @@
+from panda3d.core import CollisionSphere
+
+import math
+
+# side of the cells of the spatial index, about the size of the arena objects
+COLLISION_CELL_SIZE = 2.0
+
+def collisionSpheres(nodepath, root):
+    """
+    Returns the (x, y, z, radius) in root's space of all the CollisionSphere
+    solids of the CollisionNodes found under nodepath
+    """
+    spheres = []
+    for collision_np in nodepath.findAllMatches('**/+CollisionNode'):
+        node = collision_np.node()
+        # collision nodes are expected to be uniformly scaled
+        scale = max(collision_np.getScale(root))
+
+        for i in range(node.getNumSolids()):
+            solid = node.getSolid(i)
+            if isinstance(solid, CollisionSphere):
+                center = root.getRelativePoint(collision_np, solid.getCenter())
+                spheres.append((center.x, center.y, center.z, solid.getRadius() * scale))
+
+    return spheres
+
+
+class MovingCollider:
+    """
+    Collision spheres of an object that moves every step (the bot).
+    Spheres are read once from its CollisionNodes, only their position
+    is updated when queried.
+    """
+
+    def __init__(self, nodepath, root):
+
+        self.root = root
+        self.spheres = []
+        for collision_np in nodepath.findAllMatches('**/+CollisionNode'):
+            node = collision_np.node()
+            scale = max(collision_np.getScale(root))
+
+            for i in range(node.getNumSolids()):
+                solid = node.getSolid(i)
+                if isinstance(solid, CollisionSphere):
+                    self.spheres.append((collision_np, solid.getCenter(), solid.getRadius() * scale))
+
+    def getSpheres(self):
+        """
+        Returns the current (x, y, z, radius) in root's space of the spheres
+        """
+        spheres = []
+        for collision_np, center, radius in self.spheres:
+            center = self.root.getRelativePoint(collision_np, center)
+            spheres.append((center.x, center.y, center.z, radius))
+        return spheres
+
+
+class CollisionIndex:
+    """
+    Uniform grid over the xy plane holding the collision spheres of the
+    objects that stay still during an episode (target, obstacles).
+    A sphere is only tested against the spheres in the cells it overlaps,
+    so the cost of a query doesn't grow with the number of objects.
+    Objects must be refreshed after they are moved.
+    """
+
+    def __init__(self, root, cell_size=COLLISION_CELL_SIZE):
+
+        self.root = root
+        self.cell_size = cell_size
+        self.objects = {}
+        self.cells = {}
+
+    def addObject(self, name, nodepath):
+        self.objects[name] = nodepath
+        self.refresh()
+
+    def removeObject(self, name):
+        del self.objects[name]
+        self.refresh()
+
+    def refresh(self):
+        """
+        Rebuilds the grid from the current positions of the objects
+        """
+        self.cells = {}
+        for name, nodepath in self.objects.items():
+            for x, y, z, r in collisionSpheres(nodepath, self.root):
+                for cell in self.cellsOf(x, y, r):
+                    self.cells.setdefault(cell, []).append((name, x, y, z, r))
+
+    def cellsOf(self, x, y, r):
+        i0 = math.floor((x - r) / self.cell_size)
+        i1 = math.floor((x + r) / self.cell_size)
+        j0 = math.floor((y - r) / self.cell_size)
+        j1 = math.floor((y + r) / self.cell_size)
+        return [ (i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1) ]
+
+    def query(self, x, y, z, r):
+        """
+        Returns the names of the objects with a sphere intersecting the given one.
+        Touching spheres intersect, as for CollisionTraverser.
+        """
+        hits = set()
+        for cell in self.cellsOf(x, y, r):
+            for name, sx, sy, sz, sr in self.cells.get(cell, ()):
+                if (sx - x)**2 + (sy - y)**2 + (sz - z)**2 <= (sr + r)**2:
+                    hits.add(name)
+        return hits
@@ -1,16 +1,40 @@
+
 import yaml
 import argparse
+import os
 
 # fixed constants
 MAX_GRAPH_NODES = 1000
 
+# worker processes don't get the command line of the main process,
+# the configuration file is handed over through this environment variable
+CONFIG_ENV_VAR = 'RL_ROBOT_TARGET_CONFIG'
+
 parser = argparse.ArgumentParser()
-parser.add_argument( '-c', '--config', type=str, default='config.cfg', help='configuration file')
-args = parser.parse_args()
+parser.add_argument( '-c', '--config', type=str, default=os.environ.get(CONFIG_ENV_VAR, 'config.cfg'), help='configuration file')
+parser.add_argument( '--headless', action='store_true', help='run without a window, overrides the configuration file')
+# unknown arguments are left to whoever imported this module (e.g. multiprocessing workers)
+args, _ = parser.parse_known_args()
+
+config = {}
+
+def load_config(path):
+    """
+    Loads the configuration file in place, so that the modules that
+    already imported config see the new values
+    """
+    with open(path, 'r') as f:
+        values = yaml.safe_load(f)
+
+    config.clear()
+    config.update(values)
+    os.environ[CONFIG_ENV_VAR] = os.path.abspath(path)
 
 # takes all the config from .cfg file except input data
-config = yaml.safe_load(open(args.config, 'r'))
+load_config(args.config)
+if args.headless:
+    config['headless'] = True
 
 def debug(message):
     if config["debug"]:
-        print(message)
\ No newline at end of file
+        print(message)
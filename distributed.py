@@ -0,0 +1,809 @@
+import multiprocessing as mp
+import numpy as np
+import threading
+import argparse
+import socket
+import struct
+import queue
+import json
+import time
+import os
+
+from multiprocessing import shared_memory
+
+from config import *
+
+# seconds to wait for an actor to shut down before killing it
+ACTOR_JOIN_TIMEOUT = 10
+
+# seconds between weight polls while an actor waits for its first policy
+ACTOR_WAIT_INTERVAL = 0.1
+
+# seconds the learner waits for a trajectory batch before giving up
+BATCH_TIMEOUT = 600
+
+# seconds an actor waits for the learner to finish writing the weights
+WEIGHTS_READ_TIMEOUT = 30
+
+# owner of a shared memory batch slot that was handed to the learner
+SLOT_FILLED = -1
+
+DEFAULT_ADDRESS = '127.0.0.1:7070'
+
+# arrays of a trajectory batch: (n_steps, n_envs, ...) plus the observation
+# and done flags following the last step, to bootstrap the returns
+def batch_specs(observation_shape, n_steps, n_envs):
+    return [ ('obs', np.uint8, (n_steps, n_envs) + tuple(observation_shape)),
+             ('actions', np.int64, (n_steps, n_envs)),
+             ('rewards', np.float32, (n_steps, n_envs)),
+             ('episode_starts', np.float32, (n_steps, n_envs)),
+             ('log_probs', np.float32, (n_steps, n_envs)),
+             ('last_obs', np.uint8, (n_envs,) + tuple(observation_shape)),
+             ('last_dones', np.float32, (n_envs,)) ]
+
+def spec_shapes(specs):
+    """
+    { name: [ dtype, shape ] } of array specs, comparable after a JSON round trip
+    """
+    return { name: [ np.dtype(dtype).str, list(shape) ] for name, dtype, shape in specs }
+
+
+class ArrayLayout:
+    """
+    Named arrays packed one after the other in a flat buffer, 8 bytes aligned
+    """
+
+    def __init__(self, specs):
+
+        self.specs = [ (name, np.dtype(dtype), tuple(shape)) for name, dtype, shape in specs ]
+        self.offsets = []
+        offset = 0
+        for name, dtype, shape in self.specs:
+            self.offsets.append(offset)
+            nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+            offset += (nbytes + 7) // 8 * 8
+        self.nbytes = offset
+
+    @classmethod
+    def of(cls, arrays):
+        return cls([ (name, array.dtype, array.shape) for name, array in arrays.items() ])
+
+    def views(self, buffer, offset=0):
+        return { name: np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset + start)
+                 for (name, dtype, shape), start in zip(self.specs, self.offsets) }
+
+
+class SharedWeights:
+    """
+    Policy weights in shared memory, behind a sequence counter: odd while
+    the learner writes, 2 * version once written. Readers retry when the
+    counter changed during their copy.
+    """
+
+    def __init__(self, layout, name=None):
+
+        self.layout = layout
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=8 + layout.nbytes)
+        self.name = self.shm.name
+        self.sequence = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf)
+        self.arrays = layout.views(self.shm.buf, offset=8)
+
+    def write(self, version, arrays):
+        self.sequence[0] = 2 * version - 1
+        for name, array in arrays.items():
+            self.arrays[name][...] = array
+        self.sequence[0] = 2 * version
+
+    def read(self, current_version, timeout=WEIGHTS_READ_TIMEOUT):
+        """
+        (version, arrays) if newer than current_version, None otherwise.
+        Raises when a write doesn't complete within timeout seconds,
+        e.g. the learner died while writing.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            sequence = int(self.sequence[0])
+            if sequence % 2:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"weights version {(sequence + 1) // 2} still being written after {timeout} s")
+                time.sleep(0)
+                continue
+            if sequence // 2 <= current_version:
+                return None
+            arrays = { name: array.copy() for name, array in self.arrays.items() }
+            if int(self.sequence[0]) == sequence:
+                return sequence // 2, arrays
+
+    def close(self, unlink=False):
+        self.arrays = None
+        self.sequence = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class SharedMemoryTransport:
+    """
+    Learner side of the same host transport. Weights are published into
+    SharedWeights, actors write trajectory batches into a ring of shared
+    memory slots and only pass slot numbers through queues.
+    Actors are given address() when started, see actor_main.
+    The slot an actor is writing is marked with its id, so that
+    reclaim() can free it when the actor dies.
+    """
+
+    def __init__(self, weights_layout, batch_layout, n_slots, context):
+
+        self.weights = SharedWeights(weights_layout)
+        self.batch_layout = batch_layout
+        self.slots = [ shared_memory.SharedMemory(create=True, size=batch_layout.nbytes) for _ in range(n_slots) ]
+        self.slot_arrays = [ batch_layout.views(slot.buf) for slot in self.slots ]
+
+        self.free = context.Queue()
+        self.filled = context.Queue()
+        self.stop_event = context.Event()
+        # actor_id + 1 while an actor writes a slot, 0 when free, SLOT_FILLED once sent
+        self.owners = context.RawArray('q', n_slots)
+        for i in range(n_slots):
+            self.free.put(i)
+
+    def address(self):
+        return ('shm', { 'weights': self.weights.name, 'weights_layout': self.weights.layout.specs,
+                         'slots': [ slot.name for slot in self.slots ], 'batch_layout': self.batch_layout.specs,
+                         'free': self.free, 'filled': self.filled, 'stop': self.stop_event, 'owners': self.owners })
+
+    def publish_weights(self, version, arrays):
+        self.weights.write(version, arrays)
+
+    def receive_batch(self, timeout=None):
+        """
+        (arrays, meta, token) of the next batch, None on timeout.
+        The arrays live in the slot until release(token).
+        """
+        try:
+            slot, meta = self.filled.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self.owners[slot] = 0
+        return self.slot_arrays[slot], meta, slot
+
+    def release(self, token):
+        self.free.put(token)
+
+    def reclaim(self, actor_id):
+        """
+        Frees the slot an actor that exited was writing, if any
+        """
+        for slot, owner in enumerate(self.owners):
+            if owner == actor_id + 1:
+                self.owners[slot] = 0
+                self.free.put(slot)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def close(self):
+        self.slot_arrays = None
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
+        self.weights.close(unlink=True)
+
+
+class SharedMemoryClient:
+    """
+    Actor side of SharedMemoryTransport
+    """
+
+    def __init__(self, address, actor_id):
+
+        self.weights = SharedWeights(ArrayLayout(address['weights_layout']), name=address['weights'])
+        batch_layout = ArrayLayout(address['batch_layout'])
+        self.slots = [ shared_memory.SharedMemory(name=name) for name in address['slots'] ]
+        self.slot_arrays = [ batch_layout.views(slot.buf) for slot in self.slots ]
+
+        self.free = address['free']
+        self.filled = address['filled']
+        self.stop_event = address['stop']
+        self.owners = address['owners']
+        self.actor_id = actor_id
+
+    def poll_weights(self, current_version):
+        return self.weights.read(current_version)
+
+    def send_batch(self, arrays, meta):
+
+        # waits for the learner to consume a slot
+        while not self.stopped():
+            try:
+                slot = self.free.get(timeout=1.0)
+                break
+            except queue.Empty:
+                pass
+        else:
+            return
+
+        self.owners[slot] = self.actor_id + 1
+        for name, array in arrays.items():
+            self.slot_arrays[slot][name][...] = array
+        # marked before it is queued, a reclaimed slot can't be handed out twice
+        self.owners[slot] = SLOT_FILLED
+        self.filled.put((slot, meta))
+
+    def stopped(self):
+        return self.stop_event.is_set()
+
+    def close(self):
+        self.slot_arrays = None
+        for slot in self.slots:
+            slot.close()
+        self.weights.close()
+
+
+def send_message(sock, kind, arrays=None, meta=None):
+    """
+    A JSON header describing the message and its arrays, followed by the raw array bytes
+    """
+    arrays = { name: np.ascontiguousarray(array) for name, array in (arrays or {}).items() }
+    header = json.dumps({ 'kind': kind, 'meta': meta or {},
+                          'arrays': [ (name, array.dtype.str, array.shape) for name, array in arrays.items() ] }).encode()
+
+    sock.sendall(struct.pack('!I', len(header)) + header)
+    for array in arrays.values():
+        # raw bytes without a copy
+        sock.sendall(array.reshape(-1).view(np.uint8))
+
+def recv_exactly(sock, n):
+
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("connection closed")
+        received += count
+    return buffer
+
+def recv_message(sock):
+    """
+    (kind, arrays, meta) of the next message sent by send_message
+    """
+    length, = struct.unpack('!I', recv_exactly(sock, 4))
+    header = json.loads(recv_exactly(sock, length))
+
+    arrays = {}
+    for name, dtype, shape in header['arrays']:
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        arrays[name] = np.frombuffer(recv_exactly(sock, nbytes), dtype=dtype).reshape(shape)
+    return header['kind'], arrays, header['meta']
+
+
+class TcpTransport:
+    """
+    Learner side of the transport across hosts: actors connect to a TCP
+    server, pull the latest weights and push trajectory batches, each
+    connection served by its own thread. Actors whose batches don't have
+    the shapes of batch_layout are turned away.
+    """
+
+    def __init__(self, host, port, batch_layout, max_pending=4):
+
+        self.batch_shapes = spec_shapes(batch_layout.specs)
+        self.server = socket.create_server((host, port))
+        self.host, self.port = host, self.server.getsockname()[1]
+
+        self.lock = threading.Lock()
+        self.version = 0
+        self.arrays = None
+        self.stopping = False
+
+        # bounded: actors block on their sends when the learner falls behind
+        self.batches = queue.Queue(maxsize=max_pending)
+
+        self.thread = threading.Thread(target=self.accept_loop, name='TcpTransport', daemon=True)
+        self.thread.start()
+
+    def address(self):
+        host = '127.0.0.1' if self.host in ('', '0.0.0.0') else self.host
+        return ('tcp', (host, self.port))
+
+    def accept_loop(self):
+
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+
+        try:
+            while True:
+                kind, arrays, meta = recv_message(conn)
+
+                if kind == 'hello':
+                    error = self.check_shapes(meta['batch_specs'])
+                    if error is not None:
+                        print(f"rejected actor {meta.get('actor_id')}: {error}")
+                        send_message(conn, 'error', meta={ 'message': error })
+                        break
+                    send_message(conn, 'welcome')
+                elif kind == 'get_weights':
+                    with self.lock:
+                        version, weights, stopping = self.version, self.arrays, self.stopping
+                    if stopping:
+                        send_message(conn, 'stop')
+                    elif weights is not None and version > meta['version']:
+                        send_message(conn, 'weights', weights, { 'version': version })
+                    else:
+                        send_message(conn, 'no_weights')
+                elif kind == 'batch':
+                    error = self.check_shapes(spec_shapes((name, array.dtype, array.shape)
+                                                          for name, array in arrays.items()))
+                    if error is not None:
+                        print(f"rejected a batch of actor {meta.get('actor_id')}: {error}")
+                        break
+                    while not self.stopping:
+                        try:
+                            self.batches.put((arrays, meta, None), timeout=1.0)
+                            break
+                        except queue.Full:
+                            pass
+                else:
+                    raise ValueError(f"unexpected message `{kind}`")
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def check_shapes(self, shapes):
+        """
+        Why batches of these shapes can't fill the rollout buffer, None if they can
+        """
+        if shapes == self.batch_shapes:
+            return None
+        return (f"batches {shapes} instead of {self.batch_shapes}, "
+                f"the actor needs the learner's n_arenas, actor_n_steps and observation settings")
+
+    def publish_weights(self, version, arrays):
+        with self.lock:
+            self.version, self.arrays = version, arrays
+
+    def receive_batch(self, timeout=None):
+        try:
+            return self.batches.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def release(self, token):
+        pass
+
+    def reclaim(self, actor_id):
+        pass
+
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+
+    def close(self):
+        self.server.close()
+
+
+class TcpClient:
+    """
+    Actor side of TcpTransport, batch_specs being the batches it will send
+    """
+
+    def __init__(self, address, batch_specs, actor_id=None):
+        self.sock = socket.create_connection(tuple(address))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stopping = False
+
+        send_message(self.sock, 'hello', meta={ 'actor_id': actor_id, 'batch_specs': spec_shapes(batch_specs) })
+        kind, _, meta = recv_message(self.sock)
+        if kind == 'error':
+            self.sock.close()
+            raise RuntimeError(f"rejected by the learner: {meta['message']}")
+
+    def poll_weights(self, current_version):
+
+        send_message(self.sock, 'get_weights', meta={ 'version': current_version })
+        kind, arrays, meta = recv_message(self.sock)
+        if kind == 'stop':
+            self.stopping = True
+        if kind != 'weights':
+            return None
+        return meta['version'], arrays
+
+    def send_batch(self, arrays, meta):
+        send_message(self.sock, 'batch', arrays, meta)
+
+    def stopped(self):
+        return self.stopping
+
+    def close(self):
+        self.sock.close()
+
+def connect(address, batch_specs, actor_id=None):
+    """
+    Actor side of the transport address returned by the learner's transport
+    """
+    kind, data = address
+    if kind == 'shm':
+        return SharedMemoryClient(data, actor_id)
+    return TcpClient(data, batch_specs, actor_id)
+
+
+def actor_main(address, actor_id, config_path, seed=None):
+    """
+    Entry point of an actor process: collects trajectories on its own
+    headless RobotTargetWorld with the latest NumPy policy published by
+    the learner. Neither SB3 nor torch are imported here.
+    """
+    load_config(config_path)
+
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData("", "audio-library-name null")
+
+    from world import RobotTargetWorld
+    from vecenv import ArenaVecEnv
+    from numpy_policy import NumpyPolicy, choose_actions
+
+    world = RobotTargetWorld(headless=True)
+    env = ArenaVecEnv(world)
+    # the environments of all the actors draw from distinct streams
+    env.seed(None if seed is None else seed * env.num_envs)
+
+    n_steps = config.get('actor_n_steps', 128)
+    specs = batch_specs(env.observation_space.shape, n_steps, env.num_envs)
+    arrays = { name: np.zeros(shape, dtype=dtype) for name, dtype, shape in specs }
+    client = connect(address, specs, actor_id)
+    rng = np.random.default_rng(seed)
+
+    policy, gamma, version = None, None, 0
+    obs = env.reset()
+    episode_starts = np.ones(env.num_envs, dtype=np.float32)
+    episode_returns = np.zeros(env.num_envs)
+
+    while not client.stopped():
+
+        update = client.poll_weights(version)
+        if update is not None:
+            version, weights = update
+            policy = NumpyPolicy(weights)
+            gamma = float(weights['gamma'])
+        if policy is None:
+            time.sleep(ACTOR_WAIT_INTERVAL)
+            continue
+
+        finished = []
+        for t in range(n_steps):
+            logits, _ = policy.forward(obs)
+            actions = choose_actions(logits, False, rng)
+            shifted = logits - logits.max(axis=1, keepdims=True)
+            log_probs = shifted - np.log(np.exp(shifted).sum(axis=1, keepdims=True))
+
+            arrays['obs'][t] = obs
+            arrays['actions'][t] = actions
+            arrays['episode_starts'][t] = episode_starts
+            arrays['log_probs'][t] = log_probs[np.arange(len(actions)), actions]
+
+            obs, rewards, dones, infos = env.step(actions)
+            episode_returns += rewards
+            for i in np.flatnonzero(dones):
+                finished.append(float(episode_returns[i]))
+                episode_returns[i] = 0
+                if infos[i].get("TimeLimit.truncated", False):
+                    # bootstrap with the value of the terminal observation, as SB3 does
+                    _, value = policy.forward(infos[i]["terminal_observation"][None])
+                    rewards[i] += gamma * value[0, 0]
+
+            arrays['rewards'][t] = rewards
+            episode_starts = dones.astype(np.float32)
+
+        arrays['last_obs'][...] = obs
+        arrays['last_dones'][...] = episode_starts
+
+        client.send_batch(arrays, { 'actor_id': actor_id, 'policy_version': version,
+                                    'episode_returns': finished })
+
+    env.close()
+    client.close()
+
+
+class LocalActors:
+    """
+    The actor processes started by the learner, restarted when they exit
+    before the learner stops them. The batch slot an exited actor held goes
+    back to the transport.
+    """
+
+    def __init__(self, transport, n_actors, config_path, context):
+
+        self.transport = transport
+        self.address = transport.address()
+        self.n_actors = n_actors
+        self.config_path = config_path
+        self.context = context
+
+        self.processes = [ None ] * n_actors
+        self.restarts = [ 0 ] * n_actors
+        for actor_id in range(n_actors):
+            self.start(actor_id)
+
+    def start(self, actor_id):
+
+        # a restarted actor doesn't replay the episodes of its previous seed
+        seed = actor_id + self.n_actors * self.restarts[actor_id]
+        process = self.context.Process(target=actor_main, args=(self.address, actor_id, self.config_path, seed),
+                                       daemon=True)
+        process.start()
+        self.processes[actor_id] = process
+
+    def restart_exited(self):
+
+        for actor_id, process in enumerate(self.processes):
+            if not process.is_alive():
+                print(f"actor {actor_id} exited with code {process.exitcode}, restarting")
+                process.join()
+                self.transport.reclaim(actor_id)
+                self.restarts[actor_id] += 1
+                self.start(actor_id)
+
+    def close(self):
+
+        for process in self.processes:
+            process.join(ACTOR_JOIN_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+
+
+class Learner:
+    """
+    PPO updates from the trajectory batches of any number of actors:
+    batches_per_update batches fill the rollout buffer side by side, the
+    values are recomputed with the current policy (the log probabilities
+    are the behaviour policy's) and PPO's train() runs on them. Every
+    update publishes a new weights version. Batches collected with a
+    policy more than max_staleness versions old are dropped.
+    Local actors that exit are restarted; without any batch for
+    batch_timeout seconds the learner gives up.
+    """
+
+    def __init__(self, model, transport, n_envs_per_batch, batches_per_update, max_staleness, checkpoints=None,
+                 actors=None, batch_timeout=BATCH_TIMEOUT):
+
+        self.model = model
+        self.transport = transport
+        self.n_envs_per_batch = n_envs_per_batch
+        self.batches_per_update = batches_per_update
+        self.max_staleness = max_staleness
+        self.checkpoints = checkpoints
+        self.actors = actors
+        self.batch_timeout = batch_timeout
+
+        self.version = 0
+        self.dropped = 0
+        self.staleness = []
+        self.episode_returns = []
+
+    def publish(self):
+
+        from numpy_policy import policy_arrays
+
+        self.version += 1
+        arrays = policy_arrays(self.model.policy)
+        arrays['gamma'] = np.array(self.model.gamma)
+        self.transport.publish_weights(self.version, arrays)
+
+    def gather(self):
+        """
+        The next batches_per_update batches recent enough
+        """
+        batches = []
+        last_batch = time.monotonic()
+        while len(batches) < self.batches_per_update:
+            if self.actors is not None:
+                self.actors.restart_exited()
+
+            batch = self.transport.receive_batch(timeout=1.0)
+            if batch is None:
+                if time.monotonic() - last_batch > self.batch_timeout:
+                    for arrays, meta, token in batches:
+                        self.transport.release(token)
+                    raise RuntimeError(f"no trajectory batch received for {self.batch_timeout} s, "
+                                       f"no actor is running or connected")
+                continue
+            last_batch = time.monotonic()
+
+            arrays, meta, token = batch
+            staleness = self.version - meta['policy_version']
+            if staleness > self.max_staleness:
+                self.dropped += 1
+                self.transport.release(token)
+                continue
+
+            self.staleness.append(staleness)
+            self.episode_returns += meta['episode_returns']
+            batches.append(batch)
+        return batches
+
+    def fill_rollout_buffer(self, batches):
+
+        import torch as th
+        from stable_baselines3.common.utils import obs_as_tensor
+
+        model = self.model
+        buffer = model.rollout_buffer
+        buffer.reset()
+
+        n = self.n_envs_per_batch
+        last_obs = np.zeros((buffer.n_envs,) + model.observation_space.shape, dtype=model.observation_space.dtype)
+        last_dones = np.zeros(buffer.n_envs, dtype=np.float32)
+
+        for j, (arrays, meta, token) in enumerate(batches):
+            envs = slice(j * n, (j + 1) * n)
+            buffer.observations[:, envs] = self.policy_layout(arrays['obs'])
+            buffer.actions[:, envs, 0] = arrays['actions']
+            buffer.rewards[:, envs] = arrays['rewards']
+            buffer.episode_starts[:, envs] = arrays['episode_starts']
+            buffer.log_probs[:, envs] = arrays['log_probs']
+            last_obs[envs] = self.policy_layout(arrays['last_obs'])
+            last_dones[envs] = arrays['last_dones']
+            self.transport.release(token)
+
+        with th.no_grad():
+            for t in range(buffer.buffer_size):
+                values = model.policy.predict_values(obs_as_tensor(buffer.observations[t], model.device))
+                buffer.values[t] = values.cpu().numpy().flatten()
+            last_values = model.policy.predict_values(obs_as_tensor(last_obs, model.device))
+
+        buffer.pos = buffer.buffer_size
+        buffer.full = True
+        buffer.compute_returns_and_advantage(last_values=last_values, dones=last_dones)
+        model.num_timesteps += buffer.buffer_size * buffer.n_envs
+
+    def policy_layout(self, obs):
+        """
+        Observations as the policy reads them, channels first when SB3 transposed the images
+        """
+        if obs.shape[-3:] == self.model.observation_space.shape:
+            return obs
+        return np.moveaxis(obs, -1, -3)
+
+    def learn(self, total_timesteps):
+
+        model = self.model
+        save_freq = config.get('checkpoint_save_freq', 10000)
+        next_checkpoint = model.num_timesteps + save_freq
+
+        self.publish()
+        while model.num_timesteps < total_timesteps:
+
+            self.fill_rollout_buffer(self.gather())
+            model._update_current_progress_remaining(model.num_timesteps, total_timesteps)
+            model.train()
+            self.publish()
+
+            model.logger.record("distributed/policy_version", self.version)
+            model.logger.record("distributed/staleness_mean", float(np.mean(self.staleness)))
+            model.logger.record("distributed/staleness_max", int(np.max(self.staleness)))
+            model.logger.record("distributed/dropped_batches", self.dropped)
+            if self.episode_returns:
+                model.logger.record("rollout/ep_rew_mean", float(np.mean(self.episode_returns)))
+            model.logger.record("time/total_timesteps", model.num_timesteps)
+            model.logger.dump(step=model.num_timesteps)
+            self.staleness, self.episode_returns = [], []
+
+            if self.checkpoints is not None and model.num_timesteps >= next_checkpoint:
+                self.checkpoints.save(model, model.num_timesteps)
+                next_checkpoint += save_freq
+
+        self.transport.stop()
+
+
+def make_model(observation_space, action_space, n_envs, n_steps):
+    """
+    PPO without an environment, the actors collect the trajectories; its
+    rollout buffer holds n_envs environments of n_steps steps. The
+    configured best_model if any.
+    """
+    from stable_baselines3 import PPO
+    from stable_baselines3.common.logger import configure
+    from stable_baselines3.common.preprocessing import is_image_space, is_image_space_channels_first
+    from stable_baselines3.common.vec_env import VecTransposeImage
+
+    learning_rate = config.get('initial_learning_rate', 0.0003)
+
+    if config.get('best_model', None):
+        from checkpoints import model_file
+        model_fname = model_file(f"{config['model_path']}/{config['model_prefix']}", config['model_prefix'], config['best_model'])
+        print(f"loading agent: {model_fname}")
+        # the saved spaces are kept, the buffer is sized for the actors' batches
+        model = PPO.load(model_fname, n_envs=n_envs, n_steps=n_steps, learning_rate=learning_rate)
+    else:
+        print("creating new agent")
+        # what SB3 does to the spaces of an environment it is given
+        if is_image_space(observation_space) and not is_image_space_channels_first(observation_space):
+            observation_space = VecTransposeImage.transpose_space(observation_space)
+        model = PPO("CnnPolicy", None, n_steps=n_steps, learning_rate=learning_rate, verbose=1,
+                    _init_setup_model=False)
+        model.observation_space, model.action_space, model.n_envs = observation_space, action_space, n_envs
+        model._setup_model()
+
+    model.set_logger(configure(config.get('log_path', './logs'), [ "stdout", "csv" ]))
+    return model
+
+def run_learner(transport_kind, listen, n_actors, total_timesteps, config_path=None):
+    """
+    Trains with n_actors local actor processes, plus any remote actor
+    connecting to listen with the tcp transport
+    """
+    import gym
+    from observation import observation_spec
+    from checkpoints import CheckpointManager
+
+    if config_path is None:
+        config_path = os.environ[CONFIG_ENV_VAR]
+
+    n_steps = config.get('actor_n_steps', 128)
+    n_envs_per_batch = config.get('n_arenas', 1)
+    batches_per_update = config.get('batches_per_update', 4)
+
+    observation_space = observation_spec().observation_space()
+    action_space = gym.spaces.Discrete(3)
+    model = make_model(observation_space, action_space, n_envs_per_batch * batches_per_update, n_steps)
+
+    context = mp.get_context("spawn")
+    if transport_kind == 'shm':
+        from numpy_policy import policy_arrays
+        weights = policy_arrays(model.policy)
+        weights['gamma'] = np.array(model.gamma)
+        transport = SharedMemoryTransport(ArrayLayout.of(weights),
+                                          ArrayLayout(batch_specs(observation_space.shape, n_steps, n_envs_per_batch)),
+                                          n_slots=batches_per_update + n_actors, context=context)
+    else:
+        host, port = listen.rsplit(':', 1)
+        transport = TcpTransport(host, int(port), ArrayLayout(batch_specs(observation_space.shape, n_steps, n_envs_per_batch)),
+                                 max_pending=batches_per_update)
+        print(f"learner listening on {transport.host}:{transport.port}")
+
+    actors = LocalActors(transport, n_actors, config_path, context)
+
+    checkpoints = CheckpointManager(f"{config['model_path']}/{config['model_prefix']}", config['model_prefix'],
+                                    keep_last=config.get('checkpoint_keep_last', 5),
+                                    keep_best=config.get('checkpoint_keep_best', 3))
+    learner = Learner(model, transport, n_envs_per_batch, batches_per_update,
+                      config.get('max_policy_staleness', 2), checkpoints,
+                      actors=actors, batch_timeout=config.get('actor_batch_timeout', BATCH_TIMEOUT))
+    try:
+        learner.learn(total_timesteps)
+    finally:
+        transport.stop()
+        actors.close()
+        transport.close()
+        checkpoints.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="distributed training: a PPO learner fed by actor processes")
+    parser.add_argument('role', choices=[ 'learner', 'actor' ])
+    parser.add_argument('--transport', choices=[ 'shm', 'tcp' ], default=config.get('distributed_transport', 'shm'),
+                        help='shm: actors on this host only, tcp: actors may connect from other hosts')
+    parser.add_argument('--address', type=str, default=config.get('distributed_address', DEFAULT_ADDRESS),
+                        help='host:port the learner listens on, or an actor connects to')
+    parser.add_argument('--actors', type=int, default=config.get('n_actors', 2), help='actor processes started by the learner')
+    parser.add_argument('--timesteps', type=int, default=config['n_episodes'] * config['n_max_steps_per_episode'])
+    parser.add_argument('--id', type=int, default=0, help='actor id, for remote actors')
+    args, _ = parser.parse_known_args()
+
+    if args.role == 'learner':
+        run_learner(args.transport, args.address, args.actors, args.timesteps)
+    else:
+        host, port = args.address.rsplit(':', 1)
+        actor_main(('tcp', (host, int(port))), args.id, os.environ[CONFIG_ENV_VAR], seed=args.id)
@@ -1,7 +1,8 @@
 import gym
 import numpy as np
-import random
 
+from observation import *
+from profiling import profiler
 from config import *
 
 ACTION_FORWARD = 0
@@ -22,23 +23,95 @@ REWARD_TARGET_REACHED = 1000.0
 # terminate when bot-target distance is lower than this threshold
 COLLISION_THRESHOLD = 1
 
+# radius of the bot and target collision spheres, episodes end when they touch
+BOT_COLLISION_RADIUS = 0.5
+TARGET_COLLISION_RADIUS = 0.5
+
+# bots and targets are placed on the (-ARENA_SIZE, ARENA_SIZE) plane
+ARENA_SIZE = 10.0
+
+# compact snapshot of an arena, see BotWorldEnv.save_state; headings are in
+# degrees like NodePath.getH(), float32 like Panda3D transforms so that a
+# restored state is exactly the saved one
+STATE_DTYPE = np.dtype([ ('bot_pos', np.float32, (2,)),
+                         ('bot_heading', np.float32),
+                         ('target_pos', np.float32, (2,)),
+                         ('episode_steps', np.int64) ])
+
+def random_states(rng, n):
+    """
+    n start states, positions drawn like BotWorldEnv.reset_positions and
+    headings on the grid of the bot rotations, e.g. for an evaluation suite
+    """
+    states = np.zeros(n, dtype=STATE_DTYPE)
+    states['bot_pos'] = rng.uniform(-ARENA_SIZE, ARENA_SIZE, size=(n, 2))
+    states['bot_heading'] = rng.integers(0, 360 // AGENT_ROTATE_STEP, size=n) * AGENT_ROTATE_STEP
+    states['target_pos'] = rng.uniform(-ARENA_SIZE, ARENA_SIZE, size=(n, 2))
+    return states
+
 class BotWorldEnv(gym.Env):
+    """
+    Single bot/target environment. world is either the RobotTargetWorld,
+    which exposes its main arena, or one of its Arena instances.
+    """
 
     metadata = {'render.modes': ['infoframe'] }
 
-    def __init__(self, world):
+    def __init__(self, world, action_repeat=None, seed=None):
         self.world = world
+        # the arena itself, for the state snapshots
+        self.arena = world.arenas[0] if hasattr(world, 'arenas') else world
+
+        # start positions are drawn from this environment's own stream
+        self.rng = np.random.default_rng(seed)
+        self.episode_steps = 0
+
+        # number of sub-steps each agent decision is repeated for
+        if action_repeat is None:
+            action_repeat = config.get('action_repeat', 1)
+        self.action_repeat = action_repeat
+
+        # camera frames are preprocessed by the arena, stacked here
+        self.spec = observation_spec()
+        self.observation_space = self.spec.observation_space()
+
+        self.frames = None
+        if self.spec.frame_stack > 1:
+            self.frames = FrameStack(self.spec)
+            self.obsRing = np.zeros((config.get('obs_ring_size', 4),) + self.spec.shape, dtype=np.uint8)
+            self.obsRingIndex = 0
+        # the next observation starts an episode
+        self.new_episode = True
 
-        self.observation_space = gym.spaces.Box(
-            low=0, high=255, shape=(60, 80, 3), dtype=np.uint8)
+        # None unless this is the arena shown with a HUD
+        self.hud = self.world.hud
 
         self.action_space = gym.spaces.Discrete(3)
+
+        if config.get('profiling', False):
+            profiler.instrument_env(self)
     
-    def get_obs(self):
+    def get_obs(self, out=None):
+        """
+        Returns the current bot camera view, written into out when given.
+        Without out the observation is a slot of an observation ring,
+        valid for obs_ring_size steps.
+        """
+        if self.frames is None:
+            obs = self.world.getBotCameraBuffer(out)
+        else:
+            self.world.getBotCameraBuffer(out=self.frames.next_slot())
+            if self.new_episode:
+                self.frames.fill()
 
-        obs = self.world.getBotCameraBuffer().copy()
+            if out is None:
+                out = self.obsRing[self.obsRingIndex]
+                self.obsRingIndex = (self.obsRingIndex + 1) % len(self.obsRing)
+            np.copyto(out, self.frames.frames)
+            obs = out
+        self.new_episode = False
 
-        if not self.observation_space.contains(obs):
+        if config.get('debug_obs_check', False) and not self.observation_space.contains(obs):
             # should never happen
             print(obs)
             raise ValueError("Observation is not within the observation space bounds.")
@@ -48,37 +121,108 @@ class BotWorldEnv(gym.Env):
 
     def reset(self, reset_positions = True):
 
+        # reset_positions restarts the frame stack too
         if reset_positions:
-            bot_x = random.uniform(-10.0, 10.0)
-            bot_y = random.uniform(-10.0, 10.0)
-            self.world.bot.setPos(bot_x, bot_y, 0.0)
+            self.reset_positions()
+        else:
+            self.reset_frames()
 
-            tgt_x = random.uniform(-10.0, 10.0)
-            tgt_y = random.uniform(-10.0, 10.0)
-            self.world.target.setPos(tgt_x, tgt_y, 0.0)
+        base.stepFrame(sync=True)
 
         return self.get_obs()
+
+    def reset_positions(self):
+
+        bot_x, bot_y, tgt_x, tgt_y = self.rng.uniform(-ARENA_SIZE, ARENA_SIZE, size=4)
+        self.world.bot.setPos(bot_x, bot_y, 0.0)
+        self.world.target.setPos(tgt_x, tgt_y, 0.0)
+        self.world.refreshCollisions()
+        self.episode_steps = 0
+        self.reset_frames()
+
+    def seed(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+        return [ seed ]
+
+    def save_state(self, out=None):
+        """
+        Snapshot of the bot pose, the target position and the steps into
+        the episode, as a STATE_DTYPE record (written into out when given).
+        The frame stack is not part of it.
+        """
+        state = self.arena.saveState(out)
+        state['episode_steps'] = self.episode_steps
+        return state
+
+    def restore_state(self, state, render=True):
+        """
+        Puts the arena back in a saved state. Cheaper than reset: nothing is
+        drawn and the collision index is only refreshed if the target moved.
+        The frame stack restarts from the restored view. Returns the
+        observation, or None with render=False, for callers that render
+        several arenas at once (see ArenaVecEnv.reset_to).
+        """
+        self.arena.restoreState(state)
+        self.episode_steps = int(state['episode_steps'])
+        self.reset_frames()
+
+        if not render:
+            return None
+
+        base.stepFrame(sync=True)
+        return self.get_obs()
+
+    def reset_frames(self):
+        """
+        The frame stack restarts from the next observation
+        """
+        self.new_episode = True
     
     def valid_move(self, pos):
-        return pos.x >= -10 and pos.x <= 10 and \
-               pos.y >= -10 and pos.y <= 10
+        return pos.x >= -ARENA_SIZE and pos.x <= ARENA_SIZE and \
+               pos.y >= -ARENA_SIZE and pos.y <= ARENA_SIZE
 
     def step(self, action):
 
         # print(f"env.step: action={action}")
-        base.graphicsEngine.renderFrame()
+        reward, done = self.repeat_action(action)
+
+        # render only once the observation is actually needed
+        base.stepFrame()
+
+        info = {}
+        obs = self.get_obs()
+        
+        return obs, reward, done, info
 
-        #debug
-        old_obs = self.get_obs()
-        old_dist = self.world.getBotTargetDistance()
-        old_angle = self.world.getBotTargetAngle()
-        #~debug
+    def repeat_action(self, action):
+        """
+        Applies action for action_repeat sub-steps, without rendering.
+        Returns the sum of the sub-step rewards, stopping early when the episode ends.
+        """
+        reward = 0
+        self.episode_steps += 1
+        for _ in range(self.action_repeat):
+            sub_reward, done = self.apply_action(action)
+            reward += sub_reward
+            if done:
+                break
+
+        if self.hud is not None:
+            self.hud.publish('reward', reward)
+
+        return reward, done
+
+    def apply_action(self, action):
+        """
+        Moves the bot according to action, without rendering.
+        Returns the reward and whether the bot reached the target.
+        """
 
         valid_action = True
 
         if action == ACTION_FORWARD:
             
-            old_pos = self.world.bot.getPos( )
             old_dst = self.world.getBotTargetDistance()
             
             self.world.bot.moveForward(step=AGENT_MOVE_STEP)
@@ -94,17 +238,11 @@ class BotWorldEnv(gym.Env):
                 # print(f"old: {old_dst} -> new: {new_dst} | reward {reward}")
 
         if action == ACTION_TURN_LEFT:
-            old_angle = self.world.getBotTargetAngle()
             self.world.bot.rotateLeft(angle=AGENT_ROTATE_STEP)
-            new_angle = self.world.getBotTargetAngle()
-            # reward = (old_angle - new_angle)
             reward = 0
 
         if action == ACTION_TURN_RIGHT:
-            old_angle = self.world.getBotTargetAngle()
             self.world.bot.rotateRight(angle=AGENT_ROTATE_STEP)
-            new_angle = self.world.getBotTargetAngle()
-            # reward = (old_angle - new_angle)
             reward = 0
 
         reward -= REWARD_STEP_PENALTY
@@ -113,16 +251,14 @@ class BotWorldEnv(gym.Env):
             reward += REWARD_TARGET_REACHED
             
         done = self.world.collisionDetected()
-
-        info = {}
-        obs = self.get_obs()
        
         debug(f"action: {action}, valid: {1 if valid_action else 0} reward: {reward:.3f}")
         
-        return obs, reward, done, info
+        return reward, done
      
     def render(self, mode='infoframe'):
-        self.world.updateInfoFrame()
+        if self.hud is not None:
+            self.hud.refresh()
 
     def close(self):
         pass
\ No newline at end of file
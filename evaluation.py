@@ -0,0 +1,338 @@
+import multiprocessing as mp
+import numpy as np
+import threading
+import queue
+import time
+import os
+
+from stable_baselines3.common.callbacks import BaseCallback
+
+from workers import WORKER_JOIN_TIMEOUT
+from config import *
+
+# evaluation episodes per evaluation, over all the workers
+N_EVAL_EPISODES = 5
+
+def eval_worker_main(remote, parent_remote, config_path):
+    """
+    Entry point of an evaluation worker process.
+    Builds its own headless RobotTargetWorld from config_path and plays
+    deterministic episodes with the policy weights of each 'evaluate' command.
+    """
+    parent_remote.close()
+
+    load_config(config_path)
+
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData("", "audio-library-name null")
+
+    import torch as th
+    from stable_baselines3.common.utils import constant_fn
+
+    from world import RobotTargetWorld
+    from vecenv import ArenaVecEnv
+
+    world = RobotTargetWorld(headless=True)
+    env = ArenaVecEnv(world)
+
+    while True:
+        cmd, data = remote.recv()
+
+        if cmd == "evaluate":
+            policy_class, policy_params, weights, n_episodes, deterministic, seed = data
+            # the learning rate schedule is only needed to train
+            policy = policy_class(lr_schedule=constant_fn(0.0), **policy_params)
+            policy.load_state_dict({ k: th.as_tensor(v) for k, v in weights.items() })
+            policy.set_training_mode(False)
+
+            env.seed(seed)
+            remote.send(evaluate_episodes(env, policy, n_episodes, deterministic))
+        elif cmd == "close":
+            env.close()
+            remote.close()
+            break
+        else:
+            raise NotImplementedError(f"`{cmd}` is not implemented in the evaluation worker")
+
+def evaluate_episodes(env, policy, n_episodes, deterministic=True):
+    """
+    Plays n_episodes episodes on the vectorized env, spread over its environments
+    the way SB3's evaluate_policy does, and returns their rewards and lengths
+    """
+    n_envs = env.num_envs
+    targets = np.array([ (n_episodes + i) // n_envs for i in range(n_envs) ])
+    counts = np.zeros(n_envs, dtype=np.int64)
+
+    current_rewards = np.zeros(n_envs)
+    current_lengths = np.zeros(n_envs, dtype=np.int64)
+    rewards, lengths = [], []
+
+    obs = env.reset()
+    while (counts < targets).any():
+        actions, _ = policy.predict(obs, deterministic=deterministic)
+        obs, rews, dones, infos = env.step(actions)
+
+        current_rewards += rews
+        current_lengths += 1
+        for i in np.flatnonzero(dones):
+            if counts[i] < targets[i]:
+                rewards.append(float(current_rewards[i]))
+                lengths.append(int(current_lengths[i]))
+                counts[i] += 1
+            current_rewards[i] = 0
+            current_lengths[i] = 0
+
+    return rewards, lengths
+
+
+class EvaluationPool:
+    """
+    Evaluates policy snapshots on worker processes, each with its own
+    headless RobotTargetWorld, while training goes on.
+    Snapshots are evaluated one at a time, on all the workers at once;
+    a snapshot submitted while another one waits replaces it.
+    Results are collected by poll().
+    """
+
+    def __init__(self, n_workers=None, config_path=None, n_eval_episodes=N_EVAL_EPISODES,
+                 deterministic=True, seed=0, start_method="spawn"):
+
+        if n_workers is None:
+            n_workers = config.get('eval_workers', 1)
+        if config_path is None:
+            config_path = os.environ[CONFIG_ENV_VAR]
+
+        self.n_workers = n_workers
+        self.config_path = config_path
+        self.n_eval_episodes = n_eval_episodes
+        self.deterministic = deterministic
+        self.seed = seed
+        self.context = mp.get_context(start_method)
+
+        self.processes = [ None ] * n_workers
+        self.remotes = [ None ] * n_workers
+        for rank in range(n_workers):
+            self.start_worker(rank)
+
+        # at most one snapshot waiting, besides the one being evaluated
+        self.jobs = queue.Queue(maxsize=1)
+        self.results = queue.Queue()
+        self.skipped = 0
+
+        self.thread = threading.Thread(target=self.run, name='EvaluationPool', daemon=True)
+        self.thread.start()
+        self.closed = False
+
+    def start_worker(self, rank):
+
+        remote, work_remote = self.context.Pipe()
+        process = self.context.Process(target=eval_worker_main,
+                                       args=(work_remote, remote, self.config_path),
+                                       daemon=True)
+        process.start()
+        work_remote.close()
+
+        self.processes[rank] = process
+        self.remotes[rank] = remote
+
+    def restart_worker(self, rank):
+
+        print(f"evaluation worker {rank} crashed, restarting")
+        self.remotes[rank].close()
+        if self.processes[rank].is_alive():
+            self.processes[rank].kill()
+        self.processes[rank].join()
+        self.start_worker(rank)
+
+    def submit(self, steps, policy_class, policy_params, weights, payload=None):
+        """
+        Queues the evaluation of a policy snapshot taken at steps.
+        weights: policy state dict as numpy arrays, not shared with the live model
+        payload: returned untouched with the result
+        """
+        job = (steps, policy_class, policy_params, weights, payload)
+        while True:
+            try:
+                self.jobs.put_nowait(job)
+                return
+            except queue.Full:
+                # the workers are still busy, a newer snapshot is more useful
+                try:
+                    self.jobs.get_nowait()
+                    self.jobs.task_done()
+                    self.skipped += 1
+                except queue.Empty:
+                    pass
+
+    def run(self):
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                break
+
+            try:
+                self.results.put(self.evaluate(*job))
+            except Exception as e:
+                print(f"ERROR: evaluation at {job[0]} steps failed: {e}")
+            self.jobs.task_done()
+
+    def evaluate(self, steps, policy_class, policy_params, weights, payload):
+
+        start = time.perf_counter()
+
+        sent = []
+        for rank, remote in enumerate(self.remotes):
+            n_episodes = (self.n_eval_episodes + rank) // self.n_workers
+            if n_episodes == 0:
+                continue
+            try:
+                remote.send(("evaluate", (policy_class, policy_params, weights, n_episodes,
+                                          self.deterministic, self.seed + rank)))
+                sent.append(rank)
+            except (BrokenPipeError, ConnectionError):
+                self.restart_worker(rank)
+
+        rewards, lengths = [], []
+        for rank in sent:
+            try:
+                worker_rewards, worker_lengths = self.remotes[rank].recv()
+            except (EOFError, ConnectionError):
+                # its episodes are missing from this evaluation
+                self.restart_worker(rank)
+                continue
+            rewards += worker_rewards
+            lengths += worker_lengths
+
+        if not rewards:
+            raise RuntimeError("no episode completed")
+
+        return { 'steps': steps,
+                 'rewards': rewards,
+                 'lengths': lengths,
+                 'mean_reward': float(np.mean(rewards)),
+                 'std_reward': float(np.std(rewards)),
+                 'mean_length': float(np.mean(lengths)),
+                 'duration': time.perf_counter() - start,
+                 'payload': payload }
+
+    def poll(self):
+        """
+        Results of the evaluations completed since the last call, oldest first
+        """
+        results = []
+        try:
+            while True:
+                results.append(self.results.get_nowait())
+        except queue.Empty:
+            pass
+        return results
+
+    def wait(self):
+        """
+        Waits for the submitted evaluations to complete
+        """
+        self.jobs.join()
+
+    def close(self):
+
+        if self.closed:
+            return
+
+        self.jobs.put(None)
+        self.thread.join()
+
+        for remote in self.remotes:
+            try:
+                remote.send(("close", None))
+            except (BrokenPipeError, ConnectionError):
+                pass
+
+        for process in self.processes:
+            process.join(WORKER_JOIN_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+
+        self.closed = True
+
+
+class AsyncEvalCallback(BaseCallback):
+    """
+    EvalCallback counterpart evaluating on an EvaluationPool: every
+    eval_freq calls the policy is snapshotted and submitted, results are
+    logged when they arrive and new best ones saved by the CheckpointManager
+    from the snapshot that was evaluated.
+    """
+
+    def __init__(self, pool, eval_freq, checkpoints=None, log_path=None, verbose=1):
+        super(AsyncEvalCallback, self).__init__(verbose)
+        self.pool = pool
+        self.eval_freq = eval_freq
+        self.checkpoints = checkpoints
+        self.log_path = log_path
+
+        self.best_mean_reward = -np.inf
+        self.evaluations_timesteps = []
+        self.evaluations_results = []
+        self.evaluations_length = []
+
+    def _on_step(self) -> bool:
+
+        if self.n_calls % self.eval_freq == 0:
+            self.submit()
+
+        self.report(self.pool.poll())
+        return True
+
+    def _on_training_end(self) -> None:
+        self.pool.wait()
+        self.report(self.pool.poll())
+
+    def submit(self):
+
+        snapshot = None
+        if self.checkpoints is not None:
+            # kept along, in case this snapshot turns out to be the best
+            snapshot = self.checkpoints.snapshot(self.model)
+            weights = { k: v.numpy() for k, v in snapshot[1]['policy'].items() }
+        else:
+            weights = { k: v.detach().to('cpu', copy=True).numpy()
+                        for k, v in self.model.policy.state_dict().items() }
+
+        policy_params = self.model.policy._get_constructor_parameters()
+        policy_params.pop('lr_schedule', None)
+
+        self.pool.submit(self.num_timesteps, type(self.model.policy), policy_params, weights, payload=snapshot)
+
+    def report(self, results):
+
+        for result in results:
+            steps, mean_reward = result['steps'], result['mean_reward']
+
+            if self.verbose > 0:
+                print(f"Eval at {steps} steps (reported at {self.num_timesteps}): "
+                      f"episode_reward={mean_reward:.2f} +/- {result['std_reward']:.2f}, "
+                      f"episode_length={result['mean_length']:.2f}, {result['duration']:.1f}s")
+
+            self.logger.record("eval/mean_reward", mean_reward)
+            self.logger.record("eval/mean_ep_length", result['mean_length'])
+            self.logger.record("eval/steps", steps)
+            self.logger.record("eval/skipped", self.pool.skipped)
+
+            if self.log_path is not None:
+                self.evaluations_timesteps.append(steps)
+                self.evaluations_results.append(result['rewards'])
+                self.evaluations_length.append(result['lengths'])
+                os.makedirs(self.log_path, exist_ok=True)
+                # the number of episodes of an evaluation may vary when a worker crashed
+                np.savez(os.path.join(self.log_path, "evaluations"),
+                         timesteps=self.evaluations_timesteps,
+                         results=np.array(self.evaluations_results, dtype=object),
+                         ep_lengths=np.array(self.evaluations_length, dtype=object))
+
+            if mean_reward > self.best_mean_reward:
+                self.best_mean_reward = mean_reward
+                print(f"new best mean reward {mean_reward:.2f} at {steps} steps")
+                if self.checkpoints is not None:
+                    self.checkpoints.save(self.model, steps, reward=mean_reward, snapshot=result['payload'])
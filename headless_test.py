@@ -1,27 +1,25 @@
 
-# WORK IN PROGRESS:
-
-# experimenting to make the application runnable on a headless remote linux server
-# currently not working
-
-from panda3d.core import loadPrcFileData
-from direct.showbase.ShowBase import ShowBase
-
-
-loadPrcFileData("", "window-type none")
+# runs the world in headless mode (no window) and checks that the
+# bot camera produces observations, e.g. on a remote linux server:
+#
+#   python headless_test.py --headless
+#
+# set headless_display: p3headlessgl (or p3tinydisplay) in config.cfg
+# when no X display is available
 
 from world import RobotTargetWorld
+from environment import *
 
-world = RobotTargetWorld(headless=True)
-# it doesn't work since i couldn't find a way to make the bot camera buffer render when 
-# `window-type none` is active.
-# I had defined the headless param in the constructor so as to allow RobotTargetWorld to
-# tell the case when it was run in headless mode; now I removed this for 
-# the mentioned problem.
+import numpy as np
 
-# Give feedback on command prompt log that the Panda3D program is active 
-# 3 seconds after launch
-base.task_mgr.do_method_later(3, print, "Panda3D is still running", ["foo"])
+world = RobotTargetWorld(headless=True)
+env = BotWorldEnv(world)
 
-world.run()
+obs = env.reset()
+for action in [ACTION_FORWARD, ACTION_TURN_LEFT, ACTION_TURN_RIGHT]:
+    obs, reward, done, info = env.step(action)
 
+print(f"observation shape: {obs.shape}, dtype: {obs.dtype}, mean: {obs.mean():.2f}")
+if not np.any(obs):
+    # a blank buffer means the bot camera didn't render
+    print("WARNING: bot camera buffer is blank")
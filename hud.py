@@ -0,0 +1,85 @@
+# default maximum number of InfoFrame text refreshes per second
+HUD_REFRESH_RATE = 10
+
+HUD_SEPARATOR = '-------------'
+
+class Hud:
+    """
+    Values shown in the InfoFrame, published by whoever computes them
+    (world, environment, agent). A value only counts as changed when it
+    differs at the displayed precision, and the text is only regenerated
+    by refresh, when something changed.
+    """
+
+    def __init__(self, info_frame, refresh_rate=HUD_REFRESH_RATE):
+
+        self.info_frame = info_frame
+        self.refreshInterval = 1.0 / refresh_rate if refresh_rate else 0.0
+
+        # display order, None for separators
+        self.lines = []
+        self.labels = {}
+        self.digits = {}
+        self.values = {}
+        self.dirty = True
+
+    def addValue(self, key, label, digits=2, value=0):
+        """
+        digits: displayed decimals, for numbers or tuples of numbers
+        """
+        self.lines.append(key)
+        self.labels[key] = label
+        self.digits[key] = digits
+        self.publish(key, value)
+
+    def addText(self, key):
+        """
+        Free text, e.g. a multi-line report
+        """
+        self.lines.append(key)
+        self.labels[key] = None
+        self.values[key] = ''
+
+    def addSeparator(self):
+        self.lines.append(None)
+
+    def publish(self, key, value):
+
+        digits = self.digits[key]
+        if isinstance(value, (tuple, list)):
+            value = tuple(round(float(v), digits) for v in value)
+        else:
+            value = round(float(value), digits)
+
+        if self.values.get(key) != value:
+            self.values[key] = value
+            self.dirty = True
+
+    def publishText(self, key, text):
+        if self.values[key] != text:
+            self.values[key] = text
+            self.dirty = True
+
+    def formatValue(self, key):
+
+        value = self.values[key]
+        if self.labels[key] is None:
+            return value
+
+        digits = self.digits[key]
+        if isinstance(value, tuple):
+            text = ', '.join(f"{v:.{digits}f}" for v in value)
+        else:
+            text = f"{value:.{digits}f}"
+        return f"{self.labels[key]} {text}"
+
+    def refresh(self):
+        """
+        Regenerates the InfoFrame text if any value changed
+        """
+        if not self.dirty:
+            return
+
+        lines = [ HUD_SEPARATOR if key is None else self.formatValue(key) for key in self.lines ]
+        self.info_frame.setText(' ' + '\n '.join(line for line in lines if line))
+        self.dirty = False
@@ -0,0 +1,136 @@
+import numpy as np
+import threading
+import queue
+import math
+
+from concurrent.futures import Future
+
+from config import *
+
+class InferenceService:
+    """
+    Runs policy forward passes in a worker thread.
+    Observations submitted by any number of bots are gathered into a single
+    batch, up to max_batch_size, and evaluated with one predict_fn call.
+    predict_fn maps a batch of observations to a batch of actions and is
+    called while holding lock, so weights can be swapped safely.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=64, lock=None):
+
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.lock = lock if lock is not None else threading.Lock()
+
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='InferenceService', daemon=True)
+        self.thread.start()
+
+    def submit(self, obs):
+        """
+        Queues obs for inference, returns a Future resolving to its action.
+        obs must not be modified until the future is done.
+        """
+        future = Future()
+        self.requests.put((obs, future))
+        return future
+
+    def run(self):
+
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+
+            batch = [ request ]
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.requests.put(None)
+                    break
+                batch.append(request)
+
+            observations = np.stack([ obs for obs, _ in batch ])
+            try:
+                with self.lock:
+                    actions = self.predict_fn(observations)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), action in zip(batch, actions):
+                future.set_result(action)
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+
+class AsyncPlayer:
+    """
+    Plays one episode per environment, sending observations to an
+    InferenceService and applying actions whenever they arrive, so the
+    render loop never waits for the policy.
+    Each bot requests a new action at most policy_rate times per second
+    (0: as soon as its previous action has been applied).
+    """
+
+    def __init__(self, envs, service, n_max_steps_per_episode, policy_rate=0):
+
+        self.envs = envs
+        self.service = service
+        self.period = 1.0 / policy_rate if policy_rate else 0.0
+
+        n = len(envs)
+        self.obs = [ np.zeros(env.observation_space.shape, dtype=env.observation_space.dtype) for env in envs ]
+        self.pending = [ None ] * n
+        self.last_request = [ -math.inf ] * n
+        self.active = [ True ] * n
+        self.remaining_steps = [ n_max_steps_per_episode ] * n
+        self.cumulative_rewards = [ 0.0 ] * n
+
+        # episodes start from the current positions
+        base.stepFrame(sync=True)
+        for env, obs in zip(self.envs, self.obs):
+            env.reset_frames()
+            env.get_obs(out=obs)
+
+    def update(self, now):
+        """
+        Applies the actions that arrived, renders once for all of them and
+        sends the new requests. Returns False once all the episodes ended.
+        """
+        stepped = []
+        for i, env in enumerate(self.envs):
+            future = self.pending[i]
+            if not self.active[i] or future is None or not future.done():
+                continue
+            self.pending[i] = None
+
+            reward, done = env.repeat_action(future.result())
+            self.cumulative_rewards[i] += reward
+            self.remaining_steps[i] -= 1
+
+            if done:
+                self.active[i] = False
+            elif self.remaining_steps[i] <= 0:
+                print(f"max play step reached (bot {i})")
+                self.active[i] = False
+            stepped.append(i)
+
+        if stepped:
+            base.stepFrame()
+            for i in stepped:
+                if self.active[i]:
+                    self.envs[i].get_obs(out=self.obs[i])
+
+        for i in range(len(self.envs)):
+            if self.active[i] and self.pending[i] is None and now - self.last_request[i] >= self.period:
+                self.pending[i] = self.service.submit(self.obs[i])
+                self.last_request[i] = now
+
+        return any(self.active)
@@ -0,0 +1,302 @@
+import gym
+import numpy as np
+import argparse
+import json
+import sys
+
+from stable_baselines3.common.vec_env import VecEnv
+
+from environment import *
+from config import *
+
+# bots start where Arena.loadBot / Arena.loadTarget place them
+BOT_START_POS = (5.0, -5.0)
+TARGET_START_POS = (-5.0, 5.0)
+
+# settings that are the same for every environment, readable through get_attr
+SHARED_ATTRS = ( 'observation_space', 'action_space', 'max_episode_steps', 'action_repeat' )
+
+# largest reward difference with BotWorldEnv, float32 rounding of the distances
+REWARD_TOLERANCE = 1e-5
+
+class KinematicVecEnv(VecEnv):
+    """
+    Render-free backend for num_envs bot/target pairs.
+    Positions and headings are stored in NumPy arrays and all the
+    environments are stepped at once, reproducing the moves, rewards and
+    done flags of BotWorldEnv.step (up to float32 rounding, like Panda3D
+    transforms). Observations are the bot-target (distance, angle), with
+    the angle computed as in Arena.getBotTargetAngle.
+    The state of each environment is the STATE_DTYPE record of BotWorldEnv,
+    stored field by field in the arrays of the same names.
+    """
+
+    def __init__(self, num_envs, max_episode_steps=None, action_repeat=None, seed=None):
+
+        observation_space = gym.spaces.Box(
+            low=np.array([0.0, 0.0], dtype=np.float32),
+            high=np.array([2 * np.sqrt(2) * ARENA_SIZE, np.pi], dtype=np.float32),
+            dtype=np.float32)
+        action_space = gym.spaces.Discrete(3)
+
+        super().__init__(num_envs, observation_space, action_space)
+
+        if max_episode_steps is None:
+            max_episode_steps = config['n_max_steps_per_episode']
+        self.max_episode_steps = max_episode_steps
+
+        if action_repeat is None:
+            action_repeat = config.get('action_repeat', 1)
+        self.action_repeat = action_repeat
+
+        self.rng = np.random.default_rng(seed)
+
+        # state, headings are in degrees like NodePath.getH()
+        self.bot_pos = np.tile(np.array(BOT_START_POS, dtype=np.float32), (num_envs, 1))
+        self.bot_heading = np.zeros(num_envs, dtype=np.float32)
+        self.target_pos = np.tile(np.array(TARGET_START_POS, dtype=np.float32), (num_envs, 1))
+        self.episode_steps = np.zeros(num_envs, dtype=np.int64)
+
+        self.actions = None
+        self.buf_obs = np.zeros((num_envs, 2), dtype=np.float32)
+
+    # state helpers
+
+    def reset_positions(self, mask=None):
+        """
+        Places bots and targets uniformly on the plane, headings are kept as in BotWorldEnv.reset
+        """
+        n = self.num_envs if mask is None else int(np.count_nonzero(mask))
+        positions = self.rng.uniform(-ARENA_SIZE, ARENA_SIZE, size=(n, 2, 2)).astype(np.float32)
+
+        if mask is None:
+            self.bot_pos[:] = positions[:, 0]
+            self.target_pos[:] = positions[:, 1]
+        else:
+            self.bot_pos[mask] = positions[:, 0]
+            self.target_pos[mask] = positions[:, 1]
+
+    def forward_vectors(self):
+        """
+        Bot y axis on the plane, same as quat.getForward() for a pure heading rotation
+        """
+        heading = np.deg2rad(self.bot_heading)
+        return np.stack([-np.sin(heading), np.cos(heading)], axis=1).astype(np.float32)
+
+    def distances(self):
+        delta = self.target_pos - self.bot_pos
+        return np.sqrt(np.einsum('ij,ij->i', delta, delta))
+
+    def angles(self):
+        u = self.forward_vectors()
+        v = self.target_pos - self.bot_pos
+        # v doesn't need to be normalized, atan2 only depends on its direction
+        dot = u[:, 0]*v[:, 0] + u[:, 1]*v[:, 1]
+        det = u[:, 0]*v[:, 1] - u[:, 1]*v[:, 0]
+        return np.abs(np.arctan2(det, dot))
+
+    def get_obs(self):
+        self.buf_obs[:, 0] = self.distances()
+        self.buf_obs[:, 1] = self.angles()
+        return self.buf_obs.copy()
+
+    def save_states(self):
+        """
+        Snapshot of every environment, a STATE_DTYPE array
+        """
+        states = np.zeros(self.num_envs, dtype=STATE_DTYPE)
+        for name in STATE_DTYPE.names:
+            states[name] = getattr(self, name)
+        return states
+
+    def reset_to(self, states, indices=None):
+        """
+        Restores the given environments to a batch of STATE_DTYPE states, returns their observations
+        """
+        indices = list(self._get_indices(indices))
+        for name in STATE_DTYPE.names:
+            getattr(self, name)[indices] = states[name]
+        return self.get_obs()[indices]
+
+    # VecEnv interface
+
+    def reset(self):
+        self.reset_positions()
+        self.episode_steps[:] = 0
+        return self.get_obs()
+
+    def step_async(self, actions):
+        self.actions = np.asarray(actions)
+
+    def step_wait(self):
+
+        # action repeat as in BotWorldEnv.repeat_action, envs stop at their episode end
+        rewards = np.zeros(self.num_envs, dtype=np.float64)
+        dones = np.zeros(self.num_envs, dtype=bool)
+        for _ in range(self.action_repeat):
+            active = ~dones
+            if not active.any():
+                break
+            sub_rewards, sub_dones = self.move(self.actions, active)
+            rewards[active] += sub_rewards[active]
+            dones |= sub_dones & active
+
+        # same semantics as gym's TimeLimit wrapper
+        self.episode_steps += 1
+        truncated = (self.episode_steps >= self.max_episode_steps) & ~dones
+        dones |= truncated
+
+        obs = self.get_obs()
+        infos = [ {} for _ in range(self.num_envs) ]
+
+        if dones.any():
+            for i in np.flatnonzero(dones):
+                infos[i]["terminal_observation"] = obs[i].copy()
+                infos[i]["TimeLimit.truncated"] = bool(truncated[i])
+            self.reset_positions(dones)
+            self.episode_steps[dones] = 0
+            obs = self.get_obs()
+
+        return obs, rewards.astype(np.float32), dones, infos
+
+    def move(self, actions, active):
+        """
+        One sub-step of BotWorldEnv.apply_action for the active environments.
+        Returns the rewards and done flags of all the environments.
+        """
+        forward = (actions == ACTION_FORWARD) & active
+        turn_left = (actions == ACTION_TURN_LEFT) & active
+        turn_right = (actions == ACTION_TURN_RIGHT) & active
+
+        old_dist = self.distances()
+
+        new_pos = self.bot_pos + self.forward_vectors() * AGENT_MOVE_STEP
+        valid = np.all((new_pos >= -ARENA_SIZE) & (new_pos <= ARENA_SIZE), axis=1)
+        moved = forward & valid
+        self.bot_pos[moved] = new_pos[moved]
+
+        self.bot_heading[turn_left] += AGENT_ROTATE_STEP
+        self.bot_heading[turn_right] -= AGENT_ROTATE_STEP
+
+        new_dist = self.distances()
+
+        rewards = np.zeros(self.num_envs, dtype=np.float64)
+        # distances are float32 like NodePath.getDistance, the difference is taken in double like in python
+        rewards[moved] = old_dist[moved].astype(np.float64) - new_dist[moved]
+        rewards[forward & ~valid] = -INVALID_ACTION_PENALTY
+        rewards -= REWARD_STEP_PENALTY
+        rewards[new_dist < COLLISION_THRESHOLD] += REWARD_TARGET_REACHED
+
+        # sphere-sphere test of the CollisionTraverser
+        dones = new_dist <= BOT_COLLISION_RADIUS + TARGET_COLLISION_RADIUS
+
+        return rewards, dones
+
+    def close(self):
+        pass
+
+    def seed(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+        return [ seed for _ in range(self.num_envs) ]
+
+    def get_attr(self, attr_name, indices=None):
+        """
+        The STATE_DTYPE fields of each environment, or the SHARED_ATTRS settings
+        """
+        if attr_name in STATE_DTYPE.names:
+            values = getattr(self, attr_name)
+            return [ values[i].copy() for i in self._get_indices(indices) ]
+        if attr_name in SHARED_ATTRS:
+            return [ getattr(self, attr_name) for _ in self._get_indices(indices) ]
+        raise AttributeError(f"KinematicVecEnv has no per environment attribute `{attr_name}`")
+
+    def set_attr(self, attr_name, value, indices=None):
+        """
+        Sets a STATE_DTYPE field of each environment, or a SHARED_ATTRS setting of all of them at once
+        """
+        indices = list(self._get_indices(indices))
+        if attr_name in STATE_DTYPE.names:
+            getattr(self, attr_name)[indices] = value
+        elif attr_name in SHARED_ATTRS and len(set(indices)) == self.num_envs:
+            setattr(self, attr_name, value)
+        else:
+            raise AttributeError(f"KinematicVecEnv cannot set `{attr_name}` for environments {indices}")
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        """
+        The per environment methods of BotWorldEnv that apply here:
+        reset, save_state and restore_state
+        """
+        indices = list(self._get_indices(indices))
+
+        if method_name == 'reset':
+            mask = np.zeros(self.num_envs, dtype=bool)
+            mask[indices] = True
+            self.reset_positions(mask)
+            self.episode_steps[mask] = 0
+            obs = self.get_obs()
+            return [ obs[i] for i in indices ]
+        if method_name == 'save_state':
+            states = self.save_states()
+            return [ states[i] for i in indices ]
+        if method_name == 'restore_state':
+            state = method_args[0] if method_args else method_kwargs['state']
+            return list(self.reset_to(np.repeat(np.asarray(state, dtype=STATE_DTYPE)[None], len(indices)), indices))
+
+        raise AttributeError(f"KinematicVecEnv has no per environment method `{method_name}`")
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return [ False for _ in self._get_indices(indices) ]
+
+
+def compare_backends(env, kinematic, n_steps, seed):
+    """
+    Steps an ArenaVecEnv and a KinematicVecEnv with the same random actions,
+    the kinematic state set from the arenas' before every step. Counts the
+    steps whose rewards or done flags differ.
+    """
+    rng = np.random.default_rng(seed)
+    env.seed(seed)
+    env.reset()
+
+    reward_mismatches, done_mismatches, max_reward_error = 0, 0, 0.0
+    n_dones = 0
+    for _ in range(n_steps):
+        kinematic.reset_to(env.save_states())
+
+        actions = rng.integers(0, env.action_space.n, size=env.num_envs)
+        _, rewards, dones, _ = env.step(actions)
+        _, kinematic_rewards, kinematic_dones, _ = kinematic.step(actions)
+
+        error = np.abs(rewards.astype(np.float64) - kinematic_rewards)
+        max_reward_error = max(max_reward_error, float(error.max()))
+        reward_mismatches += int(np.count_nonzero(error > REWARD_TOLERANCE))
+        done_mismatches += int(np.count_nonzero(dones != kinematic_dones))
+        n_dones += int(np.count_nonzero(dones))
+
+    return { 'steps': n_steps * env.num_envs,
+             'episode_ends': n_dones,
+             'reward_mismatches': reward_mismatches,
+             'done_mismatches': done_mismatches,
+             'max_reward_error': max_reward_error }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="checks that KinematicVecEnv reproduces the rewards and episode ends of BotWorldEnv")
+    parser.add_argument('--steps', type=int, default=5000, help='vectorized steps')
+    parser.add_argument('--seed', type=int, default=0)
+    args, _ = parser.parse_known_args()
+
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData("", "audio-library-name null")
+
+    from world import RobotTargetWorld
+    from vecenv import ArenaVecEnv
+
+    env = ArenaVecEnv(RobotTargetWorld(headless=True))
+    report = compare_backends(env, KinematicVecEnv(env.num_envs), args.steps, args.seed)
+    print(json.dumps(report, indent=2))
+
+    if report['reward_mismatches'] or report['done_mismatches']:
+        sys.exit(1)
@@ -1,8 +1,13 @@
 from world import RobotTargetWorld
 
-world = RobotTargetWorld()
+# rollout workers are spawned processes that re-import this module,
+# the world must only be created by the main process
+if __name__ == "__main__":
 
-# debug
-action_space = world.bot.agent.environment.action_space
+    world = RobotTargetWorld()
 
-world.run()
+    if world.headless:
+        # nothing to interact with, start training right away
+        world.startLearn()
+    else:
+        world.run()
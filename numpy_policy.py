@@ -0,0 +1,262 @@
+import numpy as np
+import argparse
+import json
+import sys
+import os
+
+from numpy.lib.stride_tricks import sliding_window_view
+
+from config import *
+
+# bump when the layout of the exported arrays changes
+NUMPY_POLICY_VERSION = 1
+
+ACTIVATIONS = {
+    'ReLU': lambda x: np.maximum(x, 0, out=x),
+    'Tanh': lambda x: np.tanh(x, out=x),
+}
+
+def export_policy(policy, path):
+    """
+    Writes the forward pass of an SB3 ActorCriticCnnPolicy (NatureCNN
+    features, mlp_extractor, action and value heads) to a .npz file,
+    without the optimizer state
+    """
+    np.savez(path, **policy_arrays(policy))
+
+def policy_arrays(policy):
+    """
+    The arrays of export_policy, by name. The first linear layer is
+    reordered to read channels-last features, the layout of NumpyPolicy.
+    """
+    import torch as th
+
+    state = { k: v.detach().cpu().numpy() for k, v in policy.state_dict().items() }
+    channels, height, width = policy.observation_space.shape
+
+    arrays = {}
+    strides = []
+    for name, module in policy.features_extractor.cnn.named_children():
+        if isinstance(module, th.nn.Conv2d):
+            if tuple(module.padding) != (0, 0) or tuple(module.dilation) != (1, 1) or module.stride[0] != module.stride[1]:
+                raise ValueError(f"unsupported convolution {module}")
+            i = len(strides)
+            arrays[f'conv{i}_weight'] = state[f'features_extractor.cnn.{name}.weight']
+            arrays[f'conv{i}_bias'] = state[f'features_extractor.cnn.{name}.bias']
+            strides.append(module.stride[0])
+
+            kernel = module.kernel_size
+            channels = module.out_channels
+            height = (height - kernel[0]) // module.stride[0] + 1
+            width = (width - kernel[1]) // module.stride[1] + 1
+        elif not isinstance(module, (th.nn.ReLU, th.nn.Flatten)):
+            raise ValueError(f"unsupported layer {module}")
+
+    # torch flattens (channels, rows, cols)
+    weight = state['features_extractor.linear.0.weight']
+    arrays['linear_weight'] = weight.reshape(-1, channels, height, width).transpose(0, 2, 3, 1).reshape(len(weight), -1)
+    arrays['linear_bias'] = state['features_extractor.linear.0.bias']
+
+    n_layers = {}
+    for net in ('policy_net', 'value_net'):
+        n_layers[net] = 0
+        for name, module in getattr(policy.mlp_extractor, net).named_children():
+            if isinstance(module, th.nn.Linear):
+                i = n_layers[net]
+                arrays[f'{net}{i}_weight'] = state[f'mlp_extractor.{net}.{name}.weight']
+                arrays[f'{net}{i}_bias'] = state[f'mlp_extractor.{net}.{name}.bias']
+                n_layers[net] += 1
+
+    for head in ('action_net', 'value_net'):
+        arrays[f'{head}_weight'] = state[f'{head}.weight']
+        arrays[f'{head}_bias'] = state[f'{head}.bias']
+
+    meta = { 'version': NUMPY_POLICY_VERSION,
+             'observation_shape': list(policy.observation_space.shape),
+             'normalize_images': bool(policy.normalize_images),
+             'strides': strides,
+             'policy_layers': n_layers['policy_net'],
+             'value_layers': n_layers['value_net'],
+             'activation': policy.activation_fn.__name__ }
+    if meta['activation'] not in ACTIVATIONS:
+        raise ValueError(f"unsupported activation {meta['activation']}")
+
+    arrays = { k: np.ascontiguousarray(v, dtype=np.float32) for k, v in arrays.items() }
+    arrays['meta'] = np.array(json.dumps(meta))
+    return arrays
+
+
+def choose_actions(logits, deterministic, rng):
+    """
+    Most likely actions of a batch of logits, or actions sampled from their
+    categorical distributions
+    """
+    if deterministic:
+        return logits.argmax(axis=1)
+
+    probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+    probs /= probs.sum(axis=1, keepdims=True)
+    return (probs.cumsum(axis=1) > rng.random((len(probs), 1))).argmax(axis=1)
+
+
+class NumpyPolicy:
+    """
+    Batched forward pass of an exported CnnPolicy with NumPy only: no
+    torch, no SB3, a few MB of weights. Activations are kept channels-last,
+    convolutions are products of sliding window views with the kernels.
+    predict follows the signature of SB3's.
+    """
+
+    def __init__(self, arrays, seed=None):
+
+        self.meta = json.loads(str(arrays['meta']))
+        if self.meta['version'] != NUMPY_POLICY_VERSION:
+            raise ValueError(f"exported policy version {self.meta['version']}, expected {NUMPY_POLICY_VERSION}")
+
+        self.channels, self.height, self.width = self.meta['observation_shape']
+        self.normalize_images = self.meta['normalize_images']
+        self.activation = ACTIVATIONS[self.meta['activation']]
+
+        self.convs = [ (arrays[f'conv{i}_weight'], arrays[f'conv{i}_bias'], stride)
+                       for i, stride in enumerate(self.meta['strides']) ]
+
+        # (in, out) for x @ w
+        dense = lambda name: (np.ascontiguousarray(arrays[f'{name}_weight'].T), arrays[f'{name}_bias'])
+        self.linear = dense('linear')
+        self.policy_net = [ dense(f'policy_net{i}') for i in range(self.meta['policy_layers']) ]
+        self.value_net = [ dense(f'value_net{i}') for i in range(self.meta['value_layers']) ]
+        self.action_net = dense('action_net')
+        self.value_head = dense('value_net')
+
+        self.rng = np.random.default_rng(seed)
+
+    @classmethod
+    def load(cls, path, seed=None):
+        with np.load(path) as f:
+            arrays = { k: f[k] for k in f.files }
+        return cls(arrays, seed)
+
+    def features(self, obs):
+        """
+        NatureCNN features of a (n, rows, cols, channels) batch
+        """
+        x = obs.astype(np.float32)
+        if self.normalize_images:
+            x *= 1.0 / 255.0
+
+        for weight, bias, stride in self.convs:
+            kernel = weight.shape[2:]
+            # (n, out_rows, out_cols, channels, kernel rows, kernel cols)
+            windows = sliding_window_view(x, kernel, axis=(1, 2))[:, ::stride, ::stride]
+            x = np.tensordot(windows, weight, axes=([3, 4, 5], [1, 2, 3]))
+            x += bias
+            np.maximum(x, 0, out=x)
+
+        x = x.reshape(len(x), -1) @ self.linear[0]
+        x += self.linear[1]
+        return np.maximum(x, 0, out=x)
+
+    def forward(self, obs):
+        """
+        Action logits and values of a batch of observations, channels-last
+        or channels-first
+        """
+        features = self.features(self.channels_last(obs))
+
+        latent_pi = features
+        for weight, bias in self.policy_net:
+            latent_pi = self.activation(latent_pi @ weight + bias)
+        latent_vf = features
+        for weight, bias in self.value_net:
+            latent_vf = self.activation(latent_vf @ weight + bias)
+
+        logits = latent_pi @ self.action_net[0] + self.action_net[1]
+        values = latent_vf @ self.value_head[0] + self.value_head[1]
+        return logits, values
+
+    def channels_last(self, obs):
+
+        if obs.shape[-3:] == (self.channels, self.height, self.width):
+            return obs.transpose(0, 2, 3, 1)
+        if obs.shape[-3:] != (self.height, self.width, self.channels):
+            raise ValueError(f"observation shape {obs.shape} doesn't match {(self.channels, self.height, self.width)}")
+        return obs
+
+    def predict(self, observation, state=None, episode_start=None, deterministic=False):
+        """
+        Actions for one observation or a batch, as SB3's predict: (actions, None)
+        """
+        observation = np.asarray(observation)
+        vectorized = observation.ndim == 4
+        if not vectorized:
+            observation = observation[None]
+
+        logits, _ = self.forward(observation)
+        actions = choose_actions(logits, deterministic, self.rng)
+
+        if not vectorized:
+            actions = actions[0]
+        return actions, None
+
+
+def verify(model_path, npz_path, observations):
+    """
+    Compares the NumPy forward pass with SB3's on a batch of observations.
+    Returns the deterministic action agreement and the largest logit and value errors.
+    """
+    import torch as th
+    from stable_baselines3 import PPO
+
+    model = PPO.load(model_path, device='cpu')
+    policy = NumpyPolicy.load(npz_path)
+
+    expected = model.predict(observations, deterministic=True)[0]
+    with th.no_grad():
+        obs_tensor, _ = model.policy.obs_to_tensor(observations)
+        expected_logits = model.policy.get_distribution(obs_tensor).distribution.logits.numpy()
+        expected_values = model.policy.predict_values(obs_tensor).numpy()
+
+    logits, values = policy.forward(observations)
+    actions = logits.argmax(axis=1)
+
+    # SB3's logits are normalized to log probabilities
+    shifted = logits - logits.max(axis=1, keepdims=True)
+    logits = shifted - np.log(np.exp(shifted).sum(axis=1, keepdims=True))
+
+    return { 'n_observations': len(observations),
+             'action_agreement': float(np.mean(actions == expected)),
+             'max_logit_error': float(np.abs(logits - expected_logits).max()),
+             'max_value_error': float(np.abs(values - expected_values).max()) }
+
+def default_model_path():
+    from checkpoints import model_file
+    return model_file(f"{config['model_path']}/{config['model_prefix']}", config['model_prefix'], config['best_model'])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="export a PPO CnnPolicy for torch-free inference")
+    parser.add_argument('--model', type=str, default=None, help='SB3 zip, the configured best_model by default')
+    parser.add_argument('--output', type=str, default=None, help='.npz file, next to the model by default')
+    parser.add_argument('--dataset', type=str, default=None, help='recorded episodes (record_path) to verify the export on')
+    parser.add_argument('--samples', type=int, default=1000, help='observations to verify on')
+    parser.add_argument('--seed', type=int, default=0)
+    args, _ = parser.parse_known_args()
+
+    model_path = args.model or default_model_path()
+    output = args.output or os.path.splitext(model_path)[0] + '.npz'
+
+    from stable_baselines3 import PPO
+    model = PPO.load(model_path, device='cpu')
+    export_policy(model.policy, output)
+    print(f"exported {model_path} to {output} ({os.path.getsize(output) / 2**20:.1f} MB)")
+
+    if args.dataset:
+        from recorder import EpisodeDataset
+        rng = np.random.default_rng(args.seed)
+        batch, _ = EpisodeDataset(args.dataset).sample(args.samples, rng)
+
+        report = verify(model_path, output, batch['obs'])
+        print(json.dumps(report, indent=2))
+        if report['action_agreement'] < 1.0:
+            sys.exit(1)
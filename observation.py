@@ -0,0 +1,153 @@
+import gym
+import numpy as np
+
+from config import *
+
+# default bot camera resolution, small for performance reasons
+BOT_CAMERA_FILM_WIDTH = 80
+BOT_CAMERA_FILM_HEIGHT = 60
+
+# ITU-R BT.601 luma, applied to RGB
+GRAYSCALE_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+class ObservationSpec:
+    """
+    Shape and preprocessing of the observations, from config's observation:
+    size: [width, height] rendered by the bot camera
+    downsample: integer factor, averaging blocks of downsample x downsample pixels
+    grayscale: single luma channel instead of RGB
+    frame_stack: number of most recent frames concatenated along the channels
+    channels_first: (channels, rows, cols) layout, as expected by the CNN policy,
+        instead of (rows, cols, channels)
+    """
+
+    def __init__(self, size=(BOT_CAMERA_FILM_WIDTH, BOT_CAMERA_FILM_HEIGHT), downsample=1,
+                 grayscale=False, frame_stack=1, channels_first=False):
+
+        self.width, self.height = int(size[0]), int(size[1])
+        self.downsample = int(downsample)
+        self.grayscale = bool(grayscale)
+        self.frame_stack = int(frame_stack)
+        self.channels_first = bool(channels_first)
+
+        if self.width % self.downsample or self.height % self.downsample:
+            raise ValueError(f"camera size {self.width}x{self.height} is not a multiple of downsample {self.downsample}")
+
+        self.rows = self.height // self.downsample
+        self.cols = self.width // self.downsample
+        self.channels = 1 if self.grayscale else 3
+
+    @property
+    def frame_shape(self):
+        """
+        Shape of a single processed frame
+        """
+        if self.channels_first:
+            return (self.channels, self.rows, self.cols)
+        return (self.rows, self.cols, self.channels)
+
+    @property
+    def shape(self):
+        """
+        Shape of an observation, frame_stack frames
+        """
+        if self.channels_first:
+            return (self.channels * self.frame_stack, self.rows, self.cols)
+        return (self.rows, self.cols, self.channels * self.frame_stack)
+
+    def observation_space(self):
+        return gym.spaces.Box(low=0, high=255, shape=self.shape, dtype=np.uint8)
+
+def observation_spec():
+    """
+    ObservationSpec from config's observation settings
+    """
+    return ObservationSpec(**config.get('observation', {}))
+
+
+class FrameProcessor:
+    """
+    Turns the raw RAM image of a bot camera into a frame of an
+    ObservationSpec, through preallocated work buffers
+    """
+
+    def __init__(self, spec):
+
+        self.spec = spec
+        self.work = None
+        if spec.downsample > 1:
+            self.work = np.zeros((spec.rows, spec.cols, 3), dtype=np.float32)
+        self.gray = None
+        if spec.grayscale:
+            self.gray = np.zeros((spec.rows, spec.cols), dtype=np.float32)
+
+    def process(self, image, out):
+        """
+        image: (height, width, components) uint8 RAM image, bottom row first, BGR(A)
+        out: uint8 array of spec.frame_shape
+        """
+        spec = self.spec
+
+        # flipped RGB view, no copy
+        frame = image[::-1, :, 2::-1]
+        rounded = False
+
+        if spec.downsample > 1:
+            d = spec.downsample
+            blocks = frame.reshape(spec.rows, d, spec.cols, d, 3)
+            np.sum(blocks, axis=(1, 3), dtype=np.float32, out=self.work)
+            self.work *= 1.0 / (d * d)
+            frame = self.work
+            rounded = True
+
+        if spec.grayscale:
+            np.dot(frame, GRAYSCALE_WEIGHTS, out=self.gray)
+            frame = self.gray[..., None]
+            rounded = True
+
+        if rounded:
+            # the float to uint8 cast truncates
+            frame += 0.5
+
+        if spec.channels_first:
+            frame = frame.transpose(2, 0, 1)
+
+        np.copyto(out, frame, casting='unsafe')
+        return out
+
+
+class FrameStack:
+    """
+    The frame_stack most recent frames of an environment, oldest first,
+    concatenated along the channel axis of the spec's layout
+    """
+
+    def __init__(self, spec):
+
+        self.spec = spec
+        self.frames = np.zeros(spec.shape, dtype=np.uint8)
+        self.axis = 0 if spec.channels_first else 2
+
+    def slot(self, i):
+        index = [ slice(None) ] * 3
+        index[self.axis] = slice(i * self.spec.channels, (i + 1) * self.spec.channels)
+        return self.frames[tuple(index)]
+
+    def next_slot(self):
+        """
+        Drops the oldest frame and returns the slot of the newest one, to be filled
+        """
+        c = self.spec.channels
+        if self.spec.channels_first:
+            self.frames[:-c] = self.frames[c:]
+        else:
+            self.frames[..., :-c] = self.frames[..., c:]
+        return self.slot(self.spec.frame_stack - 1)
+
+    def fill(self):
+        """
+        Repeats the newest frame in all the slots, at the start of an episode
+        """
+        newest = self.slot(self.spec.frame_stack - 1)
+        for i in range(self.spec.frame_stack - 1):
+            self.slot(i)[...] = newest
@@ -0,0 +1,134 @@
+from gym.wrappers import TimeLimit
+
+from environment import *
+from inference import InferenceService, AsyncPlayer
+from recorder import EpisodeRecorder
+from config import *
+
+import threading
+
+MAX_STEPS_PER_EPISODE = config['n_max_steps_per_episode']
+
+class PolicyPlayer:
+    """
+    Plays a policy in the world's arenas (Ctrl-P). agent is anything with
+    SB3's predict: the PPO model of a BotAgent or a torch-free NumpyPolicy.
+    """
+
+    def __init__(self, world, agent=None, env=None):
+
+        self.world = world
+        if env is None:
+            env = TimeLimit( BotWorldEnv(world), max_episode_steps=config['n_max_steps_per_episode'] )
+
+        # playing always happens in the main arena, recorded when record_path is set
+        self.recorder = None
+        self.play_environment = env
+        if config.get('record_path', None):
+            self.recorder = EpisodeRecorder(env, config['record_path'])
+            self.play_environment = self.recorder
+
+        self.agent = agent
+        # acts in place of agent when set, e.g. a quantized copy of its policy
+        self.play_policy = None
+
+        self.playing_steps = 0
+        self.current_obs = None
+        self.cumulative_reward = 0
+
+        # held while predicting and while swapping weights
+        self.policy_lock = threading.Lock()
+        self.inference = None
+        self.player = None
+
+    @property
+    def policy(self):
+        """
+        What plays: play_policy if set, the agent otherwise
+        """
+        return self.play_policy if self.play_policy is not None else self.agent
+
+    def play(self, n_max_steps_per_episode=MAX_STEPS_PER_EPISODE ):
+
+        if self.agent == None or self.play_environment == None:
+            raise
+
+        if config.get('async_inference', True):
+            self.play_async(n_max_steps_per_episode)
+            return
+
+        self.playing_steps = n_max_steps_per_episode
+        self.current_obs = self.play_environment.reset(reset_positions=False)
+        self.cumulative_reward = 0
+        self.publishPlayState()
+
+        taskMgr.add(self.playStep, 'AgentPlayUpdate')
+
+
+    def playStep(self, task):
+
+        dt = globalClock.getDt()
+
+        with self.policy_lock:
+            action = self.policy.predict(self.current_obs)[0]
+
+        self.current_obs, reward, done, info = self.play_environment.step(action)
+
+        self.cumulative_reward += reward
+        self.playing_steps -= 1
+        self.publishPlayState()
+
+        if done: # episode ended
+            return task.done
+
+        if self.playing_steps <= 0:
+            print("max play step reached")
+            return task.done
+
+        return task.cont
+
+    def play_async(self, n_max_steps_per_episode=MAX_STEPS_PER_EPISODE):
+        """
+        Plays an episode with every bot of the world at once; their
+        observations are batched by the inference service off the main
+        thread, so rendering goes on while the policy is evaluated
+        """
+        if self.inference is None:
+            self.inference = InferenceService(lambda obs: self.policy.predict(obs)[0],
+                                              lock=self.policy_lock)
+
+        taskMgr.remove('AgentPlayUpdate')
+
+        if self.recorder is not None:
+            self.recorder.end_episode()
+            envs = [ self.recorder ]
+        else:
+            envs = [ self.play_environment.unwrapped ]
+        envs += [ BotWorldEnv(arena) for arena in self.world.arenas[1:] ]
+        self.player = AsyncPlayer(envs, self.inference, n_max_steps_per_episode,
+                                  policy_rate=config.get('policy_rate', 0))
+
+        self.playing_steps = n_max_steps_per_episode
+        self.cumulative_reward = 0
+        self.publishPlayState()
+
+        taskMgr.add(self.playAsyncStep, 'AgentPlayUpdate')
+
+    def playAsyncStep(self, task):
+
+        playing = self.player.update(globalClock.getFrameTime())
+
+        # the InfoFrame shows the main arena
+        self.cumulative_reward = self.player.cumulative_rewards[0]
+        self.playing_steps = self.player.remaining_steps[0]
+        self.publishPlayState()
+
+        if not playing:
+            return task.done
+
+        return task.cont
+
+    def publishPlayState(self):
+        if self.world.hud is not None:
+            self.world.hud.publish('cumulative_reward', self.cumulative_reward)
+            self.world.hud.publish('remaining_steps', self.playing_steps)
@@ -0,0 +1,200 @@
+from panda3d.core import PStatCollector, PStatClient
+
+from contextlib import contextmanager
+
+import numpy as np
+import threading
+import time
+
+# samples kept by each phase timer
+PROFILE_WINDOW = 1000
+
+# phases reported in the InfoFrame, in this order
+HUD_PHASES = [ 'render', 'readback', 'move', 'bounds', 'distance', 'collision', 'inference' ]
+
+class PhaseTimer:
+    """
+    Rolling window of the last durations of a phase, also reported to
+    PStats as App:Bot:<name> when measured on the main thread
+    """
+
+    def __init__(self, name, window=PROFILE_WINDOW):
+
+        self.name = name
+        self.collector = PStatCollector(f"App:Bot:{name}")
+        self.samples = np.zeros(window)
+        self.count = 0
+
+    def record(self, elapsed):
+        self.samples[self.count % len(self.samples)] = elapsed
+        self.count += 1
+
+    def window(self):
+        return self.samples[:min(self.count, len(self.samples))]
+
+    def summary(self):
+        """
+        Statistics in milliseconds over the rolling window
+        """
+        samples = self.window() * 1000
+        if len(samples) == 0:
+            return { 'count': 0 }
+        return {
+            'count': self.count,
+            'mean_ms': float(samples.mean()),
+            'p50_ms': float(np.percentile(samples, 50)),
+            'p95_ms': float(np.percentile(samples, 95)),
+            'max_ms': float(samples.max()),
+        }
+
+    def histogram(self, bins=20):
+        """
+        Counts and millisecond bin edges, log spaced, over the rolling window
+        """
+        samples = np.maximum(self.window() * 1000, 1e-4)
+        if len(samples) == 0:
+            return np.zeros(bins, dtype=np.int64), np.zeros(bins + 1)
+        edges = np.geomspace(samples.min(), samples.max() * 1.0001, bins + 1)
+        return np.histogram(samples, bins=edges)
+
+
+class Profiler:
+    """
+    Times the phases of the hot path by wrapping the methods that implement
+    them on the instances being profiled. Nothing is wrapped unless
+    profiling is enabled in config, so when disabled the cost is zero.
+    """
+
+    def __init__(self):
+
+        self.enabled = False
+        self.timers = {}
+        # seconds spent in each phase since the last take_step_totals
+        self.step_totals = {}
+        self.main_thread = threading.main_thread()
+        # per thread flag of untimed()
+        self.local = threading.local()
+
+    def timer(self, phase):
+        if phase not in self.timers:
+            self.timers[phase] = PhaseTimer(phase)
+            self.step_totals[phase] = 0.0
+        return self.timers[phase]
+
+    def instrument(self, obj, method_name, phase):
+        """
+        Replaces obj.method_name with a timed version, once: a method
+        already timed is left as is, it would be counted twice
+        """
+        self.enabled = True
+        method = getattr(obj, method_name)
+        if getattr(method, 'profiled_phase', None) is not None:
+            return
+        timer = self.timer(phase)
+        totals = self.step_totals
+        local = self.local
+
+        def timed(*args, **kwargs):
+            if getattr(local, 'untimed', False):
+                return method(*args, **kwargs)
+            pstats = threading.current_thread() is self.main_thread
+            if pstats:
+                timer.collector.start()
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                if pstats:
+                    timer.collector.stop()
+                timer.record(elapsed)
+                totals[phase] += elapsed
+
+        timed.profiled_phase = phase
+        setattr(obj, method_name, timed)
+
+    @contextmanager
+    def untimed(self):
+        """
+        Instrumented calls made by this thread inside the block are not
+        timed, e.g. the HUD polling the state of the arena between steps
+        """
+        self.local.untimed = True
+        try:
+            yield
+        finally:
+            self.local.untimed = False
+
+    def instrument_world(self, world, pstats=False):
+        """
+        Profiles rendering, readback, moves, distance/angle and collisions of all the arenas
+        """
+        if pstats and not PStatClient.isConnected():
+            PStatClient.connect()
+
+        self.instrument(world, 'stepFrame', 'render')
+        for arena in world.arenas:
+            self.instrument(arena, 'getBotCameraBuffer', 'readback')
+            self.instrument(arena, 'collisionDetected', 'collision')
+            self.instrument(arena, 'getBotTargetDistance', 'distance')
+            self.instrument(arena, 'getBotTargetAngle', 'distance')
+            for method_name in ('moveForward', 'moveBackward', 'rotateLeft', 'rotateRight'):
+                self.instrument(arena.bot, method_name, 'move')
+
+    def instrument_env(self, env):
+        """
+        Profiles the bounds check of a BotWorldEnv, its step info gets
+        the milliseconds spent in each phase during the step
+        """
+        self.instrument(env, 'valid_move', 'bounds')
+
+        step = env.step
+        def profiled_step(action):
+            self.take_step_totals()
+            obs, reward, done, info = step(action)
+            info['profile'] = self.take_step_totals()
+            return obs, reward, done, info
+        env.step = profiled_step
+
+    def instrument_vec_env(self, vec_env):
+        """
+        Same as instrument_env for a vectorized step, all the envs share the totals.
+        The bounds checks are timed by the envs themselves, see instrument_env.
+        """
+        step_wait = vec_env.step_wait
+        def profiled_step_wait():
+            self.take_step_totals()
+            obs, rewards, dones, infos = step_wait()
+            profile = self.take_step_totals()
+            for info in infos:
+                info['profile'] = profile
+            return obs, rewards, dones, infos
+        vec_env.step_wait = profiled_step_wait
+
+    def take_step_totals(self):
+        """
+        Milliseconds spent in each phase since the last call
+        """
+        totals = { phase: elapsed * 1000 for phase, elapsed in self.step_totals.items() }
+        for phase in self.step_totals:
+            self.step_totals[phase] = 0.0
+        return totals
+
+    def summary(self):
+        return { phase: timer.summary() for phase, timer in self.timers.items() }
+
+    def hud_text(self):
+        """
+        One line per phase with the mean and 95th percentile in ms
+        """
+        lines = []
+        for phase in HUD_PHASES:
+            if phase not in self.timers:
+                continue
+            summary = self.timers[phase].summary()
+            if summary['count']:
+                lines.append(f"{phase}: {summary['mean_ms']:.2f} ms (p95 {summary['p95_ms']:.2f})")
+        return "\n ".join(lines)
+
+# one profiler per process, enabled by instrumenting something
+profiler = Profiler()
@@ -0,0 +1,268 @@
+import torch as th
+import torch.quantization as tq
+import numpy as np
+import contextlib
+import argparse
+import copy
+import json
+import time
+import io
+
+from stable_baselines3.common.preprocessing import preprocess_obs
+
+from numpy_policy import choose_actions
+from config import *
+
+# recorded observations the activation ranges are calibrated on
+CALIBRATION_SAMPLES = 512
+CALIBRATION_BATCH_SIZE = 64
+
+QUANTIZATION_BATCH_SIZES = [ 1, 8, 32, 128 ]
+
+class QuantizableActor(th.nn.Module):
+    """
+    Copy of the acting part of a CnnPolicy (NatureCNN features, policy
+    latent, action head) between quantization stubs, for eager mode
+    static quantization. Takes preprocessed observations, returns logits.
+    """
+
+    def __init__(self, policy):
+        super(QuantizableActor, self).__init__()
+        self.quant = tq.QuantStub()
+        self.cnn = copy.deepcopy(policy.features_extractor.cnn)
+        self.linear = copy.deepcopy(policy.features_extractor.linear)
+        self.policy_net = copy.deepcopy(policy.mlp_extractor.policy_net)
+        self.action_net = copy.deepcopy(policy.action_net)
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        x = self.quant(x)
+        x = self.policy_net(self.linear(self.cnn(x)))
+        return self.dequant(self.action_net(x))
+
+    def fusable(self):
+        """
+        Names of the conv/linear + ReLU pairs, quantized as single layers
+        """
+        groups = []
+        for name in ('cnn', 'linear', 'policy_net'):
+            children = list(getattr(self, name).named_children())
+            for (a, layer), (b, activation) in zip(children, children[1:]):
+                if isinstance(layer, (th.nn.Conv2d, th.nn.Linear)) and isinstance(activation, th.nn.ReLU):
+                    groups.append([ f"{name}.{a}", f"{name}.{b}" ])
+        return groups
+
+def preprocess(policy, obs):
+    """
+    Batch of raw observations as the float tensor the policy network reads, on the CPU
+    """
+    obs_tensor, _ = policy.obs_to_tensor(obs)
+    return preprocess_obs(obs_tensor, policy.observation_space, normalize_images=policy.normalize_images).cpu()
+
+def quantize_policy(policy, calibration_obs, lock=None):
+    """
+    int8 weights and activations for the conv and linear layers of a
+    CnnPolicy (fbgemm backend), with activation ranges observed on
+    calibration_obs. Only the copy of the float weights is made under lock.
+    """
+    th.backends.quantized.engine = 'fbgemm'
+
+    with lock or contextlib.nullcontext():
+        model = QuantizableActor(policy).cpu().eval()
+    groups = model.fusable()
+    if groups:
+        model = tq.fuse_modules(model, groups)
+    model.qconfig = tq.get_default_qconfig('fbgemm')
+    tq.prepare(model, inplace=True)
+
+    with th.no_grad():
+        for start in range(0, len(calibration_obs), CALIBRATION_BATCH_SIZE):
+            model(preprocess(policy, calibration_obs[start:start + CALIBRATION_BATCH_SIZE]))
+
+    tq.convert(model, inplace=True)
+    return model
+
+def dataset_observations(dataset_path, sizes, seed=0):
+    """
+    Disjoint sets of observations of the given sizes, drawn without
+    replacement from recorded episodes (see recorder.EpisodeRecorder)
+    """
+    from recorder import EpisodeDataset
+
+    dataset = EpisodeDataset(dataset_path)
+    if sum(sizes) > len(dataset):
+        raise ValueError(f"{sum(sizes)} observations requested, {dataset_path} has {len(dataset)}")
+
+    indices = np.random.default_rng(seed).permutation(len(dataset))
+    bounds = np.cumsum([ 0 ] + list(sizes))
+    return [ dataset.gather(indices[start:stop])['obs'] for start, stop in zip(bounds, bounds[1:]) ]
+
+def calibration_observations(dataset_path, n_samples=CALIBRATION_SAMPLES, seed=0):
+    """
+    Up to n_samples distinct recorded observations
+    """
+    from recorder import EpisodeDataset
+
+    n_samples = min(n_samples, len(EpisodeDataset(dataset_path)))
+    return dataset_observations(dataset_path, [ n_samples ], seed)[0]
+
+
+class QuantizedPolicy:
+    """
+    int8 counterpart of a float CnnPolicy for acting, with SB3's predict
+    signature. requantize() follows updated float weights.
+    """
+
+    def __init__(self, policy, calibration_obs, seed=None):
+
+        self.policy = policy
+        self.calibration_obs = calibration_obs
+        self.model = quantize_policy(policy, calibration_obs)
+        self.rng = np.random.default_rng(seed)
+
+    def requantize(self, lock=None):
+        """
+        Quantizes the current float weights again; lock, held while the
+        policy weights change, guards their copy and the swap of the model
+        """
+        model = quantize_policy(self.policy, self.calibration_obs, lock)
+        with lock or contextlib.nullcontext():
+            self.model = model
+
+    def logits(self, obs):
+        with th.no_grad():
+            return self.model(preprocess(self.policy, obs)).numpy()
+
+    def predict(self, observation, state=None, episode_start=None, deterministic=False):
+        """
+        Actions for one observation or a batch, as SB3's predict: (actions, None)
+        """
+        observation = np.asarray(observation)
+        vectorized = observation.ndim == len(self.policy.observation_space.shape) + 1
+        if not vectorized:
+            observation = observation[None]
+
+        actions = choose_actions(self.logits(observation), deterministic, self.rng)
+
+        if not vectorized:
+            actions = actions[0]
+        return actions, None
+
+
+def action_agreement(policy, quantized, obs):
+    """
+    Fraction of observations on which both policies choose the same deterministic action
+    """
+    expected = policy.predict(obs, deterministic=True)[0]
+    actions = quantized.predict(obs, deterministic=True)[0]
+    return float(np.mean(actions == expected))
+
+def episode_success(env, policy, n_episodes, seed):
+    """
+    Deterministic episodes from the start positions drawn by seed:
+    success rate (target reached before the time limit), mean reward and length
+    """
+    from evaluation import evaluate_episodes
+
+    env.seed(seed)
+    rewards, lengths = evaluate_episodes(env, policy, n_episodes, deterministic=True)
+    return { 'success_rate': float(np.mean(np.array(lengths) < env.max_episode_steps)),
+             'mean_reward': float(np.mean(rewards)),
+             'mean_length': float(np.mean(lengths)) }
+
+def model_bytes(model):
+    """
+    Size of the serialized weights
+    """
+    buffer = io.BytesIO()
+    th.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+def activation_bytes(model, x):
+    """
+    Bytes of the outputs of every layer for the input batch x
+    """
+    total = [ 0 ]
+    def count(module, inputs, output):
+        total[0] += output.numel() * output.element_size()
+
+    hooks = [ module.register_forward_hook(count) for module in model.modules()
+              if len(list(module.children())) == 0 ]
+    with th.no_grad():
+        model(x)
+    for hook in hooks:
+        hook.remove()
+    return total[0]
+
+def throughput_report(policy, quantized, obs, batch_sizes=QUANTIZATION_BATCH_SIZES, iterations=50):
+    """
+    Observations per second and memory (weights, activations) of the float
+    and int8 networks for each batch size
+    """
+    # single threaded, the int8 kernels and the float ones scale differently
+    th.set_num_threads(1)
+    models = { 'float': QuantizableActor(policy).cpu().eval(), 'int8': quantized.model }
+
+    report = {}
+    for batch_size in batch_sizes:
+        x = preprocess(policy, obs[np.arange(batch_size) % len(obs)])
+        report[batch_size] = {}
+        for name, model in models.items():
+            with th.no_grad():
+                model(x)
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    model(x)
+                elapsed = time.perf_counter() - start
+            report[batch_size][name] = { 'obs_per_sec': batch_size * iterations / elapsed,
+                                         'weight_bytes': model_bytes(model),
+                                         'activation_bytes': activation_bytes(model, x) }
+        report[batch_size]['speedup'] = report[batch_size]['int8']['obs_per_sec'] / report[batch_size]['float']['obs_per_sec']
+    return report
+
+
+if __name__ == "__main__":
+
+    from numpy_policy import default_model_path
+
+    parser = argparse.ArgumentParser(description="int8 quantization of the PPO policy: accuracy and speed report")
+    parser.add_argument('--model', type=str, default=None, help='SB3 zip, the configured best_model by default')
+    parser.add_argument('--dataset', type=str, default=config.get('record_path', None), help='recorded episodes for calibration and agreement')
+    parser.add_argument('--samples', type=int, default=CALIBRATION_SAMPLES, help='calibration observations')
+    parser.add_argument('--episodes', type=int, default=20, help='episodes played by each policy, 0 to skip')
+    parser.add_argument('--batch-sizes', type=str, default=','.join(map(str, QUANTIZATION_BATCH_SIZES)))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help='json file for the report')
+    args, _ = parser.parse_known_args()
+
+    if args.dataset is None:
+        parser.error("--dataset (or record_path in config.cfg) is needed for calibration")
+
+    from stable_baselines3 import PPO
+    model = PPO.load(args.model or default_model_path(), device='cpu')
+
+    # calibration and evaluation observations don't overlap
+    calibration, held_out = dataset_observations(args.dataset, [ args.samples, args.samples ], args.seed)
+
+    quantized = QuantizedPolicy(model.policy, calibration, seed=args.seed)
+
+    report = { 'action_agreement': action_agreement(model.policy, quantized, held_out),
+               'throughput': throughput_report(model.policy, quantized, held_out,
+                                               [ int(b) for b in args.batch_sizes.split(',') ]) }
+
+    if args.episodes > 0:
+        from panda3d.core import loadPrcFileData
+        loadPrcFileData("", "audio-library-name null")
+
+        from world import RobotTargetWorld
+        from vecenv import ArenaVecEnv
+        env = ArenaVecEnv(RobotTargetWorld(headless=True))
+
+        report['episodes'] = { 'float': episode_success(env, model.policy, args.episodes, args.seed),
+                               'int8': episode_success(env, quantized, args.episodes, args.seed) }
+
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,235 @@
+import numpy as np
+import argparse
+import json
+import math
+
+from environment import ARENA_SIZE
+from observation import BOT_CAMERA_FILM_WIDTH, BOT_CAMERA_FILM_HEIGHT
+
+# must match Arena.setupBotCamera
+BOT_CAMERA_OFFSET = (0.0, 0.15, 0.5)
+
+# Panda3D lens defaults (default-fov, default-near): the fov is the one of
+# the smaller film dimension, the other one follows the aspect ratio
+BOT_CAMERA_MIN_FOV = 30.0
+BOT_CAMERA_NEAR = 1.0
+
+# scene, see assets/models/*.egg and RobotTargetWorld lights
+TARGET_HALF_SIZE = 0.5
+TARGET_HEIGHT = 1.0
+TARGET_COLOR = np.array([0.0117, 0.8, 0.0285])
+# tex_checkered.PNG: 2x2 checker of these colors, repeated every 4 units
+GROUND_COLORS = np.array([[255, 255, 255], [102, 102, 102]]) / 255.0
+GROUND_TEXTURE_PERIOD = 4.0
+# dominant color of sky-circular-2.PNG
+SKY_COLOR = np.array([58, 154, 173]) / 255.0
+AMBIENT_LIGHT = np.array([0.8, 0.8, 0.9])
+# direction towards the directional light at hpr (45, -45, 0)
+LIGHT_DIR = np.array([0.5, -0.5, math.sqrt(0.5)])
+
+class RaycastRenderer:
+    """
+    Pure NumPy approximation of the bot camera view, rendering a whole batch
+    of poses at once: checkered ground, target box with lambert shading and
+    its shadow, flat sky. The bot model, specular highlights and the sky
+    texture are not rendered.
+    Images are (batch, height, width, 3) uint8 with the same orientation
+    as Arena.getBotCameraImage.
+    """
+
+    def __init__(self, width=BOT_CAMERA_FILM_WIDTH, height=BOT_CAMERA_FILM_HEIGHT,
+                 min_fov=BOT_CAMERA_MIN_FOV, near=BOT_CAMERA_NEAR, chunk_size=256):
+
+        self.width = width
+        self.height = height
+        self.near = near
+        self.chunk_size = chunk_size
+
+        half_min = math.radians(min_fov) / 2
+        if width >= height:
+            tan_v = math.tan(half_min)
+            tan_h = tan_v * width / height
+        else:
+            tan_h = math.tan(half_min)
+            tan_v = tan_h * height / width
+
+        # camera space rays through the pixel centers with unit forward (y) component,
+        # so the ray parameter of a hit is also its depth; row 0 is the top of the image
+        xs = ((np.arange(width) + 0.5) / width * 2 - 1) * tan_h
+        zs = (1 - (np.arange(height) + 0.5) / height * 2) * tan_v
+        self.ray_x = np.broadcast_to(xs[None, :], (height, width)).astype(np.float32)
+        self.ray_z = np.broadcast_to(zs[:, None], (height, width)).astype(np.float32)
+
+    def render(self, bot_pos, bot_heading, target_pos):
+        """
+        bot_pos, target_pos: (batch, 2) xy positions
+        bot_heading: (batch,) headings in degrees, like NodePath.getH()
+        """
+        bot_pos = np.asarray(bot_pos, dtype=np.float32).reshape(-1, 2)
+        target_pos = np.asarray(target_pos, dtype=np.float32).reshape(-1, 2)
+        bot_heading = np.asarray(bot_heading, dtype=np.float32).reshape(-1)
+
+        images = np.empty((len(bot_pos), self.height, self.width, 3), dtype=np.uint8)
+        for start in range(0, len(bot_pos), self.chunk_size):
+            end = start + self.chunk_size
+            images[start:end] = self.render_chunk(bot_pos[start:end], bot_heading[start:end], target_pos[start:end])
+        return images
+
+    def render_chunk(self, bot_pos, bot_heading, target_pos):
+
+        heading = np.deg2rad(bot_heading)[:, None, None]
+        cos_h, sin_h = np.cos(heading), np.sin(heading)
+
+        # camera origin, mounted on the bot
+        off_x, off_y, off_z = BOT_CAMERA_OFFSET
+        ox = bot_pos[:, 0, None, None] + off_x*cos_h - off_y*sin_h
+        oy = bot_pos[:, 1, None, None] + off_x*sin_h + off_y*cos_h
+        oz = np.float32(off_z)
+
+        # world space rays, rotated by the bot heading
+        dx = self.ray_x*cos_h - sin_h
+        dy = self.ray_x*sin_h + cos_h
+        dz = np.broadcast_to(self.ray_z, dx.shape)
+
+        tx = target_pos[:, 0, None, None]
+        ty = target_pos[:, 1, None, None]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+
+            # ground plane z = 0
+            t_ground = np.where(dz < 0, -oz / dz, np.inf)
+            gx = ox + t_ground*dx
+            gy = oy + t_ground*dy
+            ground_hit = (t_ground >= self.near) & (np.abs(gx) <= ARENA_SIZE) & (np.abs(gy) <= ARENA_SIZE)
+            t_ground = np.where(ground_hit, t_ground, np.inf)
+
+            # target box
+            t_box, box_axis, box_sign = self.intersect_target(ox, oy, oz, dx, dy, dz, tx, ty)
+
+            # the target shades the ground along the light direction
+            shadow, _, _ = self.intersect_target(gx, gy, 0.0, *LIGHT_DIR, tx, ty)
+            in_shadow = np.isfinite(shadow)
+
+        colors = np.empty(dx.shape + (3,), dtype=np.float32)
+        colors[:] = SKY_COLOR
+
+        # ground: texture modulated by the saturated lighting
+        cell = (np.floor(gx[ground_hit] / GROUND_TEXTURE_PERIOD * 2 + 1) +
+                np.floor(gy[ground_hit] / GROUND_TEXTURE_PERIOD * 2 + 1)).astype(np.int64) % 2
+        light = np.where(in_shadow[ground_hit, None], AMBIENT_LIGHT, AMBIENT_LIGHT + LIGHT_DIR[2])
+        colors[ground_hit] = GROUND_COLORS[cell] * np.minimum(light, 1.0)
+
+        # target: lambert shading of the hit face
+        box_hit = t_box < t_ground
+        normal = np.zeros(box_axis.shape + (3,), dtype=np.float32)
+        np.put_along_axis(normal, box_axis[..., None], box_sign[..., None], axis=-1)
+        diffuse = np.maximum(normal[box_hit] @ LIGHT_DIR, 0.0)
+        colors[box_hit] = TARGET_COLOR * np.minimum(AMBIENT_LIGHT + diffuse[:, None], 1.0)
+
+        return np.rint(colors * 255).astype(np.uint8)
+
+    def intersect_target(self, ox, oy, oz, dx, dy, dz, tx, ty):
+        """
+        Slab test of rays against the target boxes.
+        Returns the entry distance (inf when missed), the axis and the sign
+        of the normal of the entry face. Faces are single sided, so rays
+        starting inside the box or clipped by the near plane miss it.
+        """
+        t_min = []
+        t_max = []
+        for origin, direction, low, high in ((ox, dx, tx - TARGET_HALF_SIZE, tx + TARGET_HALF_SIZE),
+                                             (oy, dy, ty - TARGET_HALF_SIZE, ty + TARGET_HALF_SIZE),
+                                             (oz, dz, 0.0, TARGET_HEIGHT)):
+            t1 = (low - origin) / direction
+            t2 = (high - origin) / direction
+            # rays parallel to a slab: inside it for any t, or never
+            inside = (origin >= low) & (origin <= high)
+            t1 = np.where(direction == 0, np.where(inside, -np.inf, np.inf), t1)
+            t2 = np.where(direction == 0, np.where(inside, np.inf, -np.inf), t2)
+            t_min.append(np.minimum(t1, t2))
+            t_max.append(np.maximum(t1, t2))
+
+        t_min = np.stack(np.broadcast_arrays(*t_min))
+        t_max = np.stack(np.broadcast_arrays(*t_max))
+
+        axis = np.argmax(t_min, axis=0)
+        t_enter = np.take_along_axis(t_min, axis[None], axis=0)[0]
+        t_exit = t_max.min(axis=0)
+
+        near = self.near if np.ndim(dx) else 0.0
+        hit = (t_enter <= t_exit) & (t_enter >= near)
+
+        directions = np.stack(np.broadcast_arrays(dx, dy, dz, t_enter)[:3])
+        sign = -np.sign(np.take_along_axis(directions, axis[None], axis=0)[0])
+
+        return np.where(hit, t_enter, np.inf), axis, sign
+
+
+def fidelity_report(world, n_poses=100, seed=0):
+    """
+    Compares the raycast images with real bot camera frames rendered by
+    world's main arena for n_poses random poses.
+    Returns mean absolute error, PSNR and the IoU of the target pixels.
+    """
+    arena = world.arenas[0]
+    lens = arena.botCam.node().getLens()
+    renderer = RaycastRenderer(arena.filmWidth, arena.filmHeight, min_fov=lens.getMinFov(), near=lens.getNear())
+
+    rng = np.random.default_rng(seed)
+    bot_pos = rng.uniform(-ARENA_SIZE, ARENA_SIZE, size=(n_poses, 2)).astype(np.float32)
+    target_pos = rng.uniform(-ARENA_SIZE, ARENA_SIZE, size=(n_poses, 2)).astype(np.float32)
+    bot_heading = rng.uniform(0, 360, size=n_poses).astype(np.float32)
+
+    frames = np.empty((n_poses, renderer.height, renderer.width, 3), dtype=np.uint8)
+    for i in range(n_poses):
+        arena.bot.setPos(bot_pos[i, 0], bot_pos[i, 1], 0)
+        arena.bot.setH(bot_heading[i])
+        arena.target.setPos(target_pos[i, 0], target_pos[i, 1], 0)
+        # the analytic collision backend indexes the target positions
+        arena.refreshCollisions()
+        world.stepFrame(sync=True)
+        arena.getBotCameraImage(out=frames[i])
+
+    images = renderer.render(bot_pos, bot_heading, target_pos)
+
+    error = np.abs(images.astype(np.float32) - frames)
+    mse = (error**2).mean(axis=(1, 2, 3))
+    psnr = 10 * np.log10(255.0**2 / np.maximum(mse, 1e-10))
+
+    def target_mask(x):
+        x = x.astype(np.int16)
+        return (x[..., 1] > x[..., 0] + 60) & (x[..., 1] > x[..., 2] + 60)
+
+    real_mask, ray_mask = target_mask(frames), target_mask(images)
+    union = (real_mask | ray_mask).sum(axis=(1, 2))
+    inter = (real_mask & ray_mask).sum(axis=(1, 2))
+    visible = union > 0
+    iou = inter[visible] / union[visible]
+
+    return {
+        "n_poses": n_poses,
+        "mean_abs_error": float(error.mean()),
+        "mean_abs_error_p95": float(np.percentile(error.mean(axis=(1, 2, 3)), 95)),
+        "psnr_mean": float(psnr.mean()),
+        "target_iou_mean": float(iou.mean()) if visible.any() else None,
+        "target_visible_poses": int(visible.sum()),
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="raycast renderer fidelity report against Panda3D frames")
+    parser.add_argument('--poses', type=int, default=100, help='number of random poses')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help='json file for the report')
+    args, _ = parser.parse_known_args()
+
+    from world import RobotTargetWorld
+    world = RobotTargetWorld(n_arenas=1, headless=True)
+
+    report = fidelity_report(world, args.poses, args.seed)
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
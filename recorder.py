@@ -0,0 +1,330 @@
+import gym
+import numpy as np
+import threading
+import queue
+import atexit
+import json
+import math
+import os
+
+# steps stored in each memory-mapped chunk file
+RECORDER_CHUNK_SIZE = 4096
+# steps buffered in memory before being handed to the writer thread
+RECORDER_FLUSH_SIZE = 256
+RECORDER_BUFFERS = 3
+
+INDEX_FILE = 'index.json'
+
+def record_fields(observation_space):
+    """
+    (shape, dtype) of each recorded field, per step
+    """
+    return {
+        'obs': (tuple(observation_space.shape), np.dtype(observation_space.dtype)),
+        'action': ((), np.dtype(np.int64)),
+        'reward': ((), np.dtype(np.float32)),
+        'done': ((), np.dtype(bool)),
+        # x, y, heading in degrees
+        'bot_pose': ((3,), np.dtype(np.float32)),
+        # x, y
+        'target_pose': ((2,), np.dtype(np.float32)),
+    }
+
+def chunk_file(path, chunk, name):
+    return os.path.join(path, f"chunk_{chunk:05d}_{name}.npy")
+
+
+class EpisodeRecorder(gym.Wrapper):
+    """
+    Records the (obs, action, reward, done, bot/target pose) of every step
+    of a BotWorldEnv into chunked .npy files under path, plus an index of
+    the episode boundaries. Each step stores the observation the action
+    was taken on. Steps are copied into preallocated buffers and written
+    in bulk by a background thread, recording into an existing dataset
+    appends to it.
+    Besides step and reset, get_obs and repeat_action are recorded too,
+    so the recorder can stand in for the environment of an AsyncPlayer.
+    """
+
+    def __init__(self, env, path, chunk_size=RECORDER_CHUNK_SIZE, flush_size=RECORDER_FLUSH_SIZE):
+
+        super().__init__(env)
+
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        self.fields = record_fields(env.observation_space)
+        self.chunk_size = chunk_size
+        self.n_steps = 0
+        self.episodes = []
+
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+            if index['chunk_size'] != chunk_size:
+                raise ValueError(f"{path} was recorded with chunk_size {index['chunk_size']}")
+            self.n_steps = index['n_steps']
+            self.episodes = index['episodes']
+
+        self.free_buffers = queue.Queue()
+        for _ in range(RECORDER_BUFFERS):
+            self.free_buffers.put({ name: np.zeros((flush_size,) + shape, dtype=dtype)
+                                    for name, (shape, dtype) in self.fields.items() })
+        self.buffer = self.free_buffers.get()
+        self.buffer_rows = 0
+
+        self.episode_start = None
+        self.has_obs = False
+
+        self.writes = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, name='EpisodeRecorder', daemon=True)
+        self.writer.start()
+
+        self.closed = False
+        atexit.register(self.close)
+
+    def reset(self, **kwargs):
+        self.end_episode()
+        obs = self.env.reset(**kwargs)
+        self.record_obs(obs)
+        return obs
+
+    def step(self, action):
+        obs, reward, done, info = self.env.step(action)
+        self.record_transition(action, reward, done)
+        if not done:
+            self.record_obs(obs)
+        return obs, reward, done, info
+
+    def get_obs(self, out=None):
+        obs = self.env.get_obs(out)
+        self.record_obs(obs)
+        return obs
+
+    def repeat_action(self, action):
+        reward, done = self.env.repeat_action(action)
+        self.record_transition(action, reward, done)
+        return reward, done
+
+    def record_obs(self, obs):
+        """
+        Stores obs and the current poses in the next row, starting an episode if needed
+        """
+        world = self.unwrapped.world
+        bot_pos = world.bot.getPos()
+        target_pos = world.target.getPos()
+
+        row = self.buffer_rows
+        self.buffer['obs'][row] = obs
+        self.buffer['bot_pose'][row] = (bot_pos.x, bot_pos.y, world.bot.getH())
+        self.buffer['target_pose'][row] = (target_pos.x, target_pos.y)
+
+        if self.episode_start is None:
+            self.episode_start = self.n_steps
+        self.has_obs = True
+
+    def record_transition(self, action, reward, done):
+        """
+        Completes the row of the last observation with the action taken on it
+        """
+        if not self.has_obs:
+            return
+
+        row = self.buffer_rows
+        self.buffer['action'][row] = action
+        self.buffer['reward'][row] = reward
+        self.buffer['done'][row] = done
+
+        self.buffer_rows += 1
+        self.n_steps += 1
+        self.has_obs = False
+
+        if done:
+            self.end_episode()
+        if self.buffer_rows == len(self.buffer['done']):
+            self.flush()
+
+    def end_episode(self):
+        """
+        Closes the current episode, e.g. when it's truncated
+        """
+        if self.episode_start is not None and self.n_steps > self.episode_start:
+            self.episodes.append([ self.episode_start, self.n_steps - self.episode_start ])
+        self.episode_start = None
+        self.has_obs = False
+
+    def flush(self):
+        """
+        Hands the buffered steps over to the writer thread
+        """
+        if self.buffer_rows == 0:
+            return
+
+        start = self.n_steps - self.buffer_rows
+        self.writes.put((self.buffer, start, self.buffer_rows, list(self.episodes)))
+
+        # blocks only when the writer is RECORDER_BUFFERS flushes behind
+        self.buffer = self.free_buffers.get()
+        self.buffer_rows = 0
+
+    def close(self):
+
+        if self.closed:
+            return
+        self.closed = True
+
+        self.end_episode()
+        self.flush()
+        self.writes.put(None)
+        self.writer.join()
+
+        super().close()
+
+    def write_loop(self):
+
+        chunk = None
+        arrays = None
+
+        while True:
+            write = self.writes.get()
+            if write is None:
+                break
+
+            buffer, start, n, episodes = write
+            written = 0
+            while written < n:
+                k, offset = divmod(start + written, self.chunk_size)
+                if k != chunk:
+                    if arrays is not None:
+                        for array in arrays.values():
+                            array.flush()
+                    chunk, arrays = k, self.open_chunk(k)
+
+                count = min(n - written, self.chunk_size - offset)
+                for name, array in arrays.items():
+                    array[offset:offset + count] = buffer[name][written:written + count]
+                written += count
+
+            self.free_buffers.put(buffer)
+
+            for array in arrays.values():
+                array.flush()
+            self.write_index(start + n, episodes)
+
+    def open_chunk(self, chunk):
+
+        arrays = {}
+        for name, (shape, dtype) in self.fields.items():
+            file_name = chunk_file(self.path, chunk, name)
+            if os.path.exists(file_name):
+                arrays[name] = np.load(file_name, mmap_mode='r+')
+            else:
+                arrays[name] = np.lib.format.open_memmap(file_name, mode='w+', dtype=dtype,
+                                                         shape=(self.chunk_size,) + shape)
+        return arrays
+
+    def write_index(self, n_steps, episodes):
+        """
+        Only lists the steps already written, so the dataset can be read while recording
+        """
+        index = {
+            'chunk_size': self.chunk_size,
+            'n_steps': n_steps,
+            'fields': { name: { 'shape': list(shape), 'dtype': dtype.str }
+                        for name, (shape, dtype) in self.fields.items() },
+            'episodes': [ e for e in episodes if e[0] + e[1] <= n_steps ],
+        }
+
+        index_path = os.path.join(self.path, INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(index_path + '.tmp', index_path)
+
+
+class EpisodeDataset:
+    """
+    Read-only access to a dataset written by EpisodeRecorder.
+    The chunk files are memory-mapped: single steps and step ranges within
+    a chunk are views on the files, nothing is read until used.
+    """
+
+    def __init__(self, path):
+
+        with open(os.path.join(path, INDEX_FILE), 'r') as f:
+            index = json.load(f)
+
+        self.path = path
+        self.chunk_size = index['chunk_size']
+        self.n_steps = index['n_steps']
+        self.fields = list(index['fields'])
+        self.episodes = np.array(index['episodes'], dtype=np.int64).reshape(-1, 2)
+
+        self.chunks = []
+        for k in range(math.ceil(self.n_steps / self.chunk_size)):
+            length = min(self.chunk_size, self.n_steps - k * self.chunk_size)
+            self.chunks.append({ name: np.load(chunk_file(path, k, name), mmap_mode='r')[:length]
+                                 for name in self.fields })
+
+    def __len__(self):
+        return self.n_steps
+
+    @property
+    def num_episodes(self):
+        return len(self.episodes)
+
+    def __getitem__(self, i):
+
+        if i < 0:
+            i += self.n_steps
+        if not 0 <= i < self.n_steps:
+            raise IndexError(f"step {i} out of range")
+
+        k, offset = divmod(i, self.chunk_size)
+        return { name: array[offset] for name, array in self.chunks[k].items() }
+
+    def steps(self, start, stop):
+        """
+        Fields of the steps in [start, stop). Views when the range lies in
+        a single chunk, copies otherwise.
+        """
+        first, last = start // self.chunk_size, (stop - 1) // self.chunk_size
+        parts = []
+        for k in range(first, last + 1):
+            begin = max(start - k * self.chunk_size, 0)
+            end = min(stop - k * self.chunk_size, self.chunk_size)
+            parts.append({ name: array[begin:end] for name, array in self.chunks[k].items() })
+
+        if len(parts) == 1:
+            return parts[0]
+        return { name: np.concatenate([ part[name] for part in parts ]) for name in self.fields }
+
+    def episode(self, k):
+        start, length = self.episodes[k]
+        return self.steps(start, start + length)
+
+    def sample(self, batch_size, rng=None):
+        """
+        Random batch of steps, gathered chunk by chunk. Returns the fields and the step indices.
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+
+        indices = rng.integers(0, self.n_steps, size=batch_size)
+        return self.gather(indices), indices
+
+    def gather(self, indices):
+        """
+        Fields of the steps at indices, in that order, gathered chunk by chunk
+        """
+        indices = np.asarray(indices)
+        chunk_ids, offsets = np.divmod(indices, self.chunk_size)
+
+        batch = { name: np.empty((len(indices),) + array.shape[1:], dtype=array.dtype)
+                  for name, array in self.chunks[0].items() }
+        for k in np.unique(chunk_ids):
+            rows = chunk_ids == k
+            for name, array in self.chunks[k].items():
+                batch[name][rows] = array[offsets[rows]]
+
+        return batch
@@ -0,0 +1,26 @@
+from stable_baselines3.common.vec_env import VecEnv
+
+from vecenv import ArenaVecEnv
+from workers import WorkerPool
+
+# the vectorized environments implement VecEnv's interface on their own,
+# the SB3 base class is only added here for the processes that train
+
+class BotWorldVecEnv(ArenaVecEnv, VecEnv):
+    """
+    ArenaVecEnv as an SB3 VecEnv
+    """
+
+    def __init__(self, world, max_episode_steps=None):
+        ArenaVecEnv.__init__(self, world, max_episode_steps)
+        VecEnv.__init__(self, self.num_envs, self.observation_space, self.action_space)
+
+
+class WorkerPoolVecEnv(WorkerPool, VecEnv):
+    """
+    WorkerPool as an SB3 VecEnv
+    """
+
+    def __init__(self, n_workers=None, config_path=None, start_method="spawn"):
+        WorkerPool.__init__(self, n_workers, config_path, start_method)
+        VecEnv.__init__(self, self.num_envs, self.observation_space, self.action_space)
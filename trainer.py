@@ -0,0 +1,79 @@
+import multiprocessing as mp
+import atexit
+import queue
+import os
+
+from config import *
+
+# seconds to wait for the training process to stop before terminating it
+TRAINER_JOIN_TIMEOUT = 10
+
+def trainer_main(config_path, weights_queue, stop_event, n_episodes, n_max_steps_per_episode):
+    """
+    Entry point of the background training process.
+    Trains on its own headless RobotTargetWorld, publishing the policy
+    weights to weights_queue while learning.
+    """
+    load_config(config_path)
+
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData("", "audio-library-name null")
+
+    from world import RobotTargetWorld
+    from agent import PublishWeightsCallback
+
+    world = RobotTargetWorld(headless=True)
+    world.bot.createAgent()
+
+    callback = PublishWeightsCallback(weights_queue, stop_event, config.get('policy_publish_freq', 1000))
+    world.bot.agent.learn(n_episodes, n_max_steps_per_episode, callbacks=[callback])
+
+
+class BackgroundTrainer:
+    """
+    Runs BotAgent.learn in a separate process with its own headless world,
+    so that training and the interactive viewport don't slow each other down.
+    The latest policy weights are kept in a one slot queue.
+    """
+
+    def __init__(self, n_episodes, n_max_steps_per_episode, config_path=None):
+
+        if config_path is None:
+            config_path = os.environ[CONFIG_ENV_VAR]
+
+        context = mp.get_context("spawn")
+        self.weights_queue = context.Queue(maxsize=1)
+        self.stop_event = context.Event()
+
+        # not a daemon: the trainer may spawn its own rollout workers
+        self.process = context.Process(target=trainer_main,
+                                       args=(config_path, self.weights_queue, self.stop_event,
+                                             n_episodes, n_max_steps_per_episode))
+
+    def start(self):
+        self.process.start()
+        atexit.register(self.stop)
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def stop(self):
+        """
+        Asks the training to stop at its next step and waits for it
+        """
+        self.stop_event.set()
+        self.process.join(TRAINER_JOIN_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def latest_weights(self):
+        """
+        Returns the most recently published policy weights, None if nothing new was published
+        """
+        weights = None
+        try:
+            while True:
+                weights = self.weights_queue.get_nowait()
+        except queue.Empty:
+            pass
+        return weights
@@ -0,0 +1,147 @@
+import numpy as np
+
+from environment import *
+from profiling import profiler
+from config import *
+
+class ArenaVecEnv:
+    """
+    Vectorized environment over all the arenas of a RobotTargetWorld.
+    Actions of every arena are applied first, then a single frame
+    produces the observations of all the arenas at once.
+    Implements SB3's VecEnv interface without importing SB3, so that
+    render-only worker processes don't load torch; see sb3env.BotWorldVecEnv.
+    """
+
+    def __init__(self, world, max_episode_steps=None):
+
+        self.world = world
+        self.envs = [ BotWorldEnv(arena) for arena in world.arenas ]
+
+        env = self.envs[0]
+        self.num_envs = len(self.envs)
+        self.observation_space = env.observation_space
+        self.action_space = env.action_space
+
+        if max_episode_steps is None:
+            max_episode_steps = config['n_max_steps_per_episode']
+        self.max_episode_steps = max_episode_steps
+
+        self.episode_steps = np.zeros(self.num_envs, dtype=np.int64)
+        self.actions = None
+
+        self.buf_obs = np.zeros((self.num_envs,) + env.observation_space.shape,
+                                dtype=env.observation_space.dtype)
+        self.buf_rews = np.zeros(self.num_envs, dtype=np.float32)
+        self.buf_dones = np.zeros(self.num_envs, dtype=bool)
+
+        if config.get('profiling', False):
+            profiler.instrument_vec_env(self)
+
+    def reset(self):
+
+        for env in self.envs:
+            env.reset_positions()
+        self.episode_steps[:] = 0
+
+        base.stepFrame(sync=True)
+        self.read_obs(range(self.num_envs))
+
+        return self.buf_obs.copy()
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions):
+        self.actions = actions
+
+    def step_wait(self):
+
+        infos = [ {} for _ in range(self.num_envs) ]
+
+        for i, (env, action) in enumerate(zip(self.envs, self.actions)):
+            self.buf_rews[i], self.buf_dones[i] = env.repeat_action(action)
+
+        # same semantics as gym's TimeLimit wrapper
+        self.episode_steps += 1
+        truncated = (self.episode_steps >= self.max_episode_steps) & ~self.buf_dones
+        self.buf_dones |= truncated
+
+        base.stepFrame()
+        self.read_obs(range(self.num_envs))
+
+        if self.buf_dones.any():
+            # ended episodes need one more frame to observe their new start positions
+            ended = np.flatnonzero(self.buf_dones)
+            for i in ended:
+                infos[i]["terminal_observation"] = self.buf_obs[i].copy()
+                infos[i]["TimeLimit.truncated"] = bool(truncated[i])
+                self.envs[i].reset_positions()
+                self.episode_steps[i] = 0
+
+            base.stepFrame(sync=True)
+            self.read_obs(ended)
+
+        return self.buf_obs.copy(), self.buf_rews.copy(), self.buf_dones.copy(), infos
+
+    def read_obs(self, indices):
+        for i in indices:
+            self.envs[i].get_obs(out=self.buf_obs[i])
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+    def seed(self, seed=None):
+        # one stream per environment, like SB3's vectorized environments
+        return sum([ env.seed(None if seed is None else seed + i) for i, env in enumerate(self.envs) ], [])
+
+    def save_states(self):
+        """
+        Snapshot of every environment, a STATE_DTYPE array
+        """
+        states = np.zeros(self.num_envs, dtype=STATE_DTYPE)
+        for env, state in zip(self.envs, states):
+            env.save_state(state)
+        states['episode_steps'] = self.episode_steps
+        return states
+
+    def reset_to(self, states, indices=None):
+        """
+        Restores the given environments to a batch of STATE_DTYPE states,
+        rendered with a single frame. Returns their observations.
+        """
+        indices = list(self.get_indices(indices))
+        for i, state in zip(indices, states):
+            self.envs[i].restore_state(state, render=False)
+            self.episode_steps[i] = state['episode_steps']
+
+        base.stepFrame(sync=True)
+        self.read_obs(indices)
+
+        return self.buf_obs[indices]
+
+    def get_images(self):
+        return [ env.world.getBotCameraImage() for env in self.envs ]
+
+    def get_attr(self, attr_name, indices=None):
+        return [ getattr(self.envs[i], attr_name) for i in self.get_indices(indices) ]
+
+    def set_attr(self, attr_name, value, indices=None):
+        for i in self.get_indices(indices):
+            setattr(self.envs[i], attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        return [ getattr(self.envs[i], method_name)(*method_args, **method_kwargs)
+                 for i in self.get_indices(indices) ]
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return [ isinstance(self.envs[i], wrapper_class) for i in self.get_indices(indices) ]
+
+    def get_indices(self, indices):
+        if indices is None:
+            return range(self.num_envs)
+        if isinstance(indices, int):
+            return [ indices ]
+        return indices
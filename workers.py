@@ -0,0 +1,315 @@
+import multiprocessing as mp
+import numpy as np
+import os
+
+from config import *
+
+# seconds to wait for a worker to shut down before killing it
+WORKER_JOIN_TIMEOUT = 5
+
+# attempts at restarting a crashed worker, or repeating a command on a restarted one
+WORKER_RESTART_ATTEMPTS = 3
+
+def worker_main(remote, parent_remote, config_path):
+    """
+    Entry point of a rollout worker process.
+    Builds its own headless RobotTargetWorld from config_path and serves
+    the commands sent by WorkerPool until 'close' is received.
+    Neither SB3 nor torch are imported here.
+    """
+    parent_remote.close()
+
+    load_config(config_path)
+
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData("", "audio-library-name null")
+
+    from world import RobotTargetWorld
+    from vecenv import ArenaVecEnv
+
+    world = RobotTargetWorld(headless=True)
+    env = ArenaVecEnv(world)
+
+    while True:
+        cmd, data = remote.recv()
+
+        if cmd == "step":
+            env.step_async(data)
+            remote.send(env.step_wait())
+        elif cmd == "reset":
+            remote.send(env.reset())
+        elif cmd == "get_spaces":
+            remote.send((env.num_envs, env.observation_space, env.action_space))
+        elif cmd == "save_states":
+            remote.send(env.save_states())
+        elif cmd == "reset_to":
+            remote.send(env.reset_to(*data))
+        elif cmd == "seed":
+            remote.send(env.seed(data))
+        elif cmd == "get_attr":
+            remote.send(env.get_attr(*data))
+        elif cmd == "set_attr":
+            remote.send(env.set_attr(*data))
+        elif cmd == "env_method":
+            method_name, method_args, method_kwargs, indices = data
+            remote.send(env.env_method(method_name, *method_args, indices=indices, **method_kwargs))
+        elif cmd == "close":
+            env.close()
+            remote.close()
+            break
+        else:
+            raise NotImplementedError(f"`{cmd}` is not implemented in the worker")
+
+
+class WorkerPool:
+    """
+    SubprocVecEnv-like pool of rollout workers, each running its own
+    headless RobotTargetWorld with config's n_arenas arenas.
+    Environments are numbered worker by worker, arena by arena.
+    Workers that crash are restarted: their environments report done
+    with info['worker_restarted'] and start a new episode. Other commands
+    are repeated on the restarted worker, see round_trip.
+    """
+
+    def __init__(self, n_workers=None, config_path=None, start_method="spawn"):
+
+        if n_workers is None:
+            n_workers = config.get('n_workers', 1)
+        if config_path is None:
+            config_path = os.environ[CONFIG_ENV_VAR]
+
+        self.n_workers = n_workers
+        self.config_path = config_path
+        self.context = mp.get_context(start_method)
+
+        self.processes = [ None ] * n_workers
+        self.remotes = [ None ] * n_workers
+        self.restarts = [ 0 ] * n_workers
+
+        for rank in range(n_workers):
+            self.start_worker(rank)
+
+        self.n_arenas, observation_space, action_space = self.round_trip({ 0: ("get_spaces", None) })[0]
+
+        self.num_envs = n_workers * self.n_arenas
+        self.observation_space = observation_space
+        self.action_space = action_space
+
+        self.waiting = False
+        self.failed = set()
+        self.closed = False
+
+    def start_worker(self, rank):
+
+        remote, work_remote = self.context.Pipe()
+        process = self.context.Process(target=worker_main,
+                                       args=(work_remote, remote, self.config_path),
+                                       daemon=True)
+        process.start()
+        work_remote.close()
+
+        self.processes[rank] = process
+        self.remotes[rank] = remote
+
+    def restart_worker(self, rank):
+        """
+        Replaces a crashed worker and returns the first observations of its environments
+        """
+        for _ in range(WORKER_RESTART_ATTEMPTS):
+            self.restarts[rank] += 1
+            print(f"worker {rank} crashed, restarting ({self.restarts[rank]} restarts so far)")
+
+            self.remotes[rank].close()
+            if self.processes[rank].is_alive():
+                self.processes[rank].kill()
+            self.processes[rank].join()
+
+            self.start_worker(rank)
+            try:
+                self.remotes[rank].send(("reset", None))
+                return self.remotes[rank].recv()
+            except (EOFError, BrokenPipeError, ConnectionError):
+                pass
+
+        raise RuntimeError(f"worker {rank} crashed {WORKER_RESTART_ATTEMPTS} times in a row while restarting")
+
+    def round_trip(self, commands):
+        """
+        Sends its (cmd, data) to each rank of commands and returns the
+        replies by rank. A worker that crashed is restarted and the
+        command repeated on the new one.
+        """
+        failed = set()
+        for rank, command in commands.items():
+            try:
+                self.remotes[rank].send(command)
+            except (BrokenPipeError, ConnectionError):
+                failed.add(rank)
+
+        replies = {}
+        for rank, command in commands.items():
+            if rank not in failed:
+                try:
+                    replies[rank] = self.remotes[rank].recv()
+                    continue
+                except (EOFError, ConnectionError):
+                    pass
+            replies[rank] = self.retry(rank, command)
+        return replies
+
+    def retry(self, rank, command):
+
+        for _ in range(WORKER_RESTART_ATTEMPTS):
+            self.restart_worker(rank)
+            try:
+                self.remotes[rank].send(command)
+                return self.remotes[rank].recv()
+            except (EOFError, BrokenPipeError, ConnectionError):
+                pass
+
+        raise RuntimeError(f"worker {rank} crashed {WORKER_RESTART_ATTEMPTS} times on `{command[0]}`")
+
+    def worker_envs(self, rank):
+        return slice(rank * self.n_arenas, (rank + 1) * self.n_arenas)
+
+    def reset(self):
+
+        obs = self.round_trip({ rank: ("reset", None) for rank in range(self.n_workers) })
+        return np.concatenate(list(obs.values()))
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions):
+
+        self.failed = set()
+        for rank, remote in enumerate(self.remotes):
+            try:
+                remote.send(("step", actions[self.worker_envs(rank)]))
+            except (BrokenPipeError, ConnectionError):
+                self.failed.add(rank)
+        self.waiting = True
+
+    def step_wait(self):
+
+        results = []
+        for rank, remote in enumerate(self.remotes):
+            result = None
+            if rank not in self.failed:
+                try:
+                    result = remote.recv()
+                except (EOFError, ConnectionError):
+                    pass
+
+            if result is None:
+                # episodes running in the crashed worker are lost
+                obs = self.restart_worker(rank)
+                result = (obs,
+                          np.zeros(self.n_arenas, dtype=np.float32),
+                          np.ones(self.n_arenas, dtype=bool),
+                          [ {"worker_restarted": True} for _ in range(self.n_arenas) ])
+
+            results.append(result)
+
+        self.waiting = False
+
+        obs, rews, dones, infos = zip(*results)
+        return np.concatenate(obs), np.concatenate(rews), np.concatenate(dones), sum(infos, [])
+
+    def close(self):
+
+        if self.closed:
+            return
+
+        if self.waiting:
+            for remote in self.remotes:
+                try:
+                    remote.recv()
+                except (EOFError, ConnectionError):
+                    pass
+
+        for remote in self.remotes:
+            try:
+                remote.send(("close", None))
+            except (BrokenPipeError, ConnectionError):
+                pass
+
+        for process in self.processes:
+            process.join(WORKER_JOIN_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+
+        self.closed = True
+
+    def seed(self, seed=None):
+
+        seeds = self.round_trip({ rank: ("seed", None if seed is None else seed + rank * self.n_arenas)
+                                  for rank in range(self.n_workers) })
+        return sum(seeds.values(), [])
+
+    def save_states(self):
+
+        states = self.round_trip({ rank: ("save_states", None) for rank in range(self.n_workers) })
+        return np.concatenate(list(states.values()))
+
+    def reset_to(self, states, indices=None):
+        """
+        Restores a batch of states, each worker renders its own with a single frame
+        """
+        indices = list(self.get_indices(indices))
+        by_rank = {}
+        for i, state in zip(indices, states):
+            local, rank_states = by_rank.setdefault(i // self.n_arenas, ([], []))
+            local.append(i % self.n_arenas)
+            rank_states.append(state)
+
+        obs = self.round_trip({ rank: ("reset_to", (np.array(rank_states), local))
+                                for rank, (local, rank_states) in by_rank.items() })
+
+        # back in the order of indices
+        position = { rank: 0 for rank in by_rank }
+        result = []
+        for i in indices:
+            rank = i // self.n_arenas
+            result.append(obs[rank][position[rank]])
+            position[rank] += 1
+        return np.stack(result)
+
+    def get_attr(self, attr_name, indices=None):
+        return self.dispatch("get_attr", lambda local: (attr_name, local), indices)
+
+    def set_attr(self, attr_name, value, indices=None):
+        self.dispatch("set_attr", lambda local: (attr_name, value, local), indices)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        return self.dispatch("env_method",
+                             lambda local: (method_name, method_args, method_kwargs, local),
+                             indices)
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return [ False for _ in self.get_indices(indices) ]
+
+    def get_indices(self, indices):
+        if indices is None:
+            return range(self.num_envs)
+        if isinstance(indices, int):
+            return [ indices ]
+        return indices
+
+    def dispatch(self, cmd, make_data, indices):
+        """
+        Sends cmd to the workers owning the given environment indices,
+        make_data builds the payload from the worker's local indices
+        """
+        by_rank = {}
+        for i in self.get_indices(indices):
+            by_rank.setdefault(i // self.n_arenas, []).append(i % self.n_arenas)
+
+        replies = self.round_trip({ rank: (cmd, make_data(local)) for rank, local in by_rank.items() })
+
+        results = []
+        for result in replies.values():
+            if result is not None:
+                results.extend(result)
+        return results
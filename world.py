@@ -7,7 +7,10 @@ from direct.gui.OnscreenImage import OnscreenImage
 
 from cameramouse import CameraMouseHandler
 from infoframe import InfoFrame
-from bot import Bot
+from hud import *
+from arena import *
+from assets import loadCachedModel
+from profiling import profiler
 from config import *
 
 import numpy as np
@@ -16,54 +19,127 @@ import math
 from PIL import Image
 import datetime
 
-# small size for performance reasons
-BOT_CAMERA_FILM_WIDTH = 80 
-BOT_CAMERA_FILM_HEIGHT = 60
+# ShowBase's default window background, used by headless buffers
+HEADLESS_CLEAR_COLOR = (0.41, 0.41, 0.41, 1)
 
-class RobotTargetWorld(ShowBase):
+# dominant color of the skybox texture, replaces it in the cheaper render profiles
+SKY_CLEAR_COLOR = (58/255, 154/255, 173/255, 1)
 
-    # Class init method
+# interactive: shadows, per-pixel lighting and skybox everywhere
+# training: bot cameras get fixed function lighting and a flat sky
+# minimal: bot cameras also skip lighting, only flat textures and colors
+RENDER_PROFILES = ('interactive', 'training', 'minimal')
 
-    def __init__(self):
+# draw mask bit of the bot cameras, scenery hidden to them is only seen by the main view
+BOT_CAMERA_MASK = BitMask32.bit(1)
 
-        super().__init__()
+class RobotTargetWorld(ShowBase):
 
-        wp = WindowProperties()
-        wp.setSize(1200, 720)
-        #wp.setSize(1920, 1080)
-    
-        self.win.requestProperties(wp)
+    # Class init method
+
+    def __init__(self, n_arenas=None, interactive=True, window_type=None, headless=None):
+        """
+        n_arenas: number of bot/target arenas, defaults to config's n_arenas
+        interactive: when False no UI, input handlers or agent are set up and the
+            main window is not drawn
+        window_type: passed to ShowBase as windowType, e.g. 'offscreen'
+        headless: no window at all, the bot cameras render into standalone
+            offscreen buffers. Implies interactive=False, defaults to config's headless
+
+        With config's pipelined_readback the frames are drawn in a separate
+        thread and bot cameras copy into rotating textures, see stepFrame.
+        config's render_profile selects the rendering quality of the bot
+        cameras, see RENDER_PROFILES; the main view always gets full quality.
+        The HUD only exists in interactive worlds with the interactive profile.
+        """
+
+        if headless is None:
+            headless = config.get('headless', False)
+        self.headless = headless
+
+        if self.headless:
+            # e.g. p3headlessgl (EGL) or p3tinydisplay (software) on servers without X
+            display = config.get('headless_display', None)
+            if display:
+                loadPrcFileData("", f"load-display {display}")
+            window_type = 'none'
+            interactive = False
+
+        self.pipelinedReadback = config.get('pipelined_readback', False)
+        if self.pipelinedReadback:
+            # app and cull stay in the main thread, drawing and texture
+            # transfer overlap with whatever follows renderFrame()
+            loadPrcFileData("", "threading-model /Draw")
+
+        super().__init__(windowType=window_type)
+
+        if self.headless and self.pipe is None:
+            self.makeDefaultPipe()
+        self.botCamGsg = None
+
+        if n_arenas is None:
+            n_arenas = config.get('n_arenas', 1)
+        self.interactive = interactive
+
+        self.renderProfile = config.get('render_profile', 'interactive')
+        if self.renderProfile not in RENDER_PROFILES:
+            raise ValueError(f"unknown render_profile {self.renderProfile}, expected one of {RENDER_PROFILES}")
+        # shadows, auto shader and skybox are only needed when someone looks at them
+        self.fullQuality = self.renderProfile == 'interactive' or self.interactive
+
+        if self.interactive:
+            wp = WindowProperties()
+            wp.setSize(1200, 720)
+            #wp.setSize(1920, 1080)
+        
+            self.win.requestProperties(wp)
 
         # load models from the environment default folder Lib\site-packages\panda3d\models
         self.loadGround()        
-        self.loadBot()
-        self.loadTarget()
 
         # self.pligth_np = self.createPointLight()
         self.dlight_np = self.createDirectionalLight()
         self.alight_np = self.createAmbientLight()
         
-        self.render.setShaderAuto()
+        if self.fullQuality:
+            self.render.setShaderAuto()
+            self.setupSkybox()
+        else:
+            self.skybox = None
+
+        # arena 0 is the one shown in the main viewport, each arena has its own
+        # bot, target, bot camera and collision nodes
+        self.arenas = [ Arena(self, 0, self.render, interactive=self.interactive) ]
+        for index in range(1, n_arenas):
+            self.arenas.append( Arena(self, index, self.createArenaRoot(index)) )
+
+        self.bot = self.arenas[0].bot
+        self.target = self.arenas[0].target
+
+        self.learning = False
+        self.hud = None
+
+        if config.get('profiling', False):
+            profiler.instrument_world(self, pstats=config.get('pstats', False))
+
+        if not self.interactive:
+            # nobody watches the main view, only the bot camera buffers are rendered
+            if self.win is not None:
+                self.win.setActive(False)
+            return
 
         # set viewport stuff
         self.setupCamera()
         self.setupMouseWatcher()
 
         self.setupCrosshair()
-        self.setupSkybox()
 
-        # set collision system
-        self.setupCollisions()
-
-        # setup bot camera
-        self.setupBotCamera()
+        # the agent is created by the first Ctrl-T/Ctrl-P, see Bot.agent
 
         # create frame for status messages
-        self.info_frame = InfoFrame()
+        if self.renderProfile == 'interactive' and config.get('hud', True):
+            self.setupHud()
 
-        taskMgr.add(self.updateInfoFrame, "updateInfoFrameTask" )
-
-        self.learning = False
         self.accept('control-t', self.startLearn )
         self.accept('control-p', self.startPlay )
         self.accept('control-o', self.targetRandomMove )
@@ -77,53 +153,42 @@ class RobotTargetWorld(ShowBase):
         """
         Load the 3d model for the ground plane
         """
-        self.ground = self.loader.loadModel("assets/models/ground.egg")
+        self.ground = loadCachedModel(self.loader, "assets/models/ground.egg")
         self.ground.reparentTo(self.render)
 
-    def loadBot(self):
-        """
-        Loads 3d model for the bot (blue ball with camera)
-        """
-        self.bot = Bot(self)
-        # self.bot = self.loader.loadModel("assets/models/bot.egg")
-        self.bot.reparentTo(self.render)
-        self.bot.setPos(5, -5, 0)
-
-    def loadTarget(self):
-        """
-        Loads 3d model for target (green box)
-        """
-        self.target = self.loader.loadModel("assets/models/target.egg")
-        self.target.setPos(-5, 5, 0)
-        self.target.reparentTo(self.render)
-
-    def createAmbientLight(self):
+    def createAmbientLight(self, parent=None):
         """
         Creates ambient light
         """
         print("creating ambient")
+        if parent is None:
+            parent = self.render
+
         ambientLight = AmbientLight('ambientLight')
         ambientLight.setColor(Vec4(0.8, 0.8, 0.9, 1))
-        ambientLight_node_path = self.render.attachNewNode(ambientLight)
+        ambientLight_node_path = parent.attachNewNode(ambientLight)
 
-        self.render.setLight(ambientLight_node_path)
+        parent.setLight(ambientLight_node_path)
         
         return ambientLight_node_path
     
-    def createDirectionalLight(self):
+    def createDirectionalLight(self, parent=None):
         """
         Create directional light
         """
         print("creating directional")
+        if parent is None:
+            parent = self.render
 
         dir_light = DirectionalLight('directionalLight')
         dir_light.setColor((1, 1, 1, 1))
-        dir_light.setShadowCaster(True, 512, 512)
+        if self.fullQuality:
+            dir_light.setShadowCaster(True, 512, 512)
 
-        dir_light_node_path = render.attachNewNode(dir_light)
+        dir_light_node_path = parent.attachNewNode(dir_light)
         dir_light_node_path.setHpr(45, -45, 0)
         
-        self.render.setLight(dir_light_node_path)
+        parent.setLight(dir_light_node_path)
 
         return dir_light_node_path
     
@@ -184,12 +249,13 @@ class RobotTargetWorld(ShowBase):
         """
         Sets the sky box background
         """
-        skybox = loader.loadModel('assets/skybox/skybox-circular.egg')
+        skybox = loadCachedModel(self.loader, 'assets/skybox/skybox-circular.egg')
         skybox.setScale(500)
         skybox.setBin('background', 1)
         skybox.setDepthWrite(0)
         skybox.setLightOff()
         skybox.reparentTo(self.render)
+        self.skybox = skybox
 
         # see: https://discourse.panda3d.org/t/changing-the-background-image-work-at-random-times-only/28594/1
         # self.background = OnscreenImage(parent=render2dp, 
@@ -198,63 +264,110 @@ class RobotTargetWorld(ShowBase):
         # cannot make the bot camera display region not transparent in sky regions
 
 
-    def setupMouseWatcher(self):
+    def createArenaRoot(self, index):
         """
-        Initialize MouseWatcher to caputre mouse click events.
+        Creates the scene root of an additional arena.
+        Ground and skybox geometry are shared with the main scene through
+        instancing, lights are per arena since they must belong to the
+        scene graph they illuminate.
         """
-        self.mouse_watcher = MouseWatcher('mouseWatcher')
-        base.mouseWatcher.attachNewNode(self.mouse_watcher)
+        root = NodePath(f'arena-{index}')
 
-        # setup jump to mouse click
-        self.accept('mouse1', self.jumpToMouse, [ self.bot ])
-        self.accept('shift-mouse1', self.jumpToMouse, [ self.target ])
-        self.plane = Plane(Vec3(0, 0, 1), Point3(0, 0, 0))
+        self.ground.instanceTo(root)
+
+        self.createDirectionalLight(root)
+        self.createAmbientLight(root)
+
+        # only seen by its bot camera
+        if self.renderProfile == 'interactive':
+            self.skybox.instanceTo(root)
+            root.setShaderAuto()
+
+        return root
 
-    def setupCollisions(self):
+    def makeBotCameraBuffer(self, name, width, height):
         """
-        Setup collision system to capture collisions between
-        the bot and the target
+        Creates the offscreen buffer a bot camera renders into.
+        With a window the buffer is hosted by it, in headless mode it is
+        a standalone buffer; all the bot camera buffers share the same GSG.
         """
-        self.cTrav = CollisionTraverser()  # Collision traverser for handling collisions
-        self.cHandler = CollisionHandlerQueue()  # Collision handler to store collision results
+        if self.win is not None:
+            return self.win.makeTextureBuffer(name, width, height)
 
-        # Create collision nodes for bot and target
-        botCollisionNode = CollisionNode("bot")
-        botCollisionNode.addSolid(CollisionSphere(0, 0, 0, 0.5))  # Adjust the sphere radius according to your bot's size
-        botCollisionNP = self.bot.attachNewNode(botCollisionNode)
+        fb_props = FrameBufferProperties()
+        fb_props.setRgbColor(True)
+        fb_props.setRgbaBits(8, 8, 8, 0)
+        fb_props.setDepthBits(24)
 
-        targetCollisionNode = CollisionNode("target")
-        targetCollisionNode.addSolid(CollisionSphere(0, 0, 0, 0.5))  # Adjust the sphere radius according to your target's size
-        targetCollisionNP = self.target.attachNewNode(targetCollisionNode)
+        buffer = self.graphicsEngine.makeOutput(self.pipe, name, -2,
+                                                fb_props, WindowProperties.size(width, height),
+                                                GraphicsPipe.BFRefuseWindow,
+                                                self.botCamGsg, None)
+        if buffer is None:
+            raise RuntimeError(f"cannot create headless buffer with display {self.pipe.getInterfaceName()}")
 
-        self.cTrav.addCollider(botCollisionNP, self.cHandler)  # Add bot's collision node to the traverser
+        buffer.setClearColor(HEADLESS_CLEAR_COLOR)
+        buffer.setClearColorActive(True)
+        buffer.setClearDepthActive(True)
 
-    def setupBotCamera(self):
+        self.botCamGsg = buffer.getGsg()
+        return buffer
+
+    def applyRenderProfile(self, camera, buffer):
         """
-        Setup the bot camera. 
-        This is a secondary camera attached to the bot, provides its PoV.
-        see: self.getBotCameraBufferImage
+        Sets up a bot camera and its buffer for the render profile: an
+        initial state overriding the scene's shader and lights, and a camera
+        mask hiding the skybox, replaced by the buffer's clear color
         """
+        camera.node().setCameraMask(BOT_CAMERA_MASK)
+        if self.renderProfile == 'interactive':
+            return
 
-        self.botCamBuffer = base.win.makeTextureBuffer(f'botCam', BOT_CAMERA_FILM_WIDTH, BOT_CAMERA_FILM_HEIGHT )
-        
-        self.botCamTexture = Texture()
-        self.botCamBuffer.addRenderTexture(self.botCamTexture, 
-                                           GraphicsOutput.RTM_copy_ram
-                                           )
+        state = NodePath('botCamState')
+        state.setShaderOff(1000)
+        if self.renderProfile == 'minimal':
+            state.setLightOff(1000)
+        camera.node().setInitialState(state.getState())
 
-        # self.botCamBuffer.setSort(-99)
-        self.botCam  = base.makeCamera( self.botCamBuffer )
+        if self.skybox is not None:
+            self.skybox.hide(BOT_CAMERA_MASK)
+        buffer.setClearColor(SKY_CLEAR_COLOR)
+        buffer.setClearColorActive(True)
 
-        self.botCam.reparentTo(self.bot)
-        self.botCam.setPos(0, 0.15, 0.5) 
+    def setupMouseWatcher(self):
+        """
+        Initialize MouseWatcher to caputre mouse click events.
+        """
+        self.mouse_watcher = MouseWatcher('mouseWatcher')
+        base.mouseWatcher.attachNewNode(self.mouse_watcher)
+
+        # setup jump to mouse click
+        self.accept('mouse1', self.jumpToMouse, [ self.bot ])
+        self.accept('shift-mouse1', self.jumpToMouse, [ self.target ])
+        self.plane = Plane(Vec3(0, 0, 1), Point3(0, 0, 0))
+
+    # Rendering functions
 
-        # Get the current lens of the botCam
-        self.botCam.node().getLens().setFilmSize(BOT_CAMERA_FILM_WIDTH, BOT_CAMERA_FILM_HEIGHT)
+    def stepFrame(self, sync=False):
+        """
+        Renders one frame for the main window and all the bot cameras.
+
+        In pipelined readback mode renderFrame() returns while the frame is
+        still being drawn and copied to RAM, and the observations read after
+        it are the ones of the previous frame: one step of latency in
+        exchange for GPU and driver time overlapping with the caller's work
+        (e.g. policy inference). sync renders enough frames for the
+        observations to show the current state, e.g. after a reset.
+        """
+        n_frames = 1
+        if self.pipelinedReadback and sync:
+            n_frames = len(self.arenas[0].botCamTextures)
 
-        botCamDispRegion = base.win.makeDisplayRegion(0.75, 0.95, 0.05, 0.3 )
-        botCamDispRegion.setCamera(self.botCam)
-        botCamDispRegion.setClearDepthActive(True)
+        for _ in range(n_frames):
+            if self.pipelinedReadback:
+                for arena in self.arenas:
+                    arena.rotateReadbackTexture()
+            self.graphicsEngine.renderFrame()
 
     # Action functions
 
@@ -266,6 +379,7 @@ class RobotTargetWorld(ShowBase):
         tgt_x = random.uniform(-10.0, 10.0)
         tgt_y = random.uniform(-10.0, 10.0)
         self.target.setPos(tgt_x, tgt_y, 0.0)
+        self.refreshCollisions()
 
     def jumpToMouse(self, object):
         """
@@ -293,24 +407,55 @@ class RobotTargetWorld(ShowBase):
                     # Only if valid position...
                     # Move the object to the mouse position on the z=0 plane
                     object.setPos(x, y, 0)
+                    self.refreshCollisions()
 
     def collisionDetected(self):
         """
         Called to check wether a collision between the bot
         and the target occurred. Signals successfull end of episode.
         """
-        # Check if any collisions occurred
-        self.cTrav.traverse(self.render)
-        return self.cHandler.getNumEntries() > 0
+        return self.arenas[0].collisionDetected()
+
+    def refreshCollisions(self):
+        """
+        To be called after the target is moved, see Arena.refreshCollisions
+        """
+        self.arenas[0].refreshCollisions()
         
+    def saveState(self, out=None):
+        """
+        Snapshot of all the arenas, a STATE_DTYPE array indexed by arena
+        """
+        if out is None:
+            out = np.zeros(len(self.arenas), dtype=STATE_DTYPE)
+        for arena, state in zip(self.arenas, out):
+            arena.saveState(state)
+        return out
+
+    def restoreState(self, states):
+        """
+        Puts the arenas back in a snapshot taken by saveState, nothing is rendered
+        """
+        for arena, state in zip(self.arenas, states):
+            arena.restoreState(state)
+
     def startLearn(self):
         """
         Triggers learning for the bot's agent, with parameters as specified by configuration
         Called when the user pressed 'control-t'
         """
+        if config.get('numpy_policy', None):
+            print("cannot learn with numpy_policy, unset it to train the PPO agent")
+            return
+
         print("learning...")
         self.learning = True
-        self.bot.agent.learn(config['n_episodes'], config['n_max_steps_per_episode'])
+        if config.get('background_training', True) and not self.headless:
+            # the viewport stays live, Ctrl-P plays the latest trained policy
+            self.bot.agent.learn_in_background(config['n_episodes'], config['n_max_steps_per_episode'])
+        else:
+            self.bot.agent.learn(config['n_episodes'], config['n_max_steps_per_episode'])
+            self.learning = False
         
     def startPlay(self):
         """
@@ -327,7 +472,7 @@ class RobotTargetWorld(ShowBase):
         Calculates current distance between the bot and the target.
         Useful for reward evaluation.
         """
-        return self.bot.getDistance(self.target)
+        return self.arenas[0].getBotTargetDistance()
     
     def getBotTargetAngle(self):
         """
@@ -337,73 +482,76 @@ class RobotTargetWorld(ShowBase):
         Useful for reward evaluation.
         """
 
-        bot_pos = self.bot.getPos()
-        target_pos = self.target.getPos()
-        
-        u = self.bot.getRelativeVector(render, (0, 1, 0)) # bot_y_axis
-        u = Vec2(-u.x, u.y) # don't know why but I have to invert x coord
+        return self.arenas[0].getBotTargetAngle()
 
-        v = target_pos - bot_pos # dir_vec
-        v = Vec2(v.x, v.y)
-        v.normalize()
-        
-        dot = u.x*v.x + u.y*v.y      # dot product
-        det = u.x*v.y - u.y*v.x      # determinant
+    def setupHud(self):
+        """
+        Creates the InfoFrame and the values it shows, refreshed at most
+        hud_refresh_rate times per second
+        """
+        self.info_frame = InfoFrame()
+        self.hud = Hud(self.info_frame, config.get('hud_refresh_rate', HUD_REFRESH_RATE))
 
-        return abs(math.atan2(det, dot))  
+        self.hud.addValue('pos', 'pos', 2, (0, 0))
+        self.hud.addValue('distance', 'distance:', 2)
+        self.hud.addValue('angle', 'angle:', 2)
+        self.hud.addValue('axis', 'bot y axis:', 2, (0, 0))
+        self.hud.addSeparator()
+        # published by the environment and the agent
+        self.hud.addValue('reward', 'last reward', 3)
+        self.hud.addValue('cumulative_reward', 'cumulative reward', 3)
+        self.hud.addValue('remaining_steps', 'remaining steps', 0)
+        if profiler.enabled:
+            self.hud.addSeparator()
+            self.hud.addText('profile')
 
-    def updateInfoFrame(self, task):
+        taskMgr.doMethodLater(self.hud.refreshInterval, self.updateHud, "updateHudTask" )
+
+    def updateHud(self, task=None):
         """
-        Updates debugging information on the top-left InfoFrame UI
+        Publishes the state of the main arena, however the bot was moved,
+        and refreshes the InfoFrame text if anything changed
         """
+        if self.hud is None:
+            return
 
-        # distance
-        distance = self.bot.getDistance(self.target)
-        
-        # angle
-        angle = self.getBotTargetAngle()
-
-        # bot pos
         pos = self.bot.getPos()
-
-        # current bot agent's cum_reward
-        reward = self.bot.agent.cumulative_reward 
-        steps = self.bot.agent.playing_steps
+        self.hud.publish('pos', (pos.x, pos.y))
+        self.hud.publish('distance', self.bot.getDistance(self.target))
+        # not part of any step, kept out of the profiled phases
+        with profiler.untimed():
+            self.hud.publish('angle', self.getBotTargetAngle())
 
         u = self.bot.getRelativeVector(render, (0, 1, 0))
-        u = Vec2(-u.x, u.y) # bot_y_axis
-
-        newtext = f" pos {pos.x:.2f} {pos.y:.2f} \
-                    \n distance: {distance:.2f} \
-                    \n angle:  {angle:.2f} \
-                    \n bot y axis: {u.x:.2f}, {u.y:.2f} \
-                    \n ------------- \
-                    \n cumulative reward {reward:.3f} \
-                    \n remaining steps {steps}"
-        
-        self.info_frame.setText(newtext)
-        return Task.again
+        self.hud.publish('axis', (-u.x, u.y)) # bot_y_axis
+
+        if profiler.enabled:
+            self.hud.publishText('profile', profiler.hud_text())
+
+        self.hud.refresh()
 
-    def getBotCameraBuffer(self):
+        if task is not None:
+            return Task.again
+
+    def getBotCameraBuffer(self, out=None):
         """
         Returns the RAM image corresponding to the current bot camera view
-        as an np.array
+        as an np.array, see Arena.getBotCameraBuffer
         """
-        buffer = self.botCamTexture.getRamImageAs("RGB")
-        buffer = np.asarray(memoryview(buffer))
-        # for some reason the image is stored as (rows, cols, colors), with
-        # rows inveerted upside down
-        buffer = buffer.reshape(BOT_CAMERA_FILM_HEIGHT, BOT_CAMERA_FILM_WIDTH, 3)
-        buffer = buffer[::-1, :, :] 
+        return self.arenas[0].getBotCameraBuffer(out)
 
-        return buffer
+    def getBotCameraImage(self, out=None):
+        """
+        Unprocessed RGB bot camera view, see Arena.getBotCameraImage
+        """
+        return self.arenas[0].getBotCameraImage(out)
 
     def saveBotCameraScreenshot(self):
         """
         saves the current bot camera view as png file
         """
-        buffer = self.getBotCameraBuffer()
-        image = Image.fromarray(np.uint8(buffer))
+        buffer = self.arenas[0].getBotCameraImage()
+        image = Image.fromarray(buffer)
 
         current_datetime = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"output/{current_datetime}.png"